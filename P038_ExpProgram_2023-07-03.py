@@ -39,34 +39,97 @@ during this interval.
 # the program is running in operant boxes (True) or not (False).
 operant_box_version = True
 
+# How often the session data file is pushed to disk while a session runs.
+# Rows are appended to the .csv as events happen, and are flushed either
+# after every "event", once per "trial" (during the ITI), or every N ms (give
+# an int, e.g. 5000). Setting data_fsync to True also forces each flush
+# through the OS cache, which is safer but slower on the box PCs.
+data_flush_policy = "trial"
+data_fsync = False
+
+# At the end of each session its data file is added to the session catalog
+# (this box PC's own catalog, kept out of the synced data folder; see
+# session_catalog.py). Set catalog_events to True to also store every event
+# row in the catalog.
+catalog_sessions = True
+catalog_events = False
+
+# While a session runs, its live status (trial, reinforcers, pecks per minute,
+# time left, event-loop lag, hopper state) is served as JSON at
+# http://<telemetry_host>:<telemetry_port>/metrics (see telemetry.py). Use
+# "0.0.0.0" as the host to let other computers watch the box, or set the port
+# to None to turn this off.
+telemetry_host = "127.0.0.1"
+telemetry_port = 8038
+
+# Set to True to profile sessions: how long each of MainScreen's callbacks
+# takes, how late its timers fire, event-loop lag, and memory use. A summary
+# is written next to the data file ("_profile.json"); see profiling.py.
+profile_sessions = False
+
+# Save a checkpoint at every trial so that a session cut short (e.g., by a
+# crash) can be resumed from the control panel; see checkpoint.py.
+checkpoint_sessions = True
+
+# Touchscreens sometimes register one peck twice. A peck within 30 px of the
+# previous one and less than this many ms after it is thrown out (and
+# counted) instead of being logged; see hit_testing.py. Set to 0 to keep
+# every peck.
+peck_debounce_ms = 50
+
+# Pecks to the blank/dark screen can be coalesced into one summary row per
+# window (count, first/last time, bounding box) in a "_coalesced.csv" next
+# to the data file, instead of one .csv row (and terminal line) each. Give
+# the window (ms) of each event type to coalesce, e.g.
+# {"ITI_peck": 5000, "hopper_up_peck": 5000}. Key pecks and reinforcers are
+# always written in full, as is every peck in the .evt; see
+# peck_coalescing.py. Leave empty to write every peck to the .csv.
+coalesce_pecks = {}
+
+# For long sessions, only this many events are kept in memory: at the end of
+# a trial, once there are this many, they are moved to a scratch file next
+# to the data file (and put back together into the .evt at the end); see
+# event_store.py. The same goes for the log of onset times. Set to None to
+# keep everything in memory.
+event_spool_size = 5000
+
 # Prior to running any code, its conventional to first import relevant 
-# libraries for the entire script. These can range from python libraries (sys)
-# or sublibraries (setrecursionlimit) that are downloaded to every computer
+# libraries for the entire script. These can range from python libraries
+# (datetime) or sublibraries (perf_counter_ns) that are downloaded to every computer
 # along with python, or other files within this folder (like control_panel or 
 # maestro).
+from startup import StartupTimer, HardwareLoader
+startup_timer = StartupTimer() # How long each part of starting up takes
 from tkinter import Toplevel, Canvas, BOTH, TclError, Tk, Label, Button, \
     StringVar, OptionMenu, IntVar, Radiobutton
-from datetime import datetime, timedelta, date
-from time import time
-from csv import writer, DictReader, QUOTE_MINIMAL
+from datetime import datetime, date
 from os import getcwd, mkdir, path as os_path
-from random import shuffle
-from sys import setrecursionlimit, path as sys_path
+from session_recorder import SessionRecorder
+from event_logger import EventLogger
+from event_store import EventStore, CSV_HEADER, binary_path_for, SPOOL_EXTENSION
+from trial_sequences import generate_sequence, new_seed, pass_seed
+from protocol import load_protocol, ProtocolError
+from schedule_library import ScheduleLibrary
+from stimulus_layer import StimulusLayer
+from session_clock import SessionClock
+from hopper_driver import HopperDriver
+from telemetry import SessionTelemetry, TelemetryServer
+from profiling import SessionProfiler
+from session_catalog import SessionCatalog, default_catalog_path
+from settings_registry import SettingsRegistry, SettingsError
+from checkpoint import SessionCheckpoint, find_resumable, truncate_data_file
+from peck_coalescing import PeckCoalescer, summary_path_for, read_session_rows
+from online_stats import SessionStats, stats_path_for
+from time import perf_counter_ns
 
-# Import hopper/other specific libraries from files on operant box computers
-try:
-    if operant_box_version:
-        cwd = getcwd()
-        sys_path.insert(0, str(os_path.expanduser('~')+"/OneDrive/Desktop/Hopper_Software"))
-        import polygon_fill
-        from hopper import HopperObject
-except ModuleNotFoundError:
-    print("ERROR :-( \n Cannot find the hopper software folder. \n Maybe a bird moved it? \n Check the trash and desktop folders and drag it to the desktop <3")
-    input()
-
-# Below  is just a safety measure to prevent too many recursive loops). It
-# doesn't need to be changed.
-setrecursionlimit(5000)
+startup_timer.mark("imports")
+
+# The hopper/paint program libraries live in the Hopper_Software folder on
+# operant box computers. They are only imported once they're needed (the
+# hopper is loaded in the background as the control panel opens), so the
+# program starts quickly and can be imported anywhere, even without them.
+# See startup.py.
+hardware = HardwareLoader(timer = startup_timer)
 
 """
 The code below jumpstarts the loop by first building the hopper object and 
@@ -83,6 +146,13 @@ object, and a macro-level overview is:
 
 """
 
+# Where the subject settings sheet (P038_Settings-Assignments.csv) lives
+def default_settings_csv_directory():
+    if operant_box_version:
+        return str(os_path.expanduser('~')+"/OneDrive/Desktop/P038/P038_Settings-Assignments.csv")
+    else:
+        return "P038_Settings-Assignments.csv"
+
 # The first of two objects we declare is the ExperimentalControlPanel (CP). It
 # exists "behind the scenes" throughout the entire session, and if it is exited,
 # the session will terminate. The purpose of the control panel is to input 
@@ -104,22 +174,38 @@ class ExperimenterControlPanel(object):
             self.doc_directory = str(os_path.expanduser('~'))+"/Documents/"
             self.data_folder = "P038_data" # The folder within Documents where subject data is kept
             self.data_folder_directory = str(os_path.expanduser('~'))+"/OneDrive/Desktop/Data/" + self.data_folder
-        # Set hopper object to be a variable of self, so it can be referenced...
-            self.Hopper = HopperObject()
+        # Start loading the hopper in the background; it is picked up once a
+        # session is started (see build_chamber_screen())
+            hardware.probe()
         else: # If not, just save in the current directory the program us being run in 
             self.data_folder_directory = getcwd() + "/Data/"
-            self.Hopper = None
+        
+        # Load (and check) the protocol (its phases, groups, trial types,
+        # and what a peck to each key does; see protocol.py)...
+        try:
+            self.protocol = load_protocol()
+        except ProtocolError as e:
+            print(f"ERROR :-( \n {e}")
+            input()
+            raise SystemExit(1)
+        # ...and the settings sheet, once, up front. Every subject's settings
+        # are kept in memory from here on, and the sheet is only read again
+        # if it is changed (see settings_registry.py).
+        try:
+            self.settings_registry = SettingsRegistry(default_settings_csv_directory(),
+                                                      groups = self.protocol.group_names())
+        except SettingsError as e:
+            print(f"ERROR :-( \n {e}")
+            input()
+            raise SystemExit(1)
+        startup_timer.mark("settings")
         
         # setup the root Tkinter window
         self.control_window = Tk()
         self.control_window.title("P038 Control Panel")
         ##  Next, setup variables within the control panel:
-        # Subject ID list (need to build/alphabetize) - TBD
-        self.pigeon_name_list = ["Itzamma", "Mario", "Jubilee", "Herriot",
-                                 "Meat Loaf", "Odin", "Vonnegut", "Durrell",
-                                 "Thoth", "Bowie"]
-        self.pigeon_name_list.sort() # This alphabetizes the list
-        self.pigeon_name_list.insert(0, "TEST")
+        # Subject ID list, straight from the settings sheet (TEST first)
+        self.pigeon_name_list = self.settings_registry.subject_names()
         # Subject ID menu and label
         Label(self.control_window, text="Pigeon Name:").pack()
         self.subject_ID_variable = StringVar(self.control_window)
@@ -127,15 +213,16 @@ class ExperimenterControlPanel(object):
         self.subject_ID_menu = OptionMenu(self.control_window,
                                           self.subject_ID_variable,
                                           *self.pigeon_name_list,
-                                          command=self.set_pigeon_ID).pack()
+                                          command=self.set_pigeon_ID)
+        self.subject_ID_menu.pack()
+        # Each time the menu is opened, pick up any edits to the sheet
+        self.subject_ID_menu["menu"].configure(postcommand = self.refresh_settings)
         
         # Training phases
         Label(self.control_window, text = "Select experimental phase:").pack()
         self.training_phase_variable = StringVar() # This is the literal text of the phase, e.g., "0: Autoshaping"
         self.training_phase_variable.set("Select") # Default
-        self.training_phase_name_list = ["0: Pre-Training",
-                                         "1: Training"
-                                         ]
+        self.training_phase_name_list = self.protocol.phase_names()
         self.training_phase_menu = OptionMenu(self.control_window,
                                           self.training_phase_variable,
                                           *self.training_phase_name_list)
@@ -161,11 +248,38 @@ class ExperimenterControlPanel(object):
                                    text = 'Start program',
                                    bg = "green2",
                                    command = self.build_chamber_screen).pack()
+        # Resume button (carries on with the subject's last unfinished
+        # session, if there is one)
+        self.resume_button = Button(self.control_window,
+                                    text = 'Resume session',
+                                    command = lambda: self.build_chamber_screen(resume = True)).pack()
+        
+        startup_timer.mark("control panel")
+        startup_timer.report()
         
         # This makes sure that the control panel remains onscreen until exited
         self.control_window.mainloop() # This loops around the CP object
         
         
+    def refresh_settings(self):
+        # Re-reads the settings sheet if it has changed since it was loaded
+        # (and rebuilds the subject menu to match). If the edited sheet has
+        # problems, they are printed and the previous settings are kept.
+        try:
+            changed = self.settings_registry.reload()
+        except SettingsError as e:
+            print(f"\nERROR: {e}\n (still using the settings loaded before)")
+            return
+        if changed:
+            self.pigeon_name_list = self.settings_registry.subject_names()
+            menu = self.subject_ID_menu["menu"]
+            menu.delete(0, "end")
+            for pigeon_name in self.pigeon_name_list:
+                menu.add_command(label = pigeon_name,
+                                 command = lambda name=pigeon_name: (self.subject_ID_variable.set(name),
+                                                                     self.set_pigeon_ID(name)))
+            print("\n- Settings sheet reloaded")
+        
     def set_pigeon_ID(self, pigeon_name):
         # This function checks to see if a pigeon's data folder currently 
         # exists in the respective "data" folder within the Documents
@@ -183,13 +297,32 @@ class ExperimenterControlPanel(object):
                 mkdir(os_path.join(parent_directory, pigeon_name))
                 print("\n ** NEW DATA FOLDER FOR %s CREATED **" % pigeon_name.upper())
                 
-    def build_chamber_screen(self):
+    def build_chamber_screen(self, resume=False):
         # Once the green "start program" button is pressed, then the mainscreen
         # object is created and pops up in a new window. It gets passed the
         # important inputs from the control panel. Importantly, it won't
-        # run unless all the informative fields are filled in.
-        if self.subject_ID_variable.get() in self.pigeon_name_list:
+        # run unless all the informative fields are filled in. If resuming,
+        # the subject's last unfinished session is picked back up instead
+        # (in its own phase, whatever is selected here).
+        self.refresh_settings()
+        checkpoint = None
+        if resume and self.subject_ID_variable.get() in self.settings_registry:
+            checkpoint = find_resumable(self.data_folder_directory, self.subject_ID_variable.get())
+            if checkpoint is None:
+                print(f"\nERROR: No unfinished session to resume for {self.subject_ID_variable.get()}")
+                return
+            self.training_phase_variable.set(self.training_phase_name_list[checkpoint.training_phase])
+        if self.subject_ID_variable.get() in self.settings_registry:
             if self.training_phase_variable.get() in self.training_phase_name_list:
+                # Set hopper object to be a variable of self, so it can be
+                # referenced (waits for the background probe, if needed)
+                if operant_box_version:
+                    self.Hopper = hardware.hopper()
+                    if self.Hopper is None:
+                        print("\nERROR: No hopper, so the session can't start (see above)")
+                        return
+                else:
+                    self.Hopper = None
                 list_of_variables_to_pass = [self.Hopper,
                                              self.subject_ID_variable.get(),
                                              self.record_data_variable.get(), # Boolean for recording data (or not)
@@ -198,7 +331,9 @@ class ExperimenterControlPanel(object):
                                              self.training_phase_name_list # list of training phases
                                              ]
                 print(f"{'SESSION STARTED': ^15}") 
-                self.MS = MainScreen(*list_of_variables_to_pass)
+                self.MS = MainScreen(*list_of_variables_to_pass,
+                                     settings_registry = self.settings_registry,
+                                     resume = checkpoint)
             else:
                 print("\nERROR: Input Experimental Phase Before Starting Session")
         else:
@@ -212,11 +347,20 @@ class MainScreen(object):
     # run when the object is first built:
     
     def __init__(self, Hopper, subject_ID, record_data, data_folder_directory,
-                 training_phase, training_phase_name_list):
+                 training_phase, training_phase_name_list, root=None,
+                 canvas=None, time_source=perf_counter_ns,
+                 settings_csv_directory=None, echo=True,
+                 threaded_logging=True, settings_registry=None, resume=None):
         ## Firstly, we need to set up all the variables passed from within
         # the control panel object to this MainScreen object. We do this 
         # by setting each argument as "self." objects to make them global
         # within this object.
+        # (The keyword arguments are only used when running without a
+        # display, e.g. by simulation.py: a stand-in window/Canvas, a virtual
+        # clock, and where the settings sheet is. They can be left out
+        # when running the experiment, apart from the settings registry,
+        # which the control panel passes along, and resume, a
+        # SessionCheckpoint of an unfinished session to carry on with.)
         
         # Setup training phase
         self.training_phase = training_phase_name_list.index(training_phase) # Starts at 0 **
@@ -226,16 +370,45 @@ class MainScreen(object):
         # Set the other pertanent variables given in the command window
         self.subject_ID = subject_ID
         self.record_data = record_data
+        self.echo = echo # Print event feedback to the terminal?
+        self.threaded_logging = threaded_logging # Log events on a separate thread?
+        self.resume = resume # Checkpoint of the session being resumed (or None)
+        # This subject's settings (hopper and ITI durations, group, and key
+        # colors) come from the settings registry, which already holds the
+        # whole (checked) settings sheet in memory. Looking them up now means
+        # a subject missing from the sheet is caught before the session
+        # starts, and starting it needs no file access.
+        if settings_registry is None:
+            settings_registry = SettingsRegistry(settings_csv_directory or default_settings_csv_directory())
+        self.settings_csv_directory = settings_registry.csv_path
+        self.settings = settings_registry.get(self.subject_ID)
+        # What happens in each phase (which keys each trial type shows, in
+        # which roles, and what a peck to each does) is set in the protocol
+        # file, which is compiled into lookup tables once; see protocol.py.
+        self.protocol = load_protocol()
+        self.phase_tables = self.protocol.phase(self.training_phase)
+
+        # If profiling, the hot paths are wrapped with timers now, before
+        # any of them are handed out as Canvas bindings or timer callbacks.
+        # (Calls are always timed in real time, even on a virtual clock.)
+        if profile_sessions:
+            self.profiler = SessionProfiler()
+            self.profiler.wrap(self)
+        else:
+            self.profiler = None
 
         ## Next, set up the visual Canvas
-        self.root = Toplevel()
+        self.root = root if root is not None else Toplevel()
         self.root.title("P038: " + self.training_phase_name_list[self.training_phase][3:]) # this is the title of the windows
         self.mainscreen_height = 600 # height of the experimental canvas screen
         self.mainscreen_width = 800 # width of the experimental canvas screen
         self.root.bind("<Escape>", self.exit_program) # bind exit program to the "esc" key
         
+        # If a Canvas was passed in (e.g., headless), just use that
+        if canvas is not None:
+            self.mastercanvas = canvas
         # If the version is the one running in the boxes...
-        if operant_box_version: 
+        elif operant_box_version: 
             # Keybind relevant keys
             self.cursor_visible = True # Cursor starts on...
             self.change_cursor_state() # turn off cursor UNCOMMENT
@@ -256,14 +429,59 @@ class MainScreen(object):
                                    height=self.mainscreen_height,
                                    width = self.mainscreen_width)
             self.mastercanvas.pack()
+        
+        # Coordinates of the two keys, given in [x1, y1, x2, y2] coordinates
+        self.key_coordinates = {"left_choice_key": [200, 250, 300, 350],
+                                "right_choice_key": [500, 250, 600, 350]}
+        if sorted(self.protocol.keys) != sorted(self.key_coordinates):
+            raise ProtocolError(f"The protocol's keys ({', '.join(self.protocol.keys)}) aren't the keys on the screen")
+        if not set(self.protocol.roles) <= {"optimal", "suboptimal"}: # (the roles with a color in the settings sheet)
+            raise ProtocolError(f"The protocol's roles ({', '.join(self.protocol.roles)}) should be optimal and/or suboptimal")
+        # Which of the protocol's keys is logged as LeftKey and RightKey
+        self.left_key_index = self.protocol.key_index["left_choice_key"]
+        self.right_key_index = self.protocol.key_index["right_choice_key"]
+        # Every stimulus on the Canvas (background, keys, and text) is built
+        # once here. From then on, each state (ITI, keys, food) only
+        # shows/hides/recolors these same items. Pecks are caught by one
+        # binding on the whole Canvas, which looks up what was pecked (and
+        # how far from the nearest key) in a precomputed map of the screen.
+        self.stimuli = StimulusLayer(self.mastercanvas,
+                                     self.mainscreen_width,
+                                     self.mainscreen_height,
+                                     self.key_coordinates,
+                                     on_background = self.write_data,
+                                     on_key = self.key_press,
+                                     debounce_ms = peck_debounce_ms,
+                                     time_source = time_source)
             
         # Setup hopper (passed from the control panel)
         self.Hopper = Hopper
         
-        # Timing variables
+        # Timing variables. Every duration is timed by the session clock, a
+        # monotonic ns clock that schedules each phase against an absolute
+        # deadline (so Tk lateness doesn't add up across trials) and logs the
+        # intended vs. actual onset of each ITI, key presentation, and hopper
+        # event. See session_clock.py.
+        self.clock = SessionClock(self.root, time_source = time_source)
+        # Hopper commands are sent through a driver, which sends them from a
+        # worker thread (so a slow hopper can't hold up the screen), skips
+        # ones that wouldn't change its state (except the "Off" at the end),
+        # and logs how long each one
+        # took in the session's timing file. See hopper_driver.py.
+        if self.Hopper is not None:
+            self.hopper_driver = HopperDriver(self.Hopper,
+                                              self.clock,
+                                              threaded = threaded_logging)
+        else:
+            self.hopper_driver = None
         self.start_time = None # This will be reset once the session actually starts
-        self.trial_start = None # Duration into each trial as a second count, resets each trial
-        self.session_duration = datetime.now() + timedelta(minutes = 90) # Max session time is 90 min
+        self.trial_onset_ns = None # When the keys came (or are due to come) on this trial, resets each trial
+        # When the session ends: whichever of these caps is reached first
+        # (None for no cap). They are set in the protocol file, and picked
+        # up when the session starts (see first_ITI()).
+        self.session_duration = None # Max session time (ms; 90 min by default)
+        self.max_trials = None # Max number of trials (one pass through the sub-sessions by default)
+        self.max_reinforcers = None # Max number of reinforcers
         
         # Hopper and ITI duration per bird refereneced a settings sheet
         # self.ITI_duration = 10 * 1000 # duration of inter-trial interval (ms)
@@ -275,21 +493,36 @@ class MainScreen(object):
         
         self.current_trial_counter = 0 # counter for current trial in session
         self.reinforcers_provided = 0 # number of trials where a reinforcer was provided
+        self.trial_stage = 0 # Stage of the current trial (see the protocol file)
+        self.state = "waiting" # What the session is doing (see go_to())
+        self.shown_keys = {} # key_string -> role of the keys currently shown
         # Max number of trials within a session differ by phase and was set 
         # later in the first-ITI function
         
-        # Here are variables for data structuring 
-        self.session_data_frame = [] #This where trial-by-trial data is stored
-        header_list = ["SessionTime", "Xcord","Ycord", "LocationEvent",
-                       "LeftKey", "RightKey", "TrialType", "ChoiceKeysActive",
-                       "TrialTime", "TrialNum", "ReinforcersProvided",
-                       "ITIDuration", "Subject", "Condition",
-                       "TrainingPhase", "Date"] # Column headers
-        
-        self.session_data_frame.append(header_list) # First row of matrix is the column headers
+        # Here are variables for data structuring. Trial-by-trial data is
+        # stored in an EventStore (compact typed columns, with the subject,
+        # group, etc. kept once in its header) that is built once the session
+        # starts and its settings are known. The column headers of the data
+        # file (CSV_HEADER) are set in event_store.py.
+        self.session_data_frame = None # This where trial-by-trial data is stored
         self.date = date.today().strftime("%y-%m-%d") # Today's date
+        self.recorder = None # Streams rows to the data file once the session starts
+        self.coalescer = None # Summarizes blank-screen pecks (if coalesce_pecks is set)
+        self.checkpoint = None # Last checkpoint saved (see save_checkpoint())
+        # Running choice statistics (optimal proportion, choice latency,
+        # second reinforcers), updated with every event; see online_stats.py
+        self.stats = SessionStats(choice_trial_types = self.protocol.choice_trial_types())
+        self.event_logger = None # Formats/writes event rows off the UI thread
+        # Live status of the session, kept up to date as it runs and served
+        # over HTTP once it starts (if telemetry_port is set)
+        self.telemetry = SessionTelemetry(self.subject_ID,
+                                          self.training_phase,
+                                          self.session_duration,
+                                          time_source = self.clock.now_ns)
+        self.telemetry_server = None
 
-        ## Finally, start the recursive loop that runs the program:
+        ## Finally, start the program (it is driven by the session clock from
+        # here on; see go_to()):
         self.place_birds_in_box()
 
     def place_birds_in_box(self):
@@ -303,125 +536,200 @@ class MainScreen(object):
             # objects off the mainscreen (making it blank), unbinds the spacebar to 
             # the first_ITI link, followed by a 30s pause before the first trial to 
             # let birds settle in and acclimate.
-            self.mastercanvas.delete("all")
+            self.stimuli.hide_all()
             self.root.unbind("<space>")
-            self.start_time = datetime.now() # Set start time
+            if self.resume is None:
+                self.start_time = datetime.now() # Set start time (for the file name)
+                self.clock.start() # ...and time zero of the session clock
+            else: # A resumed session keeps its start time and session clock
+                self.start_time = self.resume.start_time
+                self.clock.start(self.resume.elapsed_ns)
+            if self.profiler is not None:
+                self.profiler.start(self.clock)
             
-            # Then we can read the settings .csv to set up subject-specific 
-            # parameters for this session.
-            if operant_box_version:
-                settings_csv_directory = str(os_path.expanduser('~')+"/OneDrive/Desktop/P038/P038_Settings-Assignments.csv")
-            else:
-                settings_csv_directory = "P038_Settings-Assignments.csv"
+            # Then we can set up the subject-specific parameters for this
+            # session (already loaded and checked; see __init__).
+            print(self.settings)
+            self.hopper_duration = self.settings.hopper_duration
+            self.ITI_duration = self.settings.ITI_duration
+            self.experimental_group = self.settings.group
+            if self.resume is not None: # Stay in the group the session started in
+                self.experimental_group = self.resume.experimental_group
+            self.optimal_color = self.settings.optimal_color
+            self.suboptimal_color = self.settings.suboptimal_color
+            self.role_colors = {"optimal": self.optimal_color,
+                                "suboptimal": self.suboptimal_color}
             
-            # Next, check if the csv file exists.
-            settings_list = []
-            if os_path.isfile(settings_csv_directory):
-                # Read the content of the csv as a dictionary
-                with open(settings_csv_directory, 'r', encoding='utf-8-sig') as data:
-                    for line in DictReader(data):
-                        settings_list.append(line)
-            else:
-                print("Error: cannot find settings csv file!")
-                input()
-            # After we have a list off the settings for all subjects converted 
-            # into a Python-friendly data form (list of dictionaries), we can 
-            # narrow it down to a single subject-specific dictionary
-            settings_dict = "NA"
-            try:
-                for entry in settings_list:
-                    if entry["Subject"] == self.subject_ID:
-                        settings_dict = entry
-            except KeyError:
-                print("Error reading settings .csv.\n Make sure it is in comma-dilimeted form.")
-                    
-            # And we can then update subject-specific settings...
-            print(settings_dict)
-            try:
-                self.hopper_duration = int(settings_dict["Hopper Duration (ms)"])
-                self.ITI_duration = int(settings_dict["ITI Duration (ms)"])
-                self.experimental_group = settings_dict["Group"]
-                self.optimal_color = settings_dict["Optimal Color"]
-                self.suboptimal_color = settings_dict["Suboptimal Color"]
-            except TypeError:
-                print("Error: Unable to import Settings Sheet for {self.subject_ID}")
+            # Now that the start time (and therefore the file name) is known,
+            # open the data file. Rows are appended to it as they happen.
+            # (When resuming, the data file is trimmed back to the end of
+            # the last completed trial and appended to instead.)
+            if self.resume is not None:
+                self.data_file_path = self.resume.data_file
+                dropped = truncate_data_file(self.data_file_path, self.resume.rows_written)
+                print(f"Resuming {self.resume} ({dropped} row(s) of the unfinished trial dropped)")
+                self.recorder = SessionRecorder(self.data_file_path,
+                                                flush_policy = data_flush_policy,
+                                                fsync = data_fsync,
+                                                mode = "a")
+                self.recorder.rows_written = self.resume.rows_written
+                if self.resume.summary_rows_written is not None and \
+                        os_path.isfile(summary_path_for(self.data_file_path)):
+                    truncate_data_file(summary_path_for(self.data_file_path),
+                                       self.resume.summary_rows_written)
+            elif self.record_data:
+                self.data_file_path = f"{self.data_folder_directory}/{self.subject_ID}/{self.subject_ID}_{self.start_time.strftime('%Y-%m-%d_%H.%M.%S')}_P037_data-Phase{self.training_phase}.csv" # location of written .csv
+                self.recorder = SessionRecorder(self.data_file_path,
+                                                header = CSV_HEADER,
+                                                flush_policy = data_flush_policy,
+                                                fsync = data_fsync)
+            # Then build the event store and start the background event
+            # logger, which stores each event, prints it, and hands its row to
+            # the recorder off the UI thread.
+            self.session_data_frame = EventStore(self.subject_ID,
+                                                 self.experimental_group,
+                                                 self.training_phase,
+                                                 self.ITI_duration,
+                                                 start_time = self.start_time)
+            # For long sessions, the store only keeps the latest events in
+            # memory; the rest go to a scratch file (see event_spool_size at
+            # the top). The onset log is written as the session goes, too
+            # (added to, if the session is being resumed).
+            if self.recorder is not None and event_spool_size:
+                self.session_data_frame.start_spool(binary_path_for(self.data_file_path) + SPOOL_EXTENSION,
+                                                    event_spool_size)
+                self.clock.open_onsets(self.data_file_path[:-4] + "_timing.csv",
+                                       append = self.resume is not None)
+            if self.resume is not None: # Events from before the session was cut short
+                # (with any coalesced pecks expanded back into rows)
+                resumed_rows = read_session_rows(self.data_file_path)
+                self.session_data_frame.append_rows(resumed_rows)
+            # Pecks to the blank screen may be summarized rather than written
+            # in full (see coalesce_pecks at the top)
+            if self.recorder is not None and coalesce_pecks:
+                summary_path = summary_path_for(self.data_file_path)
+                resuming = self.resume is not None and os_path.isfile(summary_path)
+                self.coalescer = PeckCoalescer(summary_path,
+                                               coalesce_pecks,
+                                               flush_policy = data_flush_policy,
+                                               fsync = data_fsync,
+                                               mode = "a" if resuming else "w",
+                                               echo = self.echo)
+                if resuming:
+                    self.coalescer.recorder.rows_written = self.resume.summary_rows_written or 0
+            self.event_logger = EventLogger(self.clock.start_ns,
+                                            self.session_data_frame,
+                                            recorder = self.recorder,
+                                            echo = self.echo,
+                                            threaded = self.threaded_logging,
+                                            coalescer = self.coalescer)
                              
             # Next, we can set up the order of each trial within the session.
             # The total number of trials per session differs based on whether
             # the session is a pre-training (100% reinforced) or training 
-            # (variably reinforced) session type.
-            
-            if self.training_phase == 0: # pre-training
-                self.trials_per_session = 60 # 4 trial types * 15 iterations each
-                self.trials_per_subsession = 60 # Only one subsession
-                trial_option_list = [
-                    "LO_trial", # left optimal
-                    "RO_trial", # right optimal
-                    "LS_trial", # left suboptimal
-                    "RS_trial", # right suboptimal
-                    ] * 15
-                
-            elif self.training_phase == 1: # rejection training
-                self.trials_per_session = 80 
-                self.trials_per_subsession = 40 # Two sub-sessions of 40 trials each
-                # Two types of sessions (one for each group)
-                if self.experimental_group == "Choice":
-                    trial_option_list = ["LO_choice_trial",
-                                         "RO_choice_trial"] * (self.trials_per_subsession//2)
-                
-                elif self.experimental_group == "Forced":
-                    trial_option_list = [
-                        "LO_choice_trial", # 12 total choice trials
-                        "RO_choice_trial"]  * 6 + [
-                            "LO_trial", # left optimal
-                            "RO_trial", # right optimal
-                            "LS_trial", # left suboptimal
-                            "RS_trial", # right suboptimal
-                            ] * 7
+            # (variably reinforced) session type: pre-training is a single
+            # block of 60 trials (4 trial types * 15 iterations each), while
+            # training is two sub-sessions of 40 trials each. The trials that
+            # make up each phase/group are set in the protocol file.
+            plan = self.phase_tables.session_plan(self.experimental_group)
+            self.session_plan = plan
+            self.trials_per_session = plan.trials_per_session
+            self.trials_per_subsession = plan.trials_per_subsession
+            self.rest_between_subsessions = plan.rest_between_blocks
+            self.stats.trials_per_subsession = self.trials_per_subsession
+            if self.resume is not None: # Catch up on the trials already done
+                self.stats.add_rows(resumed_rows)
+                del resumed_rows
+            # The session ends at whichever of its caps (trials, time, or
+            # reinforcers) comes first. A trial cap above one pass through
+            # the sub-sessions (e.g., for a closed-economy session of
+            # thousands of trials) just goes through them again.
+            caps = self.phase_tables.session_caps(self.experimental_group)
+            self.max_trials = caps.trials
+            self.session_duration = None if caps.minutes is None else caps.minutes * 60 * 1000
+            self.max_reinforcers = caps.reinforcers
                             
             # Once we have the number of trials per session (and what type of
-            # trials they will be), we can semi-randomly determine the order.
+            # trials they will be), we can semi-randomly determine the order
+            # of the first pass through the sub-sessions (see ITI() for the
+            # ones after it).
             # The key here will be that we're avoiding repeats of four or more
-            # of the same trial type. We do this by shuffling the order of the 
-            # trial option list until we get one that doesn't have any trials
-            # that are repeated more than three times. Note that we ONLY do 
-            # this for the Forced experimental  group, as the choice group has
-            # uniformly  identical trials.
-            self.trial_order_list = []
+            # of the same trial type, including across the two sub-sessions.
+            # The order is built one trial at a time so that it meets that
+            # constraint by construction (rather than reshuffling until it
+            # does), and it is seeded so that it can be rebuilt later. Note
+            # that we ONLY do this for pre-training and the Forced
+            # experimental group, as the choice group has uniformly identical
+            # trials. If the order for this subject/phase/date was already
+            # precomputed (and checked) offline, that one is used instead;
+            # see schedule_library.py. The library sits next to the settings
+            # sheet.
+            schedule_library = ScheduleLibrary(os_path.join(os_path.dirname(self.settings_csv_directory),
+                                                            "schedule_library"))
+            if self.resume is not None: # Carry on with the same order
+                schedule = None
+            else:
+                schedule = schedule_library.get(self.subject_ID, self.training_phase, date.today())
+            self.trial_order_offset = 0 # Trials in the passes before the one in trial_order_list
+            if self.resume is not None:
+                self.trial_order_seed = self.resume.trial_order_seed
+                self.trial_order_list = self.resume.trial_order_list
+                self.trial_order_offset = self.resume.trial_order_offset
+            elif schedule is not None and schedule["group"] == self.experimental_group:
+                self.trial_order_seed = schedule["seed"]
+                self.trial_order_list = schedule["trials"]
+                print("Trial order loaded from the schedule library")
+            else:
+                self.trial_order_seed = new_seed()
+                self.trial_order_list = generate_sequence(plan.blocks,
+                                                          max_run = plan.max_run,
+                                                          seed = self.trial_order_seed)
+            self.session_data_frame.metadata["trial_order_seed"] = self.trial_order_seed
+            print(f"Trial order seed: {self.trial_order_seed}")
             
-            while len(self.trial_order_list) != self.trials_per_session:
-                shuffle(trial_option_list) # shuffle
-                approved = True
-                if self.training_phase == 0 or self.experimental_group == "Forced":
-                    c = 0  # counter
-                    # Cycle through the shuffled list...
-                    while c < len(trial_option_list) and approved:
-                        if c > 3:
-                            a = trial_option_list[c]
-                            if a == trial_option_list[c-1] and a == trial_option_list[c-2] and a == trial_option_list[c-3]:
-                                approved = False
-                        c += 1
-                if approved:
-                    for i in trial_option_list:
-                        self.trial_order_list.append(i)
+            # Start publishing the session's live status
+            self.telemetry.start(self.clock.start_ns,
+                                 self.experimental_group,
+                                 self.max_trials,
+                                 self.trials_per_subsession,
+                                 session_duration_ms = self.session_duration)
+            if telemetry_port is not None:
+                try:
+                    self.telemetry_server = TelemetryServer(self.telemetry,
+                                                            telemetry_host,
+                                                            telemetry_port)
+                    print(f"Live telemetry at {self.telemetry_server.url}")
+                except OSError as e: # e.g., the port is already taken
+                    print(f"WARNING: live telemetry not started ({e})")
+                self.telemetry.start_heartbeat(self.clock)
+  
+            # If resuming, pick the counters back up from the last completed
+            # trial (the next ITI then starts the trial after it), and mark
+            # the gap in the data.
+            first_ITI_anchor = self.clock.start_ns
+            if self.resume is not None:
+                self.current_trial_counter = self.resume.trials_completed
+                self.reinforcers_provided = self.resume.reinforcers
+                self.trial_type = self.trial_order_list[max(0, self.current_trial_counter - 1 - self.trial_order_offset)]
+                self.left_key = self.right_key = "NA"
+                self.trial_onset_ns = self.clock.now_ns()
+                self.write_data(None, "SessionResumed")
+                first_ITI_anchor = self.clock.now_ns()
   
-            # This is run until we reach the max number of trials per session
-            # (so once for the pre-training phase and twice for the training
-            # phase). We have the type of every sequential trial within the
+            # We have the type of every sequential trial within the
             # session and we can get started! Let's set set up a timer and
             # move on to the ITI to start the first trial.
             if self.subject_ID == "TEST": # If test, don't worry about first ITI delay
-                self.root.after(1, lambda: self.ITI())
+                self.go_to("ITI", first_ITI_anchor, 1)
             else: # Else, give 30 s for the first ITI to occur after the session begins
-                self.root.after(30000, lambda: self.ITI())
+                self.go_to("ITI", first_ITI_anchor, 30000)
 
         # This is outside of the "first_ITI()" function, but calls it with a 
         # space bar press
         self.root.bind("<space>", first_ITI) # bind cursor state to "space" key
-        self.mastercanvas.create_text(350,300,
-                                      fill="white",
-                                      font="Times 20 italic bold",
-                                      text=f"P037 \n Place bird in box, then press space \n Subject: {self.subject_ID} \n Training Phase {self.training_phase_name_list[self.training_phase]}")
+        self.stimuli.show_text(350,300,
+                               fill="white",
+                               text=f"P037 \n Place bird in box, then press space \n Subject: {self.subject_ID} \n Training Phase {self.training_phase_name_list[self.training_phase]}")
 
     def ITI (self):
         # Every trial (including the first) "starts" with an ITI. The ITI function
@@ -431,33 +739,25 @@ class MainScreen(object):
         #   3) Increases the trial counter by one
         #   4) Moves on to the next trial after a delay (ITI)
         
-        # This function just clear the screen. It will be used a lot in the future, too.
-        self.clear_canvas()
-
-        # Make sure pecks during ITI are saved...
-        self.mastercanvas.create_rectangle(0,0,
-                                           self.mainscreen_width,
-                                           self.mainscreen_height,
-                                           fill = self.ITI_color,
-                                           outline = self.ITI_color,
-                                           tag = "bkgrd")
-        self.mastercanvas.tag_bind("bkgrd",
-                                   "<Button-1>",
-                                   lambda event, 
-                                   event_type = "ITI_peck": 
-                                       self.write_data(event, event_type))
+        # First, hide the keys and any text and switch the background to
+        # the ITI color. Make sure pecks during ITI are saved...
+        self.stimuli.hide_keys()
+        self.stimuli.hide_text()
+        self.stimuli.show_background(self.ITI_color, "ITI_peck")
         
         # First, check to see if any session limits have been reached (e.g.,
         # if the max time or reinforcers earned limits are reached).
-        if self.current_trial_counter  == self.trials_per_session:
+        if self.max_trials is not None and self.current_trial_counter >= self.max_trials:
             print("&&& Trial max reached &&&")
             self.exit_program("event")
             
-# =============================================================================
-#         elif datetime.now() >= (self.session_duration):
-#             print("Time max reached")
-#             self.exit_program("event")
-# =============================================================================
+        elif self.session_duration is not None and self.clock.elapsed_ms() >= self.session_duration:
+            print("&&& Time max reached &&&")
+            self.exit_program("event")
+            
+        elif self.max_reinforcers is not None and self.reinforcers_provided >= self.max_reinforcers:
+            print("&&& Reinforcer max reached &&&")
+            self.exit_program("event")
         
         # Else, after a timer move on to the next trial. Note that,
         # although the after() function is given here, the rest of the code 
@@ -465,67 +765,121 @@ class MainScreen(object):
         else: 
             # Print text on screen if a test (should be black if an experimental trial)
             if not operant_box_version or self.subject_ID == "TEST":
-                self.mastercanvas.create_text(400,300,
-                                              fill="purple2",
-                                              font="Times 20 italic bold",
-                                              text=f"ITI ({int(self.ITI_duration/1000)} sec.)")
+                self.stimuli.show_text(400,300,
+                                       fill="purple2",
+                                       text=f"ITI ({int(self.ITI_duration/1000)} sec.)\n\n{self.stats.text()}")
                 
             # This calls the Hopper function to turn it off, and resets other
             # variables. The hopper should be turned off in the previous function,
             # but this is an additional safeguard just to be safe.
-            if operant_box_version:
-                self.Hopper.change_hopper_state("Off")
+            self.set_hopper_state("Off")
                 
             # Reset other variables for the following trial.
-            self.trial_start = time() # Set trial start time (note that it includes the ITI, which is subtracted later)
-            self.optimal_choice = False # Reset the choice tracker
+            self.trial_stage = 0 # Every trial starts at its first stage
             self.left_key = "NA" # reset state of left key
             self.right_key = "NA" # and right
             
-            # Update data .csv file with previous trial's data
+            # Update data .csv file with previous trial's data (and, in a
+            # long session, move older events and onsets out of memory)
             self.write_comp_data(False)
+            if event_spool_size:
+                self.clock.roll_onsets(event_spool_size)
+            # ...and save a checkpoint to resume from, should the session be
+            # cut short during the following trial
+            self.save_checkpoint()
+            # ...and print how the bird is doing so far
+            if self.current_trial_counter > 0:
+                self.event_logger.console(f"\n{self.stats.text()}")
                 
-            # Next up, set the string that tracks the trial type
-            self.trial_type = self.trial_order_list[self.current_trial_counter]
+            # Next up, set the string that tracks the trial type, and look up
+            # its rows of the protocol's tables: the keys shown at each of
+            # its stages, and what a peck to each of them does. Once a pass
+            # through the sub-sessions is done, the order of the next pass
+            # is built (only the current pass is kept).
+            if self.current_trial_counter - self.trial_order_offset == len(self.trial_order_list):
+                self.next_trial_order()
+            self.trial_type = self.trial_order_list[self.current_trial_counter - self.trial_order_offset]
+            trial_type_index = self.protocol.trial_index[self.trial_type]
+            self.key_layouts = self.phase_tables.layouts[trial_type_index]
+            self.peck_outcomes = self.phase_tables.outcomes[trial_type_index]
 
             # Increment trial counter by one
             self.current_trial_counter += 1
             
-            # If halfway through a training session, set up a 15 minute ITI
-            # before the following trial. The screen should be black, here
-            if self.training_phase == 1 and self.current_trial_counter ==  (self.trials_per_session//2 + 1):
+            # Log the ITI onset. The ITI is timed from when it was meant to
+            # start (e.g., the intended end of the last hopper cycle), rather
+            # than from whenever this callback got to run.
+            ITI_onset = self.clock.mark("ITI_onset", self.current_trial_counter)
+            self.set_state("ITI", self.current_trial_counter)
+            
+            # If between the sub-sessions of a training session, set up a 15
+            # minute ITI before the following trial. The screen should be
+            # black, here
+            if self.rest_between_subsessions and self.current_trial_counter > 1 and \
+                    (self.current_trial_counter - 1) % self.trials_per_subsession == 0:
                 # Make sure pecks during ITI are saved...
-                self.mastercanvas.create_rectangle(0,0,
-                                                   self.mainscreen_width,
-                                                   self.mainscreen_height,
-                                                   fill = "black",
-                                                   outline = "black",
-                                                   tag = "bkgrd")
-                self.mastercanvas.tag_bind("bkgrd",
-                                           "<Button-1>",
-                                           lambda event, 
-                                           event_type = "between-session_ITI_peck": 
-                                               self.write_data(event, event_type))
+                self.stimuli.show_background("black", "between-session_ITI_peck")
+                self.set_state("between-session_ITI")
                 # Onscreen feedback for testing...
                 if not operant_box_version or self.subject_ID == "TEST":
-                    self.mastercanvas.create_text(400,300,
-                                                  fill="white",
-                                                  font="Times 20 italic bold",
-                                                  text=f"ITI ({int(self.between_session_ITI_duration/1000)} sec.)")
+                    self.stimuli.show_text(400,300,
+                                           fill="white",
+                                           text=f"ITI ({int(self.between_session_ITI_duration/1000)} sec.)\n\n{self.stats.text()}")
                 # Then set a 15 m timer before continuing to the following trial
-                self.root.after(self.between_session_ITI_duration,
-                                lambda: self.build_keys())
+                self.go_to("keys", ITI_onset, self.between_session_ITI_duration)
+                self.trial_onset_ns = ITI_onset + self.between_session_ITI_duration * 1000000
                 
                 
             # If a regular ITI, set a shorter delay timer to proceed to the
             # next trial
             else:
-                self.root.after(self.ITI_duration,
-                                lambda: self.build_keys())
+                self.go_to("keys", ITI_onset, self.ITI_duration)
+                self.trial_onset_ns = ITI_onset + self.ITI_duration * 1000000
             
             # Finally, print terminal feedback "headers" for each event within the next trial
-            print(f"\n{'*'*35} Trial {self.current_trial_counter} begins {'*'*35}") # Terminal feedback...
-            print(f"{'Event Type':>30} | Xcord. Ycord. |  Session Time  | Trial Type")
+            self.event_logger.console(f"\n{'*'*35} Trial {self.current_trial_counter} begins {'*'*35}") # Terminal feedback...
+            self.event_logger.console(f"{'Event Type':>30} | Xcord. Ycord. |  Session Time  | Trial Type")
+
+    def next_trial_order(self):
+        # Builds the trial order of the next pass through the sub-sessions,
+        # carrying on from the last one (so the run-length limit holds
+        # across passes, too, if it can). Each pass has its own seed, worked
+        # out from the session's, so the whole order can be rebuilt.
+        self.trial_order_offset += len(self.trial_order_list)
+        pass_number = self.trial_order_offset // self.trials_per_session
+        seed = pass_seed(self.trial_order_seed, pass_number)
+        try:
+            order = generate_sequence(self.session_plan.blocks,
+                                      max_run = self.session_plan.max_run,
+                                      seed = seed,
+                                      previous = self.trial_order_list)
+        except ValueError: # The last pass ended in a run this one can't follow
+            order = generate_sequence(self.session_plan.blocks,
+                                      max_run = self.session_plan.max_run,
+                                      seed = seed)
+        self.trial_order_list = order
+
+    # The session runs as a state machine: waiting, ITI (or
+    # between-session_ITI), keys, hopper, and ended. The ITI and keys states
+    # are started by their methods below (see STATE_METHODS), which never
+    # call one another: each asks the session clock to start the next state
+    # (go_to()) and returns. So the call stack stays the same depth however
+    # many trials a session runs. (The hopper state starts right away, from
+    # the peck that earned it, and the ended state from whatever ends it.)
+    STATE_METHODS = {"ITI": "ITI",
+                     "keys": "build_keys"}
+
+    def go_to(self, state, anchor_ns, delay_ms, label=None, trial=None):
+        # Starts a state delay_ms after anchor_ns (see SessionClock.after()).
+        # Its method is looked up now, so whatever is on the instance by
+        # then (e.g., a timed version when profiling) is what runs.
+        method = getattr(self, self.STATE_METHODS[state])
+        return self.clock.after(anchor_ns, delay_ms, method, label = label, trial = trial)
+
+    def set_state(self, state, trial=None, reinforcers=None):
+        # Keeps track of the state the session is in (and publishes it)
+        self.state = state
+        self.telemetry.set_state(state, trial, reinforcers = reinforcers)
         
     """
     Each trial is an iteration of the build_keys() funtion below. Because we
@@ -548,108 +902,48 @@ class MainScreen(object):
         # during specific times. However, pecks to keys will be differentiated
         # regardless of activity.
         
-        # First, build the background. This basically builds a button the size of 
-        # screen to track any pecks; buttons built on top of this button will
+        # First, set up the background. This is basically a button the size of 
+        # screen to track any pecks; buttons on top of this button will
         # NOT count as background pecks but as "key" pecks, because the object is
         # covering that part of the background. Once a peck is made, an event line
         # is appended to the data matrix and eventually written to the data
-        # file.
-        self.clear_canvas() # Remove everything from the screen...
+        # file. (All of these objects were built once, when the session
+        # started; here they are just shown, hidden, or recolored.)
         
         # This calls the Hopper function to turn it off.
-        if operant_box_version:
-            self.Hopper.change_hopper_state("Off")
+        self.set_hopper_state("Off")
                 
-        self.mastercanvas.create_rectangle(0,0, # Top left
-                                           self.mainscreen_width,
-                                           self.mainscreen_height, # to bottom right
-                                           fill = "black",
-                                           outline = "black",
-                                           tag = "bkgrd")
-        self.mastercanvas.tag_bind("bkgrd",
-                                   "<Button-1>",
-                                   lambda event, 
-                                   event_type = "background_peck": 
-                                       self.write_data(event, event_type))
-
-        # Coordinate dictionary for the shapes around a key. The keys are 
-        # given in [x1, y1, x2, y2] coordinates
-        self.key_coord_dict = {"left_choice_key": ["color", 200, 250, 300, 350],
-                               "right_choice_key": ["color", 500, 250, 600, 350]}
-        
-        # Now we need to select the keys to build for this specific trial by
-        # removing the others the dictionary above. First, we need to check 
-        # whether this is the second half of an optimal choice trial. If so,
-        # we need to remove the optimal choice such that only the suboptimal 
-        # option is left available.
-        if self.optimal_choice:
-            if "L" in self.trial_type: # If left key...
-                del self.key_coord_dict ["left_choice_key"]
-            else:
-                del self.key_coord_dict ["right_choice_key"]
-                
-        # Then do the opposite for non-choice trials
-        elif "choice" not in self.trial_type: 
-            if "L" in self.trial_type: # If left key...
-                del self.key_coord_dict["right_choice_key"]
-            else:
-                del self.key_coord_dict ["left_choice_key"]
-        
-        # After we determine which keys to build, we can assign them a color (and
-        # thereby differentiate their sub/optimal properties)
-        for key in self.key_coord_dict:
-            if key ==  "left_choice_key":
-                if "LO" in self.trial_type:
-                    self.left_key = "optimal"
-                    self.key_coord_dict [key][0] = self.optimal_color
-                elif "LS" in self.trial_type or ("RO" in self.trial_type and self.optimal_choice) or ("RO_choice" in self.trial_type):
-                    self.left_key = "suboptimal"
-                    self.key_coord_dict [key][0] = self.suboptimal_color
-            elif key ==  "right_choice_key":
-                if "RO" in self.trial_type:
-                    self.right_key = "optimal"
-                    self.key_coord_dict [key][0] = self.optimal_color
-                elif "RS" in self.trial_type or ("LO" in self.trial_type and self.optimal_choice) or ("LO_choice" in self.trial_type):
-                    self.right_key = "suboptimal"
-                    self.key_coord_dict [key][0] = self.suboptimal_color
-                    
+        self.stimuli.hide_text() # Remove any text from the screen...
+        self.stimuli.show_background("black", "background_peck")
+        self.set_state("keys")
+
+        # Now we need to select the keys to build for this specific trial,
+        # and their roles (and thereby colors, which differentiate their
+        # sub/optimal properties). Both come straight from the protocol's
+        # layout for this stage of the trial: e.g., on a choice trial both
+        # keys are shown at first, but after an optimal choice only the
+        # suboptimal option is left available. A key that isn't shown keeps
+        # the role it had earlier in the trial (for the data file).
+        roles = self.key_layouts[self.trial_stage]
+        if roles[self.left_key_index] is not None:
+            self.left_key = roles[self.left_key_index]
+        if roles[self.right_key_index] is not None:
+            self.right_key = roles[self.right_key_index]
+        self.shown_keys = {key_string: role for key_string, role in
+                           zip(self.protocol.keys, roles) if role is not None}
                     
-        # Now that we have all the coordinates and colors linked to each
-        # specific key, we can use a for loop to build each one (or, in some
-        # cases, only a single key).
-        for key_string in self.key_coord_dict :
-            # First up, build the actual circle that is around the key and will
-            # contain the stimulus. Order is important here, as shapes built
-            # on top of each other will overlap/cover each other. We 
-            # have to build a little "active" space behind the key, first.
-            self.mastercanvas.create_oval(
-                self.key_coord_dict[key_string][1] - 25,
-                self.key_coord_dict[key_string][2] - 25,
-                self.key_coord_dict[key_string][3] + 25,
-                self.key_coord_dict[key_string][4] + 25,
-                fill = "", # No fill/color
-                outline = "",
-                tag = key_string # This tag allows us to bind a function to all related keys
-                )
-
-            # Then build the literal key...
-            self.mastercanvas.create_oval(
-                *self.key_coord_dict [key_string][1:], # coordinates
-                fill = self.key_coord_dict[key_string][0], # color
-                outline = "",
-                tag = key_string)
-                
-            # And lastly tie a function to a key peck. The function is
-            # key_press() for all the keys, but will be passed a different
-            # "key_string" argument.
-            self.mastercanvas.tag_bind(
-                key_string,
-                "<Button-1>",
-                lambda event,
-                    key_string = key_string:
-                        self.key_press(event,
-                                       key_string)
-                        )
+        # Now that we have the colors linked to each specific key, we can
+        # show each one (or, in some cases, only a single key) in its color.
+        # Pecks to each key are already tied to the key_press() function,
+        # which is passed a different "key_string" argument for each key.
+        self.stimuli.show_keys({key_string: self.role_colors[role]
+                                for key_string, role in self.shown_keys.items()})
+        
+        # Log when the keys came on. The first time they come on in a trial
+        # is when that trial's TrialTime starts counting from.
+        self.clock.mark("key_onset", self.current_trial_counter)
+        if self.trial_stage == 0:
+            self.trial_onset_ns = self.clock.now_ns()
     
     def key_press(self, event, keytag):
         # This function is called every time a key press is called, regardless
@@ -660,72 +954,62 @@ class MainScreen(object):
         # a data point will be recorded, but nothing will functionally change
         # within the trial.
         
-        # We need two different processes for the two different phases.
-        # For pretraining, we give food no matter what
-        if self.training_phase == 0:
-            # Write data for the peck
-            self.write_data(event, (f"{keytag}_peck"))
-            self.provide_food()
-                
-        # For the training task, it's a bit more complicated...
-        elif self.training_phase == 1:
-            # We have to contruct a matrix of coordinates that need to be 
-            # covered after a choice is made. If optimal trial type and choice:
-            if ("LO" in self.trial_type and "left" in keytag) or ("RO" in self.trial_type and "right" in keytag):
-                # Write data for the peck
-                self.write_data(event, "optimal_peck")
-                self.optimal_choice = True
-            # Else if a suboptimal choice...
-            else:
-                # Write data for the peck
-                self.write_data(event, "suboptimal_peck")
-                self.optimal_choice = False
-
-            # Then provide food if the hopper isn't already activated
-            self.provide_food()
+        # What a peck does depends on the phase and on the key's role at
+        # this stage of the trial, and was worked out from the protocol
+        # when the session started (see protocol.py). E.g., in pre-training
+        # we give food no matter what, while in training an optimal choice
+        # is reinforced and leaves the suboptimal key up for a second
+        # reinforcer, and a suboptimal choice is reinforced and ends the
+        # trial.
+        outcome = self.peck_outcomes[self.trial_stage][self.protocol.key_index[keytag]]
+        if outcome is None: # Not a key of this trial (it shouldn't be shown)
+            self.write_data(event, f"{keytag}_peck")
+            return
+        # Write data for the peck
+        self.write_data(event, outcome.event)
+        continue_trial = outcome.next_stage is not None
+        if continue_trial:
+            self.trial_stage = outcome.next_stage
+        # Then provide food (if reinforced), or move straight on
+        if outcome.reinforce:
+            self.provide_food(continue_trial)
+        else:
+            self.go_to("keys" if continue_trial else "ITI", self.clock.anchor(), 0)
     
-    def provide_food(self):
+    def provide_food(self, continue_trial=False):
         # This function is contingent upon correct and timely choice key
         # response. It opens the hopper and then either leads to ITI after a preset
         # reinforcement interval (i.e., hopper down duration) in the pre-training
         # phase or with suboptimal choice, OR cycles back into the build_keys()
-        # function for the opportunity to earn a second reinforcer.
+        # function for the opportunity to earn a second reinforcer (if the
+        # trial continues to its next stage).
         self.write_data(None, "reinforcer_provided")
         self.reinforcers_provided += 1 # We also need to add one to the reinforcement counter
-        self.clear_canvas()
-        # Make sure pecks during feeding interval are saved...
-        
-        self.mastercanvas.create_rectangle(0,0,
-                                           self.mainscreen_width,
-                                           self.mainscreen_height,
-                                           fill = "black",
-                                           tag = "bkgrd")
-        self.mastercanvas.tag_bind("bkgrd",
-                                   "<Button-1>",
-                                   lambda event, 
-                                   event_type = "hopper_up_peck": 
-                                       self.write_data(event, event_type))
-
+        # Hide the keys. Make sure pecks during feeding interval are saved...
+        self.stimuli.hide_keys()
+        self.stimuli.show_background("black", "hopper_up_peck")
 
-        # Turn on hopper
-        if operant_box_version:
-            self.Hopper.change_hopper_state("On") 
+        # Turn on hopper (and log when it did)
+        self.set_hopper_state("On")
+        self.set_state("hopper", reinforcers = self.reinforcers_provided)
+        hopper_onset = self.clock.mark("hopper_on", self.current_trial_counter)
         
         # If optimal choice, the trial continues
-        if self.optimal_choice:
-            self.root.after(self.hopper_duration,
-                lambda: self.build_keys())
+        if continue_trial:
+            self.go_to("keys", hopper_onset, self.hopper_duration,
+                       label = "hopper_off",
+                       trial = self.current_trial_counter)
         # Otherwise, it concludes
         else:
-            self.root.after(self.hopper_duration,
-                            lambda: self.ITI())
+            self.go_to("ITI", hopper_onset, self.hopper_duration,
+                       label = "hopper_off",
+                       trial = self.current_trial_counter)
         
         # If testing, give onscreen feedback...
         if not operant_box_version or self.subject_ID == "TEST":
-            self.mastercanvas.create_text(400,400,
-                                          fill="white",
-                                          font="Times 20 italic bold", 
-                                          text=f"Food accessible ({int(self.hopper_duration/1000)} s)") # just onscreen feedback
+            self.stimuli.show_text(400,400,
+                                   fill="white",
+                                   text=f"Food accessible ({int(self.hopper_duration/1000)} s)") # just onscreen feedback
 
     # Outside of the main loop functions, there are several additional
     # repeated functions that are called either outside of the loop or 
@@ -744,16 +1028,13 @@ class MainScreen(object):
             self.cursor_visible = True
     
     def clear_canvas(self):
-         # This is by far the most called function across the program. It
-         # deletes all the objects currently on the Canvas. A finer point to 
-         # note here is that objects still exist onscreen if they are covered
-         # up (rendering them invisible and inaccessible); if too many objects
-         # are stacked upon each other, it can may be too difficult to track/
-         # project at once (especially if many of the objects have functions 
-         # tied to them. Therefore, its important to frequently clean up the 
-         # Canvas by literally deleting every element.
+         # This function blanks the screen by hiding every object on the
+         # Canvas. The objects themselves (and their bindings) are built once
+         # per session by the stimulus layer and are only shown/hidden from
+         # then on, so nothing stacks up on the Canvas over the session and
+         # nothing needs to be deleted until the window is destroyed.
         try:
-            self.mastercanvas.delete("all")
+            self.stimuli.hide_all()
         except TclError:
             print("No screen to exit")
         
@@ -772,12 +1053,17 @@ class MainScreen(object):
         #       In the future, if we aren't using the paint object, we'll need 
         #       to 
         def other_exit_funcs():
+            self.clock.cancel_all() # Stop any trial/hopper timers still waiting
+            self.set_hopper_state("Off", force = True)
+            if self.hopper_driver is not None:
+                self.hopper_driver.close() # Wait for the hopper to actually go down
+            self.set_state("ended")
             if operant_box_version:
-                self.Hopper.change_hopper_state("Off")
-                # root.after_cancel(AFTER)
                 if not self.cursor_visible:
                 	self.change_cursor_state() # turn cursor back on, if applicable
             self.write_comp_data(True) # write data for end of session
+            if self.telemetry_server is not None:
+                self.telemetry_server.close()
             self.root.destroy() # destroy Canvas
             print("\n GUI window exited")
             
@@ -785,67 +1071,150 @@ class MainScreen(object):
         other_exit_funcs()
         print("\n You may now exit the terminal and operater windows now.")
         if operant_box_version:
-            polygon_fill.main(self.subject_ID) # call paint object
+            paint_program = hardware.paint_program()
+            if paint_program is not None:
+                paint_program.main(self.subject_ID) # call paint object
         
     
+    def set_hopper_state(self, state, force=False):
+        # Turns the hopper "On" or "Off" (if there is one). A forced command
+        # is sent even if the hopper should already be in that state.
+        if self.hopper_driver is not None:
+            self.hopper_driver.set_state(state, self.current_trial_counter, force = force)
+            self.telemetry.hopper_state = state
+    
     def write_data(self, event, outcome):
-        # This function writes a new data line after EVERY peck. Data is
+        # This function records a new data line after EVERY peck. Data is
         # organized into a matrix (just a list/vector with two dimensions,
-        # similar to a table). This matrix is appended to throughout the 
-        # session, then written to a .csv once at the end of the session.
+        # similar to a table) that is appended to throughout the session and
+        # streamed to the .csv as it goes. Because this is called from inside
+        # the Tkinter callbacks, it only takes a timestamp and snapshots the
+        # trial variables into a compact record; the event logger then
+        # builds the full row (SessionTime, TrialTime, subject, date, etc.),
+        # prints it, and writes it on its own thread.
+        if self.event_logger is None: # Session hasn't started yet
+            return
         if event != None: 
             x, y = event.x, event.y
+            # Where the peck landed (background, halo, or key) and how far
+            # from the nearest key centre, from the stimulus layer's hit map
+            hit_region = getattr(event, "region", 0)
+            hit_distance = getattr(event, "distance", None)
         else: # There are certain data events that are not pecks.
             x, y = "NA", "NA"
-
-        print(f"{outcome:>30} | x: {x: ^3} y: {y:^3} | {str(datetime.now() - self.start_time)} | {self.trial_type}")
-        # print(f"{outcome:>30} | x: {x: ^3} y: {y:^3} | Target: {self.current_target_location: ^2} | {str(datetime.now() - self.start_time)}")
-        self.session_data_frame.append([
-            str(datetime.now() - self.start_time), # SessionTime as datetime object
+            hit_region, hit_distance = 0, None
+        now = self.clock.now_ns()
+        self.telemetry.event(outcome, now)
+        if self.trial_onset_ns is not None:
+            self.stats.event(outcome, self.current_trial_counter, self.trial_type,
+                             round((now - self.trial_onset_ns) / 1e9, 5))
+        self.event_logger.log((
+            now, # Timestamp of the event (session clock)
             x, # X coordinate of a peck
             y, # Y coordinate of a peck
             outcome, # Type of event (e.g., background peck, target presentation, session end, etc.)
             self.left_key,
             self.right_key,
             self.trial_type, # Trial type (e.g., "training", "CBE.1", etc.)
-            round((time() - self.trial_start - (self.ITI_duration/1000)), 5), # Time into this trial minus ITI (if session ends during ITI, will be negative)
+            self.trial_onset_ns, # Key onset of this trial (used to calculate TrialTime)
             self.current_trial_counter, # Trial count within session (1 - max # trials)
             self.reinforcers_provided, # Reinforced trial counter
-            self.ITI_duration, # ITI duration
-            self.subject_ID, # Name of subject (same across datasheet)
-            self.experimental_group, # Either Forced or Choice
-            self.training_phase, # Phase of training as a number (0 - 7)
-            date.today() # Today's date as "MM-DD-YYYY"
-            ])
-        
-        
-        header_list = ["SessionTime", "Xcord","Ycord", "LocationEvent",
-                       "LeftKey", "RightKey", "TrialType",
-                       "TrialTime", "TrialNum", "ReinforcersProvided",
-                       "ITIDuration", "Subject", "Condition",
-                       "TrainingPhase", "Date"] # Column headers
-
-
+            hit_region, # Only kept in the binary event store (not the .csv)
+            hit_distance
+            ))
         
     def write_comp_data(self, SessionEnded):
-        # The following function creates a .csv data document. It is either 
-        # called after each trial during the ITI (SessionEnded ==False) or 
-        # one the session finishes (SessionEnded). If the first time the 
-        # function is called, it will produce a new .csv out of the
-        # session_data_matrix variable, named after the subject, date, and
-        # training phase. Consecutive iterations of the function will simply
-        # write over the existing document.
+        # The following function pushes the session's .csv data document to
+        # disk. It is either called after each trial during the ITI
+        # (SessionEnded == False) or once the session finishes (SessionEnded).
+        # The file itself is opened when the session starts and each event row
+        # is appended to it as it happens (see write_data()), so here we only
+        # need to flush the rows written since the last trial (depending on
+        # the flush policy) or, at the end of the session, close the file.
+        # Both go through the event logger, so any rows still queued are
+        # written before the file is flushed or closed.
+        if self.event_logger is None: # Session hasn't started yet
+            return
+        # At the end of the session, the compact binary copy of the event
+        # store is also saved next to the .csv.
         if SessionEnded:
             self.write_data(None, "SessionEnds") # Writes end of session to df
-        if self.record_data : # If experimenter has choosen to automatically record data in seperate sheet:
-            myFile_loc = f"{self.data_folder_directory}/{self.subject_ID}/{self.subject_ID}_{self.start_time.strftime('%Y-%m-%d_%H.%M.%S')}_P037_data-Phase{self.training_phase}.csv" # location of written .csv
-            # This loop writes the data in the matrix to the .csv              
-            edit_myFile = open(myFile_loc, 'w', newline='')
-            with edit_myFile as myFile:
-                w = writer(myFile, quoting=QUOTE_MINIMAL)
-                w.writerows(self.session_data_frame) # Write all event/trial data 
-            print(f"\n- Data file written to {myFile_loc}")
+            self.event_logger.close() # Drain the queue and close the file
+            bounces = self.stimuli.debouncer.bounces
+            self.session_data_frame.metadata["debounced_pecks"] = bounces
+            if bounces:
+                print(f"\n- {bounces} double-registered peck(s) were ignored")
+            if self.recorder is not None: # If experimenter has choosen to automatically record data in seperate sheet:
+                print(f"\n- Data file written to {self.recorder.file_path}")
+                # The session's choice statistics (kept up to date as it ran)
+                print(self.stats.text())
+                self.stats.write_summary(stats_path_for(self.recorder.file_path))
+                if self.coalescer is not None:
+                    print(f"- {self.coalescer.coalesced} peck(s) summarized in {self.coalescer.file_path}")
+                self.session_data_frame.save(binary_path_for(self.recorder.file_path))
+                self.session_data_frame.close_spool() # (its events are all in the .evt now)
+                # And the intended/actual onset of every timed event
+                self.clock.write_onsets(self.recorder.file_path[:-4] + "_timing.csv")
+                # The session finished, so there's nothing to resume
+                if self.checkpoint is not None:
+                    self.checkpoint.discard()
+                if catalog_sessions:
+                    self.catalog_session()
+            # And, if profiling, how long everything took
+            if self.profiler is not None:
+                if self.recorder is not None:
+                    summary = self.profiler.write_summary(self.recorder.file_path[:-4] + "_profile.json")
+                else:
+                    summary = self.profiler.summary()
+                self.profiler.print_summary(summary)
+                self.profiler.stop()
+        else:
+            self.event_logger.end_trial()
+            self.telemetry.dropped_events = self.event_logger.dropped
+            if self.recorder is not None:
+                self.event_logger.console(f"\n- Data file written to {self.recorder.file_path}")
                 
+    def save_checkpoint(self):
+        # Saves the state needed to resume the session after the trials done
+        # so far. The checkpoint is written by the event logger once every
+        # row logged before now is in the data file, so its row count
+        # matches the file.
+        if not checkpoint_sessions or self.recorder is None:
+            return
+        checkpoint = SessionCheckpoint(self.subject_ID,
+                                       self.training_phase,
+                                       self.experimental_group,
+                                       self.data_file_path,
+                                       self.start_time,
+                                       self.clock.elapsed_ns(),
+                                       self.trial_order_seed,
+                                       self.trial_order_list,
+                                       self.current_trial_counter,
+                                       self.reinforcers_provided,
+                                       trial_order_offset = self.trial_order_offset)
+        recorder = self.recorder
+        coalescer = self.coalescer
+        def write_checkpoint():
+            recorder.flush()
+            checkpoint.rows_written = recorder.rows_written
+            if coalescer is not None:
+                coalescer.recorder.flush()
+                checkpoint.summary_rows_written = coalescer.recorder.rows_written
+            checkpoint.save()
+        self.checkpoint = checkpoint
+        self.event_logger.call(write_checkpoint)
+
+    def catalog_session(self):
+        # Upserts the session's (now closed) data file into the session
+        # catalog. A problem with the catalog shouldn't lose the session, so
+        # any error is only reported.
+        try:
+            with SessionCatalog(default_catalog_path()) as catalog:
+                catalog.ingest_file(self.recorder.file_path, with_events = catalog_events)
+            print("- Session added to the catalog")
+        except Exception as e:
+            print(f"- Could not add the session to the catalog: {e}")
+
 #%% Finally, this is the code that actually runs the program:
 if __name__ == '__main__':
     cp = ExperimenterControlPanel()
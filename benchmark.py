@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for P038 (no display or box hardware needed).
+
+Times the parts of the program that matter for a session running smoothly:
+
+    sequences     -- trial-order generation for each phase and group
+    write_data    -- logging one event from a running session
+    persistence   -- end-of-trial data persistence (write_comp_data) once a
+                     session holds 60, 80, 1,000 and 10,000 trials of data
+    canvas        -- ITI -> keys -> hopper state transitions of the
+                     stimulus layer, drawn by Tk under a virtual framebuffer
+                     (Xvfb) when one is available, or on the headless canvas
+    sessions      -- complete simulated sessions (see simulation.py)
+
+Results are saved as JSON and can be compared against a stored baseline;
+any benchmark whose median got slower than the threshold is reported (and
+the exit code is 1):
+
+    python benchmark.py --out results.json
+    python benchmark.py --baseline baseline.json --threshold 1.25
+    python benchmark.py --quick --only sequences sessions
+"""
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime
+from io import StringIO
+from json import dump, load
+from os import environ, path as os_path
+from platform import platform, python_version
+from shutil import which
+from statistics import median
+from subprocess import Popen, DEVNULL, check_output
+from tempfile import TemporaryDirectory
+from time import perf_counter_ns, sleep
+
+from protocol import load_protocol
+from settings_registry import SettingsRegistry
+from simulation import (SessionSimulator, HeadlessCanvas, RandomPigeon,
+                        simulate_session, SETTINGS_PATH)
+from stimulus_layer import StimulusLayer
+from trial_sequences import session_plan, generate_sequence
+
+SUITES = ("sequences", "write_data", "persistence", "canvas", "sessions")
+PERSISTENCE_TRIALS = (60, 80, 1000, 10000)
+EVENTS_PER_TRIAL = 8
+KEY_COORDINATES = {"left_choice_key": [200, 250, 300, 350],
+                   "right_choice_key": [500, 250, 600, 350]}
+
+
+def stats(durations_ns, per=1):
+    # Summary of a list of timings, in seconds per operation
+    per_op = sorted(d / per / 1e9 for d in durations_ns)
+    return {"runs": len(per_op),
+            "median_s": median(per_op),
+            "mean_s": sum(per_op) / len(per_op),
+            "min_s": per_op[0],
+            "max_s": per_op[-1]}
+
+
+def measure(function, repeat, number=1):
+    # Times `number` calls of function, `repeat` times (after a warm-up call)
+    function()
+    durations = []
+    for _ in range(repeat):
+        start = perf_counter_ns()
+        for _ in range(number):
+            function()
+        durations.append(perf_counter_ns() - start)
+    return stats(durations, number)
+
+
+def bench_sequences(repeat):
+    results = {}
+    protocol = load_protocol()
+    for phase in range(len(protocol.phases)):
+        for group in protocol.group_names():
+            plan = session_plan(phase, group)
+            seeds = iter(range(10 ** 9))
+            results[f"sequences/phase{phase}_{group}"] = measure(
+                lambda: generate_sequence(plan.blocks, max_run = plan.max_run, seed = next(seeds)),
+                repeat, number = 20)
+    return results
+
+
+def _started_screen(data_folder, subject_ID="B5"):
+    # A MainScreen whose session has started (data file open), with the
+    # trial variables of a trial in progress
+    simulator = SessionSimulator(subject_ID, 1, data_folder_directory = data_folder, seed = 1)
+    screen = simulator.screen
+    simulator.root.fire("<space>")
+    screen.trial_type = screen.trial_order_list[0]
+    screen.left_key, screen.right_key = "optimal", "suboptimal"
+    screen.optimal_choice = False
+    screen.trial_onset_ns = screen.clock.now_ns()
+    screen.current_trial_counter = 1
+    return screen
+
+
+class _Peck(object):
+    x, y = 250, 300
+
+
+def bench_write_data(repeat, quick):
+    number = 1000 if quick else 10000
+    with TemporaryDirectory() as data_folder:
+        screen = _started_screen(data_folder)
+        result = measure(lambda: screen.write_data(_Peck, "background_peck"), repeat, number)
+        screen.exit_program(None)
+    result["events_per_s"] = 1 / result["median_s"]
+    return {"write_data/event": result}
+
+
+def bench_persistence(quick):
+    # Times write_comp_data(False) (the end-of-trial push to disk) at every
+    # trial of a session, and reports the cost near each trial count
+    results = {}
+    for n_trials in PERSISTENCE_TRIALS:
+        if quick and n_trials > 1000:
+            continue
+        with TemporaryDirectory() as data_folder:
+            screen = _started_screen(data_folder)
+            durations = []
+            for trial in range(1, n_trials + 1):
+                screen.current_trial_counter = trial
+                for _ in range(EVENTS_PER_TRIAL):
+                    screen.write_data(_Peck, "background_peck")
+                start = perf_counter_ns()
+                screen.write_comp_data(False)
+                durations.append(perf_counter_ns() - start)
+            screen.exit_program(None)
+        # The last 10% of trials show whether the cost grows with the session
+        result = stats(durations[-max(1, n_trials // 10):])
+        result["all_trials_median_s"] = median(durations) / 1e9
+        results[f"persistence/{n_trials}_trials"] = result
+    return results
+
+
+def _virtual_display():
+    # Returns (Tk root, Xvfb process or None), or (None, None) if there is no
+    # display and Xvfb can't be started
+    from tkinter import Tk, TclError
+    process = None
+    if not environ.get("DISPLAY") and which("Xvfb"):
+        process = Popen(["Xvfb", ":87", "-screen", "0", "800x600x24"], stdout=DEVNULL, stderr=DEVNULL)
+        environ["DISPLAY"] = ":87"
+        sleep(1)
+    try:
+        return Tk(), process
+    except TclError:
+        if process is not None:
+            process.terminate()
+        return None, None
+
+
+def bench_canvas(repeat, quick):
+    number = 100 if quick else 1000
+    root, xvfb = _virtual_display()
+    if root is not None:
+        from tkinter import Canvas
+        canvas = Canvas(root, bg="black", height=600, width=800)
+        canvas.pack()
+        backend = "tk"
+        redraw = root.update_idletasks
+    else:
+        canvas = HeadlessCanvas()
+        backend = "headless"
+        redraw = lambda: None
+    stimuli = StimulusLayer(canvas, 800, 600, KEY_COORDINATES,
+                            on_background = lambda event, event_type: None,
+                            on_key = lambda event, key_string: None)
+    def trial_states():
+        stimuli.hide_keys() # ITI
+        stimuli.show_background("Slategray2", "ITI_peck")
+        redraw()
+        stimuli.show_background("black", "background_peck") # Keys
+        stimuli.show_keys({"left_choice_key": "Blue", "right_choice_key": "Yellow"})
+        redraw()
+        stimuli.hide_keys() # Hopper
+        stimuli.show_background("black", "hopper_up_peck")
+        redraw()
+    try:
+        result = measure(trial_states, repeat, number)
+    finally:
+        if root is not None:
+            root.destroy()
+        if xvfb is not None:
+            xvfb.terminate()
+    result["backend"] = backend
+    return {"canvas/trial_transitions": result}
+
+
+def bench_sessions(repeat):
+    results = {}
+    settings = SettingsRegistry(SETTINGS_PATH)
+    for subject_ID, phase in (("B1", 0), ("B1", 1), ("B5", 1)):
+        group = settings.get(subject_ID).group
+        results[f"sessions/phase{phase}_{group}"] = measure(
+            lambda: simulate_session(subject_ID, phase, RandomPigeon(), seed = 1),
+            repeat)
+    return results
+
+
+def run(suites=SUITES, quick=False):
+    repeat = 3 if quick else 7
+    results = {}
+    with redirect_stdout(StringIO()): # The program's terminal feedback
+        if "sequences" in suites:
+            results.update(bench_sequences(repeat))
+        if "write_data" in suites:
+            results.update(bench_write_data(repeat, quick))
+        if "persistence" in suites:
+            results.update(bench_persistence(quick))
+        if "canvas" in suites:
+            results.update(bench_canvas(repeat, quick))
+        if "sessions" in suites:
+            results.update(bench_sessions(repeat))
+    return results
+
+
+def _git_commit():
+    try:
+        return check_output(["git", "rev-parse", "--short", "HEAD"],
+                            cwd = os_path.dirname(os_path.abspath(__file__)),
+                            stderr = DEVNULL, text = True).strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline, threshold):
+    # Returns [(name, baseline median, median, ratio, regressed)]
+    comparison = []
+    for name, result in results.items():
+        if name in baseline:
+            ratio = result["median_s"] / baseline[name]["median_s"]
+            comparison.append((name, baseline[name]["median_s"], result["median_s"],
+                               ratio, ratio > threshold))
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmarks for the P038 program")
+    parser.add_argument("--only", nargs="+", choices=SUITES, default=SUITES)
+    parser.add_argument("--quick", action="store_true", help="fewer runs and smaller sizes")
+    parser.add_argument("--out", default="P038_benchmark.json")
+    parser.add_argument("--baseline", default=None, help="results .json to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio (vs. baseline) counted as a regression")
+    args = parser.parse_args()
+
+    results = run(args.only, args.quick)
+    with open(args.out, 'w', encoding='utf-8') as f:
+        dump({"meta": {"date": datetime.now().isoformat(timespec="seconds"),
+                       "commit": _git_commit(),
+                       "python": python_version(),
+                       "platform": platform(),
+                       "quick": args.quick},
+              "results": results}, f, indent=2)
+
+    print(f"{'Benchmark':>32} | {'Median':>12} | {'Min':>12}")
+    for name, result in results.items():
+        print(f"{name:>32} | {result['median_s'] * 1e3:>9.3f} ms | {result['min_s'] * 1e3:>9.3f} ms")
+    print(f"\n- Results written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = load(f)["results"]
+        comparison = compare(results, baseline, args.threshold)
+        print(f"\n{'Benchmark':>32} | {'Baseline':>12} | {'Now':>12} | Ratio")
+        for name, before, now, ratio, regressed in comparison:
+            flag = "  <-- slower" if regressed else ""
+            print(f"{name:>32} | {before * 1e3:>9.3f} ms | {now * 1e3:>9.3f} ms | {ratio:.2f}{flag}")
+        regressions = [c for c in comparison if c[4]]
+        if regressions:
+            print(f"\n- {len(regressions)} regression(s) beyond {args.threshold}x")
+            raise SystemExit(1)
+        print("\n- No regressions")
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Crash-safe session checkpoints for P038.
+
+Once per trial (at the start of each ITI), the state needed to carry on with
+a session is saved next to its data file as "_checkpoint.json": the trial
+order (as trial type names, so any trial type in the protocol), how many
+trials are done, reinforcers provided, how far into the session it is, its
+start time (which is also in the data file's name), and how many data rows
+had been written by then. Each checkpoint is written to a
+temporary file, synced to disk, and then renamed over the previous one, so
+there is always a complete checkpoint on disk, even if the PC crashes
+mid-write. The checkpoint is only saved after the data rows it counts have
+been written (it goes through the event logger's queue), and is deleted
+once the session ends normally.
+
+If a session is cut short (crash, power cut, closed window), the "Resume
+session" button on the control panel finds the subject's latest checkpoint
+and picks the session back up at the next trial. The data file is trimmed
+back to the rows of the last completed trial and then appended to, so the
+session ends up in the same data file.
+"""
+
+from datetime import datetime
+from json import dumps, loads
+from os import fsync, listdir, path as os_path, remove, replace
+
+CHECKPOINT_SUFFIX = "_checkpoint.json"
+CHECKPOINT_VERSION = 1
+
+
+def checkpoint_path_for(csv_path):
+    # The checkpoint sits next to the .csv, with the same name
+    if csv_path.endswith(".csv"):
+        return csv_path[:-4] + CHECKPOINT_SUFFIX
+    return csv_path + CHECKPOINT_SUFFIX
+
+
+def write_atomic(file_path, text):
+    # Writes text to a temporary file, forces it to disk, then swaps it in
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8', newline='') as f:
+        f.write(text)
+        f.flush()
+        fsync(f.fileno())
+    replace(temp_path, file_path)
+
+
+class SessionCheckpoint(object):
+    __slots__ = ("subject_ID", "training_phase", "experimental_group",
+                 "data_file", "start_time", "elapsed_ns", "trial_order_seed",
+                 "trial_order_list", "trials_completed", "reinforcers",
+                 "rows_written", "summary_rows_written", "trial_order_offset")
+
+    def __init__(self, subject_ID, training_phase, experimental_group,
+                 data_file, start_time, elapsed_ns, trial_order_seed,
+                 trial_order_list, trials_completed, reinforcers,
+                 rows_written=None, summary_rows_written=None,
+                 trial_order_offset=0):
+        self.subject_ID = subject_ID
+        self.training_phase = training_phase
+        self.experimental_group = experimental_group
+        self.data_file = data_file
+        self.start_time = start_time # datetime the session started
+        self.elapsed_ns = elapsed_ns # Session time at the checkpoint
+        self.trial_order_seed = trial_order_seed
+        self.trial_order_list = trial_order_list
+        self.trials_completed = trials_completed
+        self.reinforcers = reinforcers
+        self.rows_written = rows_written # Data rows in the file (not the header)
+        self.summary_rows_written = summary_rows_written # Rows in the coalesced peck summary (if any)
+        self.trial_order_offset = trial_order_offset # Trials before trial_order_list (the current pass) starts
+
+    @property
+    def path(self):
+        return checkpoint_path_for(self.data_file)
+
+    def to_dict(self):
+        return {"version": CHECKPOINT_VERSION,
+                "subject": self.subject_ID,
+                "training_phase": self.training_phase,
+                "group": self.experimental_group,
+                "data_file": self.data_file,
+                "start_time": self.start_time.isoformat(),
+                "elapsed_ns": self.elapsed_ns,
+                "trial_order_seed": self.trial_order_seed,
+                "trial_order": list(self.trial_order_list), # Trial type names
+                "trials_completed": self.trials_completed,
+                "reinforcers": self.reinforcers,
+                "rows_written": self.rows_written,
+                "summary_rows_written": self.summary_rows_written,
+                "trial_order_offset": self.trial_order_offset}
+
+    def save(self):
+        write_atomic(self.path, dumps(self.to_dict()))
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            d = loads(f.read())
+        if d.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Unknown checkpoint version in {file_path}")
+        return cls(d["subject"], d["training_phase"], d["group"],
+                   d["data_file"], datetime.fromisoformat(d["start_time"]),
+                   d["elapsed_ns"], d["trial_order_seed"],
+                   list(d["trial_order"]),
+                   d["trials_completed"], d["reinforcers"], d["rows_written"],
+                   d.get("summary_rows_written"), d.get("trial_order_offset", 0))
+
+    def discard(self):
+        if os_path.isfile(self.path):
+            remove(self.path)
+
+    def __repr__(self):
+        return (f"{self.subject_ID}, phase {self.training_phase}, started "
+                f"{self.start_time:%Y-%m-%d %H:%M:%S}: {self.trials_completed} "
+                f"trials, {self.reinforcers} reinforcers")
+
+
+def find_resumable(data_folder_directory, subject_ID):
+    # The subject's most recent unfinished session (or None)
+    subject_folder = os_path.join(data_folder_directory, subject_ID)
+    if not os_path.isdir(subject_folder):
+        return None
+    checkpoints = sorted(f for f in listdir(subject_folder) if f.endswith(CHECKPOINT_SUFFIX))
+    for file_name in reversed(checkpoints): # File names start with the date/time
+        try:
+            checkpoint = SessionCheckpoint.load(os_path.join(subject_folder, file_name))
+        except (ValueError, KeyError, OSError) as e:
+            print(f"WARNING: skipping unreadable checkpoint {file_name} ({e})")
+            continue
+        if os_path.isfile(checkpoint.data_file) and checkpoint.rows_written is not None:
+            return checkpoint
+    return None
+
+
+def truncate_data_file(csv_path, rows):
+    # Trims a session .csv back to its header plus its first `rows` data rows
+    # (dropping those of a trial cut short). Returns how many were dropped.
+    with open(csv_path, 'r', newline='') as f:
+        lines = f.readlines()
+    kept = lines[:rows + 1]
+    dropped = len(lines) - len(kept)
+    if dropped:
+        write_atomic(csv_path, "".join(kept))
+    return dropped
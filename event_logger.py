@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background event logging pipeline for P038 sessions.
+
+Every peck used to be formatted, printed to the terminal, and turned into a
+data row inside the Tkinter callback that also has to hand out food. Under
+bursts of pecks, that work delays provide_food() and the scheduling of the
+next root.after() call. The EventLogger below moves all of that off of the
+Tkinter (UI) thread:
+
+    Tk callback --(compact event record)--> bounded queue --> writer thread
+                                                               |-> terminal
+                                                               |-> event store
+                                                               '-> recorder
+
+The callback only takes a single timestamp and drops a small tuple into the
+queue. The writer thread turns each record into numeric fields, adds them to
+the session's EventStore (see event_store.py), prints the terminal feedback
+line, and appends the matching .csv row to the recorder (see
+session_recorder.py). The queue is bounded so a runaway burst of pecks cannot
+eat all of the memory; records that don't fit are dropped and counted, and
+the count is reported on the terminal. Trial and session boundaries are sent through the same queue, so
+their order relative to the events is preserved, and close() drains
+everything that is still queued before returning.
+
+If a PeckCoalescer is given (see peck_coalescing.py), each row is offered to
+it before being printed and written; the pecks it coalesces go into its
+summary file instead (they are still added to the event store).
+
+At the end of each trial, the event store is also given the chance to move
+its events out to its spool file (see EventStore.roll()), on this thread,
+so that it never changes under a row being built.
+"""
+
+from queue import Queue, Full, Empty
+from threading import Thread
+
+# Indices into a compact event record (a plain tuple, built in the callback)
+(REC_TIME, REC_X, REC_Y, REC_OUTCOME, REC_LEFT_KEY, REC_RIGHT_KEY,
+ REC_TRIAL_TYPE, REC_TRIAL_ONSET, REC_TRIAL_NUM, REC_REINFORCERS,
+ REC_HIT_REGION, REC_HIT_DISTANCE) = range(12)
+
+# Control messages that travel through the queue alongside event records
+_CONSOLE = "console"
+_END_TRIAL = "end_trial"
+_CALL = "call"
+_CLOSE = "close"
+
+
+class EventLogger(object):
+    # The logger is built once the session's constant values (subject,
+    # group, etc.) are known, i.e., when the session actually starts. Those
+    # constants live in the event store's header.
+    def __init__(self, start_ns, store, recorder=None, echo=True,
+                 maxsize=10000, threaded=True, coalescer=None):
+        self.start_ns = start_ns # Session clock time (ns) at session start
+        self.store = store # EventStore that every event is added to
+        self.recorder = recorder # SessionRecorder (or None)
+        self.coalescer = coalescer # PeckCoalescer (or None)
+        self.echo = echo # Print feedback lines to the terminal?
+        self.dropped = 0 # Number of event records that didn't fit in the queue
+        self._reported_drops = 0
+        self.threaded = threaded
+        self._closed = False
+        self._queue = Queue(maxsize=maxsize)
+        if threaded:
+            self._thread = Thread(target=self._run,
+                                  name="P038-event-logger",
+                                  daemon=True)
+            self._thread.start()
+        else:
+            self._thread = None
+
+    def log(self, record):
+        # Called from the Tk callback. Never blocks: if the queue is full the
+        # record is dropped (and counted). Returns whether it was accepted.
+        if self._closed:
+            return False
+        if not self.threaded:
+            self._handle_event(record)
+            return True
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except Full:
+            self.dropped += 1
+            return False
+
+    def console(self, text):
+        # Prints a line of terminal feedback in order with the event lines
+        self._put_control((_CONSOLE, text))
+
+    def end_trial(self):
+        # Marks the end of a trial (lets the recorder flush, if it wants to)
+        self._put_control((_END_TRIAL, None))
+
+    def call(self, function):
+        # Runs function on the writer thread once every event logged before
+        # it has been written (e.g., to save a checkpoint that counts them)
+        self._put_control((_CALL, function))
+
+    def close(self, timeout=None):
+        # Drains every queued record, closes the recorder, and stops the
+        # writer thread. Safe to call more than once.
+        if self._closed:
+            return
+        self._put_control((_CLOSE, None))
+        self._closed = True
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._report_drops(final=True)
+
+    def _put_control(self, message):
+        # Control messages can't be dropped, so these wait for room
+        if self._closed:
+            return
+        if self.threaded:
+            self._queue.put(message)
+        else:
+            self._handle_control(message)
+
+    def _run(self):
+        # The writer thread's loop. Event records are tuples of length 12;
+        # anything else is a (control type, payload) pair.
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except Empty:
+                self._report_drops()
+                continue
+            try:
+                if len(item) == 2:
+                    if self._handle_control(item):
+                        return
+                else:
+                    self._handle_event(item)
+            except Exception as error: # Keep the pipeline alive no matter what
+                print(f"\nERROR: event logger could not write record {item}: {error}")
+            self._report_drops()
+
+    def _handle_control(self, message):
+        kind, payload = message
+        if kind == _CONSOLE:
+            if self.echo:
+                print(payload)
+        elif kind == _END_TRIAL:
+            if self.coalescer is not None:
+                self.coalescer.end_trial()
+            if self.recorder is not None:
+                self.recorder.end_trial()
+            self.store.roll()
+        elif kind == _CALL:
+            payload()
+        elif kind == _CLOSE:
+            if self.coalescer is not None:
+                self.coalescer.close()
+            if self.recorder is not None:
+                self.recorder.close()
+            return True
+        return False
+
+    def _handle_event(self, record):
+        # Adds the event to the store, then prints/writes its .csv row
+        index = self.store_record(record)
+        row = self.store.row(index)
+        if self.coalescer is not None and \
+                self.coalescer.add(row, (record[REC_TIME] - self.start_ns) // 1000):
+            return
+        if self.echo:
+            print(f"{row[3]:>30} | x: {row[1]: ^3} y: {row[2]:^3} | {row[0]} | {row[6]}")
+        if self.recorder is not None:
+            self.recorder.write_row(row)
+
+    def store_record(self, record):
+        # Turns a compact record into the store's numeric fields. Record
+        # times are session clock nanoseconds and are kept as integer
+        # microseconds; TrialTime is rounded to 5 decimals (as it always has
+        # been) before the conversion.
+        t = record[REC_TIME]
+        trial_time = round((t - record[REC_TRIAL_ONSET]) / 1e9, 5) # Time into this trial after the keys came on (negative during the ITI)
+        return self.store.append(
+            (t - self.start_ns) // 1000, # SessionTime
+            record[REC_X], # X coordinate of a peck
+            record[REC_Y], # Y coordinate of a peck
+            record[REC_OUTCOME], # Type of event
+            record[REC_LEFT_KEY],
+            record[REC_RIGHT_KEY],
+            record[REC_TRIAL_TYPE],
+            round(trial_time * 1000000), # TrialTime
+            record[REC_TRIAL_NUM],
+            record[REC_REINFORCERS],
+            hit_region = record[REC_HIT_REGION],
+            hit_distance = record[REC_HIT_DISTANCE])
+
+    def _report_drops(self, final=False):
+        if self.dropped != self._reported_drops or (final and self.dropped):
+            print(f"\nWARNING: {self.dropped} event(s) dropped by the event logger (queue full)")
+            self._reported_drops = self.dropped
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact, typed event storage for P038 sessions.
+
+The session data used to be kept as a list of 15-value Python lists, where
+every row repeated the same per-session constants (Subject, Condition,
+ITIDuration, TrainingPhase, Date) and stored SessionTime as a str(timedelta).
+The EventStore below instead keeps:
+
+    - the per-session constants ONCE, in a header
+    - every per-event field as its own numeric column (a typed array), with
+      times as integer microseconds and string fields (event type, trial
+      type, and key states) coded as small integers via a codebook
+
+A store can be saved to (and loaded from) a compact binary file that lives
+next to the session's .csv, and any row can be turned back into exactly the
+same values that are written to the .csv. This module can also be run from
+the command line to convert a binary file back into today's .csv layout:
+
+    python event_store.py <session file>.evt [<output>.csv]
+
+If no output is given, "_converted.csv" is added to the session file's name
+(so the .csv recorded during the session is never overwritten).
+
+The binary file also keeps two columns that the .csv doesn't have: the
+region of the screen each peck landed in (background, a key's halo, or the
+key itself) and its distance to the nearest key centre (see hit_testing.py).
+
+For long sessions, the store can be given a spool file (start_spool()). Its
+events are then moved out of memory in chunks as the session runs (see
+roll()), so it only ever holds the latest few thousand, and save() puts the
+spooled chunks and the events still in memory together into the .evt.
+"""
+
+from array import array
+from csv import reader, writer, QUOTE_MINIMAL
+from datetime import date, datetime, timedelta
+from json import dumps, loads
+from os import remove
+from struct import pack, unpack
+from sys import argv, byteorder
+
+# Column headers of the session .csv. Note that the data rows only have 15
+# values: "ChoiceKeysActive" was never filled in, so every column after
+# "TrialType" is shifted one place to the left of its header. This is kept
+# as-is so that the files match the ones already collected.
+CSV_HEADER = ["SessionTime", "Xcord","Ycord", "LocationEvent",
+              "LeftKey", "RightKey", "TrialType", "ChoiceKeysActive",
+              "TrialTime", "TrialNum", "ReinforcersProvided",
+              "ITIDuration", "Subject", "Condition",
+              "TrainingPhase", "Date"]
+
+# Known values of the string fields. Values not listed here (e.g., from a new
+# phase) are still stored; they just get added to the end of a session's
+# codebook, which is saved in the file header.
+EVENT_TYPES = ["ITI_peck", "background_peck", "hopper_up_peck",
+               "between-session_ITI_peck", "left_choice_key_peck",
+               "right_choice_key_peck", "optimal_peck", "suboptimal_peck",
+               "reinforcer_provided", "SessionEnds", "SessionResumed"]
+TRIAL_TYPES = ["LO_trial", "RO_trial", "LS_trial", "RS_trial",
+               "LO_choice_trial", "RO_choice_trial"]
+KEY_STATES = ["NA", "optimal", "suboptimal"]
+
+NA_COORD = -2**31 # Stands in for "NA" coordinates (non-peck events)
+NA_DISTANCE = 2**16 - 1 # Stands in for the distance of non-peck events
+
+# (column name, array typecode) for every per-event column
+COLUMNS = [("session_us", "q"), # SessionTime in microseconds
+           ("x", "i"), # Xcord (NA_COORD if "NA")
+           ("y", "i"), # Ycord (NA_COORD if "NA")
+           ("event", "H"), # LocationEvent code
+           ("left_key", "B"), # LeftKey code
+           ("right_key", "B"), # RightKey code
+           ("trial_type", "H"), # TrialType code
+           ("trial_time_us", "q"), # TrialTime in microseconds
+           ("trial_num", "i"), # TrialNum
+           ("reinforcers", "i"), # ReinforcersProvided
+           ("day_offset", "b"), # Days after the header date (past midnight)
+           ("hit_region", "B"), # Region pecked (see hit_testing.py; binary only)
+           ("hit_distance", "H")] # Tenths of a px to the nearest key centre (binary only)
+
+FILE_MAGIC = b"P038EVS\x01"
+FILE_EXTENSION = ".evt"
+SPOOL_EXTENSION = ".spool"
+
+
+class Codebook(object):
+    # Two-way mapping between the strings of a field and small int codes
+    __slots__ = ("values", "_codes")
+
+    def __init__(self, values):
+        self.values = list(values)
+        self._codes = {value: code for code, value in enumerate(self.values)}
+
+    def code(self, value):
+        try:
+            return self._codes[value]
+        except KeyError:
+            self._codes[value] = len(self.values)
+            self.values.append(value)
+            return self._codes[value]
+
+    def value(self, code):
+        return self.values[code]
+
+
+def session_microseconds(session_time):
+    # "H:MM:SS[.ffffff]" (a str(timedelta), which becomes "D day(s),
+    # H:MM:SS[.ffffff]" past 24 h) -> microseconds
+    days, _, clock_time = session_time.rpartition(" ")
+    hours, minutes, seconds = clock_time.split(":")
+    whole_seconds, _, fraction = seconds.partition(".")
+    return (((int(days.split()[0]) if days else 0) * 24 + int(hours)) * 60 + int(minutes)) * 60000000 \
+        + int(whole_seconds) * 1000000 + int(fraction.ljust(6, "0") if fraction else 0)
+
+
+def binary_path_for(csv_path):
+    # The binary file sits next to the .csv, with the same name
+    if csv_path.endswith(".csv"):
+        return csv_path[:-4] + FILE_EXTENSION
+    return csv_path + FILE_EXTENSION
+
+
+class EventStore(object):
+    __slots__ = ("subject_ID", "experimental_group", "training_phase",
+                 "ITI_duration", "session_date", "start_time",
+                 "metadata", "event_types", "trial_types", "key_states",
+                 "columns", "spooled", "spool_size", "_spool", "_chunks")
+
+    def __init__(self, subject_ID, experimental_group, training_phase,
+                 ITI_duration, session_date=None, start_time=None):
+        # Per-session constants (stored once)
+        self.subject_ID = subject_ID
+        self.experimental_group = experimental_group
+        self.training_phase = training_phase
+        self.ITI_duration = ITI_duration
+        self.session_date = session_date or date.today()
+        self.start_time = start_time # datetime the session started (or None)
+        self.metadata = {} # Anything else worth keeping (e.g., the trial order seed)
+        # Codebooks for the string fields
+        self.event_types = Codebook(EVENT_TYPES)
+        self.trial_types = Codebook(TRIAL_TYPES)
+        self.key_states = Codebook(KEY_STATES)
+        # Per-event columns (of the events still in memory)
+        self.columns = {name: array(typecode) for name, typecode in COLUMNS}
+        # Events moved out to the spool file (see start_spool())
+        self.spooled = 0
+        self.spool_size = None
+        self._spool = None
+        self._chunks = [] # (file offset, number of events) of each spooled chunk
+
+    def __len__(self):
+        return self.spooled + len(self.columns["session_us"])
+
+    def start_spool(self, file_path, spool_size=5000):
+        # From now on, roll() moves the events in memory to file_path once
+        # there are spool_size of them. (The file is only scratch space for
+        # save(); it is overwritten if it is already there.)
+        self._spool = open(file_path, "w+b")
+        self.spool_size = spool_size
+
+    def roll(self):
+        # Moves the events in memory to the spool file as one chunk (each
+        # column's raw values, in order), if there are enough of them.
+        # Returns how many were moved.
+        n = len(self.columns["session_us"])
+        if self._spool is None or n == 0 or n < self.spool_size:
+            return 0
+        self._spool.seek(0, 2)
+        self._chunks.append((self._spool.tell(), n))
+        for name, typecode in COLUMNS:
+            self._write_column(self._spool, self.columns[name])
+            self.columns[name] = array(typecode)
+        self._spool.flush()
+        self.spooled += n
+        return n
+
+    def _spooled_column(self, name, chunk):
+        # One column's values from a spooled chunk
+        offset, n = chunk
+        for other, typecode in COLUMNS:
+            if other == name:
+                break
+            offset += array(typecode).itemsize * n
+        column = array(dict(COLUMNS)[name])
+        self._spool.seek(offset)
+        column.fromfile(self._spool, n)
+        if byteorder != "little":
+            column.byteswap()
+        return column
+
+    def close_spool(self):
+        # Closes (and removes) the spool file. Only call this once the
+        # store has been saved.
+        if self._spool is not None:
+            self._spool.close()
+            remove(self._spool.name)
+            self._spool = None
+
+    def append(self, session_us, x, y, outcome, left_key, right_key,
+               trial_type, trial_time_us, trial_num, reinforcers,
+               event_date=None, hit_region=0, hit_distance=None):
+        # Adds a single event and returns its index
+        c = self.columns
+        c["session_us"].append(session_us)
+        c["x"].append(x if isinstance(x, int) else NA_COORD)
+        c["y"].append(y if isinstance(y, int) else NA_COORD)
+        c["event"].append(self.event_types.code(outcome))
+        c["left_key"].append(self.key_states.code(left_key))
+        c["right_key"].append(self.key_states.code(right_key))
+        c["trial_type"].append(self.trial_types.code(trial_type))
+        c["trial_time_us"].append(trial_time_us)
+        c["trial_num"].append(trial_num)
+        c["reinforcers"].append(reinforcers)
+        if event_date is None:
+            event_date = date.today()
+        c["day_offset"].append((event_date - self.session_date).days)
+        c["hit_region"].append(hit_region)
+        c["hit_distance"].append(NA_DISTANCE if hit_distance is None
+                                 else min(round(hit_distance * 10), NA_DISTANCE - 1))
+        return self.spooled + len(c["session_us"]) - 1
+
+    def append_csv_rows(self, file_path):
+        # Adds every data row of a session .csv (e.g., the part of a session
+        # recorded before it was resumed). Values are read by position (see
+        # CSV_HEADER) and come back out of row() exactly as they went in.
+        with open(file_path, 'r', newline='') as f:
+            rows = reader(f)
+            next(rows, None) # Header
+            self.append_rows(rows)
+
+    def append_rows(self, rows):
+        # Adds rows (lists of strings) in the session .csv layout
+        for row in rows:
+            self.append(session_microseconds(row[0]),
+                        int(row[1]) if row[1] != "NA" else "NA",
+                        int(row[2]) if row[2] != "NA" else "NA",
+                        row[3], row[4], row[5], row[6],
+                        round(float(row[7]) * 1000000),
+                        int(row[8]), int(row[9]),
+                        event_date = date.fromisoformat(row[14]))
+
+    def row(self, i, columns=None):
+        # Rebuilds row i exactly as it is written to the session .csv (i
+        # counts every event; only those still in memory can be asked for,
+        # unless the columns they're in are given)
+        if columns is None:
+            c = self.columns
+            i -= self.spooled
+            if i < 0:
+                raise IndexError("That event has been moved to the spool file")
+        else:
+            c = columns
+        x, y = c["x"][i], c["y"][i]
+        return [
+            str(timedelta(microseconds = c["session_us"][i])), # SessionTime
+            "NA" if x == NA_COORD else x, # Xcord
+            "NA" if y == NA_COORD else y, # Ycord
+            self.event_types.value(c["event"][i]), # LocationEvent
+            self.key_states.value(c["left_key"][i]), # LeftKey
+            self.key_states.value(c["right_key"][i]), # RightKey
+            self.trial_types.value(c["trial_type"][i]), # TrialType
+            round(c["trial_time_us"][i] / 1000000, 5), # TrialTime
+            c["trial_num"][i], # TrialNum
+            c["reinforcers"][i], # ReinforcersProvided
+            self.ITI_duration, # ITIDuration
+            self.subject_ID, # Subject
+            self.experimental_group, # Condition
+            self.training_phase, # TrainingPhase
+            self.session_date + timedelta(days = c["day_offset"][i]) # Date
+            ]
+
+    def __iter__(self):
+        # Every row, spooled (read back one chunk at a time) or not
+        for chunk in self._chunks:
+            columns = {name: self._spooled_column(name, chunk) for name, _ in COLUMNS}
+            for i in range(chunk[1]):
+                yield self.row(i, columns)
+        for i in range(len(self.columns["session_us"])):
+            yield self.row(i, self.columns)
+
+    def _write_column(self, f, column):
+        if byteorder != "little":
+            column = array(column.typecode, column)
+            column.byteswap()
+        column.tofile(f)
+
+    def header(self):
+        # Everything (other than the columns themselves) needed to rebuild
+        # the store from disk
+        return {"version": 1,
+                "subject": self.subject_ID,
+                "condition": self.experimental_group,
+                "training_phase": self.training_phase,
+                "iti_duration": self.ITI_duration,
+                "date": self.session_date.isoformat(),
+                "start_time": self.start_time.isoformat() if self.start_time else None,
+                "metadata": self.metadata,
+                "event_types": self.event_types.values,
+                "trial_types": self.trial_types.values,
+                "key_states": self.key_states.values,
+                "columns": COLUMNS,
+                "n_events": len(self)}
+
+    def save(self, file_path):
+        # Writes the store to a binary file: magic bytes, a length-prefixed
+        # JSON header, then each column's raw little-endian values in order.
+        # (A spooled column is copied over a chunk at a time.)
+        header = dumps(self.header()).encode("utf-8")
+        with open(file_path, "wb") as f:
+            f.write(FILE_MAGIC)
+            f.write(pack("<I", len(header)))
+            f.write(header)
+            for name, typecode in COLUMNS:
+                for chunk in self._chunks:
+                    self._write_column(f, self._spooled_column(name, chunk))
+                self._write_column(f, self.columns[name])
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, "rb") as f:
+            if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                raise ValueError(f"{file_path} is not a P038 event file")
+            header_length, = unpack("<I", f.read(4))
+            header = loads(f.read(header_length).decode("utf-8"))
+            store = cls(header["subject"],
+                        header["condition"],
+                        header["training_phase"],
+                        header["iti_duration"],
+                        session_date = date.fromisoformat(header["date"]))
+            if header["start_time"]:
+                store.start_time = datetime.fromisoformat(header["start_time"])
+            store.metadata = header.get("metadata", {})
+            store.event_types = Codebook(header["event_types"])
+            store.trial_types = Codebook(header["trial_types"])
+            store.key_states = Codebook(header["key_states"])
+            n = header["n_events"]
+            for name, typecode in header["columns"]:
+                column = array(typecode)
+                column.fromfile(f, n)
+                if byteorder != "little":
+                    column.byteswap()
+                store.columns[name] = column
+            # Files saved before a column existed get it filled with NAs
+            for name, typecode in COLUMNS:
+                if len(store.columns[name]) != n:
+                    missing = NA_DISTANCE if name == "hit_distance" else 0
+                    store.columns[name] = array(typecode, [missing]) * n
+        return store
+
+    def to_csv(self, file_path):
+        # Writes the store out in the session .csv layout (header + rows)
+        with open(file_path, "w", newline="") as f:
+            w = writer(f, quoting=QUOTE_MINIMAL)
+            w.writerow(CSV_HEADER)
+            w.writerows(self)
+
+
+if __name__ == '__main__':
+    if len(argv) not in (2, 3):
+        print("Usage: python event_store.py <session file>.evt [<output>.csv]")
+    else:
+        input_path = argv[1]
+        if len(argv) == 3:
+            output_path = argv[2]
+        elif input_path.endswith(FILE_EXTENSION): # Don't overwrite the recorded .csv
+            output_path = input_path[:-len(FILE_EXTENSION)] + "_converted.csv"
+        else:
+            output_path = input_path + "_converted.csv"
+        EventStore.load(input_path).to_csv(output_path)
+        print(f"- {input_path} converted to {output_path}")
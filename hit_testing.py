@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Geometric hit-testing of pecks on the P038 canvas.
+
+Pecks used to be routed by Tk itself: the background, both (invisible) halo
+ovals and both key ovals each had their own "<Button-1>" binding, and Tk
+searched its display list for the topmost item under every click. Which key
+had been hit was then worked out from the tag of the item.
+
+Because the keys never move during a session, the HitMap below works the
+other way around. When the session starts, it paints every key (and its
+halo) into a one-byte-per-pixel lookup grid the size of the screen. Classifying
+a peck is then a single index into that grid:
+
+    grid[y * width + x] -> BACKGROUND, or (key, HALO/CORE)
+
+The distance from the peck to the nearest key's centre is worked out from
+the keys' precomputed centres. Both are kept with each peck in the session's
+event store (see event_store.py) so how accurately a bird pecks can be
+analysed later; they are not added to the .csv.
+
+Touchscreens sometimes register a single peck twice. A peck that lands
+within debounce_px of the previous peck, less than debounce_ms after it, is
+treated as such a "bounce": it is counted, but not passed on (so it can't
+be logged twice or earn a second reinforcer).
+"""
+
+from math import ceil, floor, hypot
+
+# Where a peck landed (as stored in the event store's hit_region column)
+NO_HIT = 0 # Not a peck (e.g., reinforcer_provided)
+BACKGROUND = 1
+HALO = 2 # The "active" space around a key
+CORE = 3 # The key itself
+REGION_NAMES = ["NA", "background", "halo", "core"]
+
+
+class HitMap(object):
+    def __init__(self, width, height, key_coordinates, halo_margin=25):
+        # key_coordinates gives the [x1, y1, x2, y2] of each key, e.g.
+        # {"left_choice_key": [200, 250, 300, 350], ...}
+        self.width = width
+        self.height = height
+        self.key_strings = list(key_coordinates)
+        self.centres = [((x1 + x2) / 2, (y1 + y2) / 2)
+                        for x1, y1, x2, y2 in key_coordinates.values()]
+        # Each grid cell holds 0 for the background, or a code for a key's
+        # halo (2k + 1) or core (2k + 2), where k is the key's index
+        self.grid = bytearray(width * height)
+        for k, (x1, y1, x2, y2) in enumerate(key_coordinates.values()):
+            self._paint_oval(x1 - halo_margin, y1 - halo_margin,
+                             x2 + halo_margin, y2 + halo_margin, 2 * k + 1)
+        # Cores are painted last so they win wherever they overlap a halo
+        for k, (x1, y1, x2, y2) in enumerate(key_coordinates.values()):
+            self._paint_oval(x1, y1, x2, y2, 2 * k + 2)
+        # What each code stands for: (key_string or None, region)
+        self.codes = [(None, BACKGROUND)]
+        for key_string in self.key_strings:
+            self.codes.append((key_string, HALO))
+            self.codes.append((key_string, CORE))
+
+    def _paint_oval(self, x1, y1, x2, y2, code):
+        # Fills every pixel (x, y) that lies inside (or on) the oval
+        cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+        rx, ry = (x2 - x1) / 2, (y2 - y1) / 2
+        for y in range(max(0, ceil(y1)), min(self.height, floor(y2) + 1)):
+            dy = (y - cy) / ry
+            if dy * dy > 1:
+                continue
+            half = rx * (1 - dy * dy) ** 0.5
+            start = max(0, ceil(cx - half))
+            stop = min(self.width, floor(cx + half) + 1)
+            if stop > start:
+                row = y * self.width
+                self.grid[row + start:row + stop] = bytes([code]) * (stop - start)
+
+    def classify(self, x, y):
+        # Returns (key_string or None, region) for a peck at (x, y)
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.codes[self.grid[y * self.width + x]]
+        return self.codes[0]
+
+    def distance(self, x, y):
+        # Distance (px) from (x, y) to the nearest key's centre
+        return min(hypot(x - cx, y - cy) for cx, cy in self.centres)
+
+
+class Debouncer(object):
+    # Flags pecks that follow the previous peck too closely (in time and
+    # space) to be a new peck
+    def __init__(self, debounce_ms=50, debounce_px=30):
+        self.debounce_ns = int(debounce_ms * 1e6)
+        self.debounce_px = debounce_px
+        self.bounces = 0 # How many pecks were thrown out
+        self._last = None # (time, x, y) of the last accepted peck
+
+    def is_bounce(self, now_ns, x, y):
+        last = self._last
+        if (last is not None and now_ns - last[0] < self.debounce_ns
+                and hypot(x - last[1], y - last[2]) <= self.debounce_px):
+            self.bounces += 1
+            return True
+        self._last = (now_ns, x, y)
+        return False
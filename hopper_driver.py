@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Non-blocking hopper commands for P038.
+
+HopperObject.change_hopper_state() talks to the box hardware and can take a
+while to return, which used to hold up the UI thread (and, with it, the
+timing of everything else) at every ITI, key presentation, and reinforcer.
+The HopperDriver instead hands each command to a worker thread and returns
+straight away:
+
+    - A command that asks for the state the hopper was last asked to be in
+      is dropped rather than sent again (e.g., "Off" at every ITI and key
+      presentation, when it is already off). A command that fails doesn't
+      count as the hopper's state, so a hopper that failed to go down is
+      asked again at the next "Off". The "Off" at the end of the session is
+      always sent.
+    - Each command sent is timestamped when it was issued and when the
+      hopper call returned. These go into the session clock's onset log
+      (the "_timing.csv" written next to the data file) as
+      "hopper_on_command"/"hopper_off_command" rows, where the lateness
+      column is the hopper's actuation latency.
+
+SimulatedHopperObject stands in for the box's HopperObject (with adjustable
+delays, and optionally failing), so the driver can be tried out without the
+hardware.
+"""
+
+from collections import deque
+from queue import Queue
+from random import Random
+from threading import Lock, Thread
+from time import perf_counter_ns, sleep
+
+HOPPER_STATES = ("On", "Off")
+COMMAND_HISTORY = 1000 # Commands kept for latencies_ms() (every one is also in the clock's log)
+
+
+class SimulatedHopperObject(object):
+    # Same interface as the box's HopperObject, but only waits
+    def __init__(self, on_delay_ms=5, off_delay_ms=5, jitter_ms=0, seed=None, failures=0):
+        self.on_delay_ms = on_delay_ms
+        self.off_delay_ms = off_delay_ms
+        self.jitter_ms = jitter_ms
+        self.rng = Random(seed)
+        self.failures = failures # The next this many calls raise an error
+        self.state = None
+        self.calls = 0
+
+    def change_hopper_state(self, state):
+        if self.failures > 0:
+            self.failures -= 1
+            raise IOError(f"simulated hopper failure turning {state}")
+        delay_ms = self.on_delay_ms if state == "On" else self.off_delay_ms
+        if self.jitter_ms:
+            delay_ms += self.rng.uniform(0, self.jitter_ms)
+        if delay_ms > 0:
+            sleep(delay_ms / 1000)
+        self.state = state
+        self.calls += 1
+
+
+class HopperDriver(object):
+    def __init__(self, hopper, clock=None, time_source=perf_counter_ns, threaded=True):
+        self.hopper = hopper # Anything with change_hopper_state("On"/"Off")
+        self.clock = clock # Optional SessionClock, to log command latencies
+        self.time_source = clock.time_source if clock is not None else time_source
+        self.threaded = threaded
+        self.requested_state = None # Last state asked for (None: unknown)
+        self._state_lock = Lock() # requested_state is also cleared by the worker
+        self.commands = deque(maxlen=COMMAND_HISTORY) # (trial, state, issued ns, completed ns, error) of the latest commands
+        self.dropped = 0 # Redundant commands not sent
+        self._queue = Queue()
+        self._worker = None
+        if threaded:
+            self._worker = Thread(target=self._run, name="HopperDriver", daemon=True)
+            self._worker.start()
+
+    def set_state(self, state, trial=None, force=False):
+        # Asks for the hopper to be turned "On" or "Off". Returns whether a
+        # command was actually sent (False if it was already in that state).
+        # A forced command is sent even then (e.g., at the end of the
+        # session, in case the hopper isn't where it was last asked to be).
+        if state not in HOPPER_STATES:
+            raise ValueError(f"Unknown hopper state: {state!r}")
+        with self._state_lock:
+            if state == self.requested_state and not force:
+                self.dropped += 1
+                return False
+            self.requested_state = state
+        command = (trial, state, self.time_source())
+        if self.threaded:
+            self._queue.put(command)
+        else:
+            self._send(command)
+        return True
+
+    def _run(self):
+        while True:
+            command = self._queue.get()
+            if command is None:
+                break
+            self._send(command)
+
+    def _send(self, command):
+        trial, state, issued = command
+        error = None
+        try:
+            self.hopper.change_hopper_state(state)
+        except Exception as e: # Keep going; the next command may work
+            error = e
+            print(f"\nERROR: hopper did not turn {state}: {e}")
+            # The hopper's state is unknown now, so the next command for this
+            # state mustn't be dropped (unless another was asked for since)
+            with self._state_lock:
+                if self.requested_state == state:
+                    self.requested_state = None
+        completed = self.time_source()
+        self.commands.append((trial, state, issued, completed, error))
+        if self.clock is not None:
+            self.clock.record(f"hopper_{state.lower()}_command", issued, completed, trial)
+
+    def latencies_ms(self):
+        # Actuation latency of the latest commands sent
+        return [(completed - issued) / 1e6 for _, _, issued, completed, _ in self.commands]
+
+    def close(self, timeout=5):
+        # Waits for any queued commands to be sent, then stops the worker
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join(timeout)
+            self._worker = None
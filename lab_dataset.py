@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lab-wide columnar dataset of every P038 session.
+
+Analyses across subjects (e.g., Choice vs. Forced over weeks) used to read
+dozens of session .csv files into Python lists every time. The build command
+below compiles every session in the data folder into one on-disk dataset
+that is laid out for that kind of query:
+
+    P038_dataset/
+        dataset.json                    -- sessions, partitions, dictionaries
+        B1/phase1/chunk-000001/         -- one partition per subject and phase
+            session.npy  session_us.npy  event.npy  trial_type.npy ...
+
+Every column of a chunk is one contiguous typed NumPy array (.npy), and the
+string columns (event, trial type, key states) hold small integer codes
+into dictionaries kept in dataset.json. Readers memory-map the .npy files,
+so a query only touches the columns and partitions it asks for, and nothing
+is copied until it is actually used.
+
+Building is incremental: sessions already in the dataset (same file, size
+and modification time) are skipped, and new sessions are written as a new
+chunk in their partition, so existing chunks are never rewritten. A session
+that changed since it was added (e.g., one that was resumed) is added again,
+and its old rows are retired. "compact" merges a partition's chunks (and
+drops retired rows) into one chunk.
+
+    python lab_dataset.py build [data folder] [--out <dataset folder>]
+    python lab_dataset.py compact [--out <dataset folder>]
+    python lab_dataset.py info [--out <dataset folder>]
+"""
+
+from json import dumps, loads
+from os import makedirs, path as os_path, stat
+from shutil import rmtree
+
+import numpy as np
+
+from checkpoint import write_atomic
+from event_store import EVENT_TYPES, TRIAL_TYPES, KEY_STATES
+from peck_coalescing import read_session_rows, session_microseconds
+from session_catalog import parse_session_filename, find_session_files
+
+DATASET_FOLDER = "P038_dataset"
+DATASET_VERSION = 1
+NA_COORD = -1 # Stands in for "NA" coordinates (non-peck events)
+
+# (column name, dtype) of every column
+COLUMNS = [("session", "i4"), # Index into the dataset's sessions
+           ("session_us", "i8"), # SessionTime in microseconds
+           ("x", "i2"), # Xcord (NA_COORD if "NA")
+           ("y", "i2"), # Ycord (NA_COORD if "NA")
+           ("event", "u1"), # LocationEvent code
+           ("left_key", "u1"), # LeftKey code
+           ("right_key", "u1"), # RightKey code
+           ("trial_type", "u1"), # TrialType code
+           ("trial_time_us", "i8"), # TrialTime in microseconds
+           ("trial_num", "i2"),
+           ("reinforcers", "i2")]
+# Dictionary of each string column (shared by every chunk; only ever added to)
+DICTIONARY_COLUMNS = {"event": EVENT_TYPES, "trial_type": TRIAL_TYPES,
+                      "left_key": KEY_STATES, "right_key": KEY_STATES}
+
+
+def partition_name(subject, phase):
+    return f"{subject}/phase{phase}"
+
+
+def partition_key(partition):
+    # "B1/phase1" -> ("B1", 1)
+    subject, phase = partition.split("/")
+    return subject, int(phase[len("phase"):])
+
+
+class LabDataset(object):
+    def __init__(self, folder):
+        self.folder = folder
+        self.sessions = [] # Dicts: file, size, mtime_ns, subject, phase, condition, start, date, rows, retired
+        self.partitions = {} # partition name -> [chunk names]
+        self.dictionaries = {name: list(values) for name, values in DICTIONARY_COLUMNS.items()}
+        self._codes = None
+        manifest = os_path.join(folder, "dataset.json")
+        if os_path.isfile(manifest):
+            with open(manifest, 'r', encoding='utf-8') as f:
+                stored = loads(f.read())
+            if stored.get("version") != DATASET_VERSION:
+                raise ValueError(f"Unknown dataset version in {manifest}")
+            self.sessions = stored["sessions"]
+            self.partitions = stored["partitions"]
+            self.dictionaries = stored["dictionaries"]
+
+    def _save_manifest(self):
+        # Written last (and atomically), so a build that is cut short never
+        # leaves the dataset pointing at half-written chunks
+        write_atomic(os_path.join(self.folder, "dataset.json"),
+                     dumps({"version": DATASET_VERSION,
+                            "sessions": self.sessions,
+                            "partitions": self.partitions,
+                            "dictionaries": self.dictionaries}))
+
+    # Reading
+
+    def _chunk_path(self, partition, chunk):
+        return os_path.join(self.folder, partition, chunk)
+
+    def select(self, subject=None, phase=None):
+        # Names of the partitions matching a subject and/or phase
+        return [name for name in sorted(self.partitions)
+                if (subject is None or name.split("/")[0] == subject)
+                and (phase is None or name.split("/")[1] == f"phase{phase}")]
+
+    def chunks(self, columns, subject=None, phase=None):
+        # Yields {column: memory-mapped array} for each chunk of the
+        # matching partitions (only the columns asked for are opened)
+        for partition in self.select(subject, phase):
+            for chunk in self.partitions[partition]:
+                path = self._chunk_path(partition, chunk)
+                yield {name: np.load(os_path.join(path, name + ".npy"), mmap_mode='r')
+                       for name in columns}
+
+    def load(self, columns, subject=None, phase=None, condition=None,
+             include_retired=False):
+        # {column: array} over the matching partitions. A single chunk
+        # comes back as its memory map (no copy); several are joined.
+        wanted = list(columns)
+        needs_session = condition is not None or not include_retired
+        if needs_session and "session" not in wanted:
+            wanted.append("session")
+        parts = list(self.chunks(wanted, subject, phase))
+        if not parts:
+            return {name: np.empty(0, dtype=dict(COLUMNS)[name]) for name in columns}
+        if len(parts) == 1:
+            result = parts[0]
+        else:
+            result = {name: np.concatenate([part[name] for part in parts]) for name in wanted}
+        if needs_session:
+            keep = np.array([(include_retired or not s["retired"])
+                             and (condition is None or s["condition"] == condition)
+                             for s in self.sessions], dtype=bool)
+            mask = keep[result["session"]]
+            if not mask.all():
+                result = {name: values[mask] for name, values in result.items()}
+        return {name: result[name] for name in columns}
+
+    def code(self, column, value):
+        # The code of a string value (e.g., code("event", "optimal_peck")),
+        # or -1 if it never occurs
+        values = self.dictionaries[column]
+        return values.index(value) if value in values else -1
+
+    def decode(self, column, codes):
+        return np.asarray(self.dictionaries[column], dtype=object)[np.asarray(codes)]
+
+    def rows(self, subject=None, phase=None):
+        return sum(s["rows"] for s in self.sessions if not s["retired"]
+                   and (subject is None or s["subject"] == subject)
+                   and (phase is None or s["phase"] == phase))
+
+    # Writing
+
+    def _encode(self, column, values):
+        codes = {value: code for code, value in enumerate(self.dictionaries[column])}
+        encoded = []
+        for value in values:
+            if value not in codes: # New value: add it to the dictionary
+                codes[value] = len(self.dictionaries[column])
+                self.dictionaries[column].append(value)
+            encoded.append(codes[value])
+        return np.array(encoded, dtype=dict(COLUMNS)[column])
+
+    def _session_columns(self, session_index, rows):
+        # A session's rows (lists of strings) as typed columns
+        def coordinate(value):
+            return int(value) if value != "NA" else NA_COORD
+        return {"session": np.full(len(rows), session_index, dtype="i4"),
+                "session_us": np.array([session_microseconds(row[0]) for row in rows], dtype="i8"),
+                "x": np.array([coordinate(row[1]) for row in rows], dtype="i2"),
+                "y": np.array([coordinate(row[2]) for row in rows], dtype="i2"),
+                "event": self._encode("event", [row[3] for row in rows]),
+                "left_key": self._encode("left_key", [row[4] for row in rows]),
+                "right_key": self._encode("right_key", [row[5] for row in rows]),
+                "trial_type": self._encode("trial_type", [row[6] for row in rows]),
+                "trial_time_us": np.array([round(float(row[7]) * 1000000) for row in rows], dtype="i8"),
+                "trial_num": np.array([int(row[8]) for row in rows], dtype="i2"),
+                "reinforcers": np.array([int(row[9]) for row in rows], dtype="i2")}
+
+    def _write_chunk(self, partition, columns):
+        # Writes a new chunk (after the partition's existing ones)
+        existing = self.partitions.setdefault(partition, [])
+        number = int(existing[-1].split("-")[1]) + 1 if existing else 1
+        chunk = f"chunk-{number:06d}"
+        path = self._chunk_path(partition, chunk)
+        makedirs(path, exist_ok=True)
+        for name, _ in COLUMNS:
+            np.save(os_path.join(path, name + ".npy"), columns[name])
+        existing.append(chunk)
+
+    def add_sessions(self, data_folder):
+        # Adds every new (or changed) session file in the data folder.
+        # Returns (sessions added, sessions already in the dataset).
+        known = {(s["file"], s["size"], s["mtime_ns"]): s for s in self.sessions if not s["retired"]}
+        by_file = {s["file"]: s for s in self.sessions if not s["retired"]}
+        new_columns = {} # partition -> [column dicts]
+        added = skipped = 0
+        for file_path in find_session_files(data_folder):
+            subject, timestamp, phase = parse_session_filename(os_path.basename(file_path))
+            info = stat(file_path)
+            file_name = os_path.relpath(file_path, data_folder)
+            if (file_name, info.st_size, info.st_mtime_ns) in known:
+                skipped += 1
+                continue
+            rows = [row for row in read_session_rows(file_path) if len(row) >= 15]
+            if not rows:
+                continue
+            if file_name in by_file: # Changed since it was added
+                by_file[file_name]["retired"] = True
+            self.sessions.append({"file": file_name, "size": info.st_size,
+                                  "mtime_ns": info.st_mtime_ns, "subject": subject,
+                                  "phase": phase, "condition": rows[0][12],
+                                  "start": timestamp, "date": rows[0][14],
+                                  "rows": len(rows), "retired": False})
+            new_columns.setdefault(partition_name(subject, phase), []).append(
+                self._session_columns(len(self.sessions) - 1, rows))
+            added += 1
+        for partition, parts in new_columns.items():
+            self._write_chunk(partition, {name: np.concatenate([part[name] for part in parts])
+                                          for name, _ in COLUMNS})
+        if added or not os_path.isfile(os_path.join(self.folder, "dataset.json")):
+            makedirs(self.folder, exist_ok=True)
+            self._save_manifest()
+        return added, skipped
+
+    def compact(self):
+        # Merges each partition's chunks into one (dropping retired rows).
+        # Returns the number of partitions rewritten.
+        retired = np.array([s["retired"] for s in self.sessions], dtype=bool)
+        compacted = 0
+        old_chunks = []
+        for partition in sorted(self.partitions):
+            chunks = self.partitions[partition]
+            parts = list(self.chunks([name for name, _ in COLUMNS],
+                                     *partition_key(partition)))
+            if len(chunks) < 2 and not any(retired[part["session"]].any() for part in parts):
+                continue
+            merged = {name: np.concatenate([part[name] for part in parts]) for name, _ in COLUMNS}
+            keep = ~retired[merged["session"]]
+            merged = {name: values[keep] for name, values in merged.items()}
+            del parts
+            self._write_chunk(partition, merged)
+            old_chunks += [self._chunk_path(partition, chunk) for chunk in chunks[:-1]]
+            self.partitions[partition] = chunks[-1:]
+            compacted += 1
+        if compacted:
+            self._save_manifest()
+            # Old chunks are only deleted once the manifest no longer uses them
+            for path in old_chunks:
+                rmtree(path, ignore_errors=True)
+        return compacted
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from session_analysis import default_data_folder
+
+    parser = ArgumentParser(description="Lab-wide columnar dataset of P038 sessions")
+    parser.add_argument("command", choices=("build", "compact", "info"))
+    parser.add_argument("data_folder", nargs="?", default=None)
+    parser.add_argument("--out", default=None, help=f"dataset folder (default: {DATASET_FOLDER} in the data folder)")
+    args = parser.parse_args()
+
+    data_folder = args.data_folder or default_data_folder()
+    dataset = LabDataset(args.out or os_path.join(data_folder, DATASET_FOLDER))
+    if args.command == "build":
+        added, skipped = dataset.add_sessions(data_folder)
+        print(f"- {added} session(s) added, {skipped} already in the dataset")
+    elif args.command == "compact":
+        print(f"- {dataset.compact()} partition(s) compacted")
+    optimal, suboptimal = dataset.code("event", "optimal_peck"), dataset.code("event", "suboptimal_peck")
+    print(f"{'Partition':>14} | Chunks | {'Rows':>8} | Optimal/suboptimal pecks")
+    for partition in dataset.select():
+        subject, phase = partition_key(partition)
+        event = dataset.load(["event"], subject, phase)["event"]
+        print(f"{partition:>14} | {len(dataset.partitions[partition]):^6} | {len(event):>8} | "
+              f"{int((event == optimal).sum())}/{int((event == suboptimal).sum())}")
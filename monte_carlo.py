@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo predictions of Choice vs. Forced group outcomes in P038.
+
+Before committing birds to the Choice or Forced conditions, this simulates
+thousands of "virtual pigeons" going through the same sessions the real
+birds would get:
+
+    - Trial orders come from the same plans/generator used by first_ITI()
+      (see trial_sequences.py and the protocol file): pre-training sessions
+      (phase 0), then training sessions (phase 1) of each group. A trial
+      type counts as a choice trial if it starts with both an optimal and a
+      suboptimal key, and as a forced optimal or suboptimal trial if it
+      starts with only one of them (see trial_classes()).
+    - Reinforcement follows key_press()/provide_food(): any peck in
+      pre-training gives one reinforcer; in training, the optimal key gives
+      a reinforcer and then leaves the suboptimal key up for a second one,
+      while the suboptimal key gives a single reinforcer and ends the trial.
+
+Learning is modelled for all simulated subjects at once with NumPy arrays:
+each subject has a value for the optimal and suboptimal stimulus, chooses
+between them with a softmax rule, and updates the chosen (or forced) value
+with a delta rule. Two models are available:
+
+    "rw"          -- Rescorla-Wagner: the outcome of a trial is the number
+                     of reinforcers it ends up giving
+    "discounted"  -- like "rw", but the second reinforcer after an optimal
+                     choice is discounted by the extra delay to get it
+                     (hyperbolically, by the hopper cycle + choice latency)
+
+Subjects are split into chunks that are run in a pool of processes. The
+output is a learning curve for each group (mean optimal-choice proportion on
+choice trials, per training session) with a 95% confidence interval of the
+mean and a 95% band across subjects, plus the expected session length.
+
+    python monte_carlo.py --subjects 10000 --model discounted --out predictions.csv
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from csv import writer, QUOTE_MINIMAL
+from os import cpu_count
+
+import numpy as np
+
+from protocol import load_protocol
+from trial_sequences import session_plan, generate_sequence
+
+MODELS = ("rw", "discounted")
+ORDER_POOL_SIZE = 256 # Distinct trial orders generated per phase/group/chunk
+
+
+def trial_classes(protocol):
+    # Trial types are coded as their index in the protocol. Returns the
+    # codes of the (forced optimal, forced suboptimal, choice) trial types.
+    forced_optimal, forced_suboptimal, choice = [], [], []
+    choice_trial_types = protocol.choice_trial_types()
+    for trial_type, code in protocol.trial_index.items():
+        roles = protocol.starting_roles(trial_type)
+        if trial_type in choice_trial_types:
+            choice.append(code)
+        elif roles == {"optimal"}:
+            forced_optimal.append(code)
+        elif roles == {"suboptimal"}:
+            forced_suboptimal.append(code)
+    return tuple(forced_optimal), tuple(forced_suboptimal), tuple(choice)
+
+
+class Parameters(object):
+    # Everything a simulation run needs (passed to each worker process)
+    __slots__ = ("model", "alpha_range", "beta_range", "discount_k",
+                 "p_collect", "latency_ms", "ITI_duration", "hopper_duration",
+                 "between_session_ITI_duration", "pretraining_sessions",
+                 "training_sessions")
+
+    def __init__(self, model="rw", alpha_range=(0.05, 0.3), beta_range=(1.0, 8.0),
+                 discount_k=0.2, p_collect=0.95, latency_ms=(1500, 0.5),
+                 ITI_duration=10000, hopper_duration=6000,
+                 between_session_ITI_duration=15 * 60 * 1000,
+                 pretraining_sessions=3, training_sessions=20):
+        if model not in MODELS:
+            raise ValueError(f"Unknown model: {model!r} (use one of {MODELS})")
+        self.model = model
+        self.alpha_range = alpha_range # Learning rate, drawn per subject
+        self.beta_range = beta_range # Softmax inverse temperature, drawn per subject
+        self.discount_k = discount_k # Hyperbolic discounting rate (per second)
+        self.p_collect = p_collect # Chance of collecting the second reinforcer
+        self.latency_ms = latency_ms # (median, log-sd) of lognormal peck latencies
+        self.ITI_duration = ITI_duration
+        self.hopper_duration = hopper_duration
+        self.between_session_ITI_duration = between_session_ITI_duration
+        self.pretraining_sessions = pretraining_sessions
+        self.training_sessions = training_sessions
+
+
+def _order_pool(training_phase, experimental_group, size, rng):
+    # A pool of valid trial orders for a phase/group, as a (size x trials)
+    # array of trial codes. Generating an order per subject per session in
+    # Python would dominate the run time, so each session's orders are
+    # drawn from this pool instead.
+    plan = session_plan(training_phase, experimental_group)
+    trial_index = load_protocol().trial_index
+    seeds = rng.integers(0, 2**32, size=size)
+    return np.array([[trial_index[t] for t in generate_sequence(plan.blocks,
+                                                                 max_run = plan.max_run,
+                                                                 seed = int(seed))]
+                     for seed in seeds], dtype=np.int16)
+
+
+def _trial_orders(pool, n_subjects, rng):
+    # One trial order per subject for a session
+    return pool[rng.integers(0, len(pool), size=n_subjects)]
+
+
+def _latencies(params, rng, shape):
+    median, sigma = params.latency_ms
+    return rng.lognormal(np.log(median), sigma, size=shape)
+
+
+def simulate_chunk(experimental_group, n_subjects, params, seed):
+    # Simulates one chunk of subjects of a group (run in a worker process).
+    # Returns (optimal-choice proportion per subject per training session,
+    # session length in minutes per subject per training session).
+    rng = np.random.default_rng(seed)
+    forced_optimal, _, choice = trial_classes(load_protocol())
+    alpha = rng.uniform(*params.alpha_range, size=n_subjects)
+    beta = rng.uniform(*params.beta_range, size=n_subjects)
+    value_optimal = np.zeros(n_subjects)
+    value_suboptimal = np.zeros(n_subjects)
+    # Value of the second reinforcer (the delay to it is roughly a hopper
+    # cycle plus one peck latency)
+    second_delay_s = (params.hopper_duration + params.latency_ms[0]) / 1000
+    if params.model == "discounted":
+        second_value = 1 / (1 + params.discount_k * second_delay_s)
+    else:
+        second_value = 1.0
+
+    pretraining_pool = _order_pool(0, experimental_group, ORDER_POOL_SIZE, rng)
+    training_pool = _order_pool(1, experimental_group, ORDER_POOL_SIZE, rng)
+
+    # Pre-training: every key is reinforced once, so both stimuli gain value
+    for session in range(params.pretraining_sessions):
+        orders = _trial_orders(pretraining_pool, n_subjects, rng)
+        for t in range(orders.shape[1]):
+            optimal_shown = np.isin(orders[:, t], forced_optimal)
+            value_optimal += np.where(optimal_shown, alpha * (1 - value_optimal), 0)
+            value_suboptimal += np.where(~optimal_shown, alpha * (1 - value_suboptimal), 0)
+
+    proportions = np.zeros((n_subjects, params.training_sessions))
+    minutes = np.zeros((n_subjects, params.training_sessions))
+    for session in range(params.training_sessions):
+        orders = _trial_orders(training_pool, n_subjects, rng)
+        n_trials = orders.shape[1]
+        optimal_choices = np.zeros(n_subjects)
+        choice_trials = np.zeros(n_subjects)
+        duration_ms = np.full(n_subjects, params.ITI_duration * n_trials + params.between_session_ITI_duration, dtype=float)
+        for t in range(n_trials):
+            code = orders[:, t]
+            is_choice = np.isin(code, choice)
+            # Choice trials: softmax between the two values
+            p_optimal = 1 / (1 + np.exp(-beta * (value_optimal - value_suboptimal)))
+            chose_optimal = np.where(is_choice,
+                                     rng.random(n_subjects) < p_optimal,
+                                     np.isin(code, forced_optimal))
+            optimal_choices += is_choice & chose_optimal
+            choice_trials += is_choice
+            # The optimal key leaves the suboptimal key up for a second
+            # reinforcer, which is (usually) collected
+            collected = chose_optimal & (rng.random(n_subjects) < params.p_collect)
+            outcome_optimal = 1 + collected * second_value
+            value_optimal += np.where(chose_optimal, alpha * (outcome_optimal - value_optimal), 0)
+            value_suboptimal += np.where(~chose_optimal, alpha * (1 - value_suboptimal), 0)
+            # Time spent: a peck latency and a hopper cycle per reinforcer
+            duration_ms += _latencies(params, rng, n_subjects) + params.hopper_duration
+            duration_ms += np.where(collected, _latencies(params, rng, n_subjects) + params.hopper_duration, 0)
+        with np.errstate(invalid="ignore"):
+            proportions[:, session] = optimal_choices / choice_trials
+        minutes[:, session] = duration_ms / 60000
+    return proportions, minutes
+
+
+def simulate_group(experimental_group, n_subjects, params, workers=None, seed=None):
+    # Simulates n_subjects of a group, split across a process pool
+    workers = workers or cpu_count()
+    chunk_sizes = [n_subjects // workers + (i < n_subjects % workers) for i in range(workers)]
+    chunk_sizes = [n for n in chunk_sizes if n]
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds = seed.spawn(len(chunk_sizes))
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        results = list(pool.map(simulate_chunk,
+                                [experimental_group] * len(chunk_sizes),
+                                chunk_sizes,
+                                [params] * len(chunk_sizes),
+                                seeds))
+    return (np.concatenate([r[0] for r in results]),
+            np.concatenate([r[1] for r in results]))
+
+
+def summarize(proportions, minutes):
+    # Per-session mean, 95% CI of the mean, and 95% band across subjects
+    n = proportions.shape[0]
+    mean = proportions.mean(axis=0)
+    sem = proportions.std(axis=0, ddof=1) / np.sqrt(n)
+    band_low, band_high = np.percentile(proportions, [2.5, 97.5], axis=0)
+    return {"mean": mean,
+            "ci_low": mean - 1.96 * sem,
+            "ci_high": mean + 1.96 * sem,
+            "band_low": band_low,
+            "band_high": band_high,
+            "minutes": minutes.mean(axis=0)}
+
+
+def run(n_subjects, params, groups=None, workers=None, seed=None):
+    # Returns {group: summary} for every group (by default, those in the
+    # protocol)
+    if groups is None:
+        groups = load_protocol().group_names()
+    seeds = np.random.SeedSequence(seed).spawn(len(groups))
+    return {group: summarize(*simulate_group(group, n_subjects, params, workers, group_seed))
+            for group, group_seed in zip(groups, seeds)}
+
+
+def write_summary(summaries, params, file_path):
+    with open(file_path, 'w', newline='') as f:
+        w = writer(f, quoting=QUOTE_MINIMAL)
+        w.writerow(["Group", "Model", "Session", "MeanOptimal", "CILow",
+                    "CIHigh", "BandLow", "BandHigh", "MeanSessionMinutes"])
+        for group, summary in summaries.items():
+            for session in range(len(summary["mean"])):
+                w.writerow([group, params.model, session + 1] +
+                           [round(float(summary[k][session]), 4) for k in
+                            ("mean", "ci_low", "ci_high", "band_low", "band_high", "minutes")])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Monte Carlo predictions of P038 group outcomes")
+    parser.add_argument("--subjects", type=int, default=5000, help="simulated subjects per group")
+    parser.add_argument("--model", choices=MODELS, default="rw")
+    parser.add_argument("--alpha", type=float, nargs=2, default=(0.05, 0.3))
+    parser.add_argument("--beta", type=float, nargs=2, default=(1.0, 8.0))
+    parser.add_argument("--discount-k", type=float, default=0.2)
+    parser.add_argument("--p-collect", type=float, default=0.95)
+    parser.add_argument("--pretraining-sessions", type=int, default=3)
+    parser.add_argument("--training-sessions", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--out", default="P038_monte_carlo.csv")
+    args = parser.parse_args()
+
+    params = Parameters(model = args.model,
+                        alpha_range = tuple(args.alpha),
+                        beta_range = tuple(args.beta),
+                        discount_k = args.discount_k,
+                        p_collect = args.p_collect,
+                        pretraining_sessions = args.pretraining_sessions,
+                        training_sessions = args.training_sessions)
+    summaries = run(args.subjects, params, workers = args.workers, seed = args.seed)
+    write_summary(summaries, params, args.out)
+    for group, summary in summaries.items():
+        print(f"\n{group} group ({args.model}): optimal choice by session")
+        for session, (m, lo, hi) in enumerate(zip(summary["mean"], summary["ci_low"], summary["ci_high"]), 1):
+            print(f"  Session {session:>2}: {m:.3f} [{lo:.3f}, {hi:.3f}]  ~{summary['minutes'][session - 1]:.0f} min")
+    print(f"\n- Learning curves written to {args.out}")
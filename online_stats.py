@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Running choice statistics for P038 sessions.
+
+How a bird did used to only be known after the session, once its .csv was
+opened (or run through session_analysis.py). SessionStats keeps the same
+numbers up to date as the session runs, from the events passed to
+write_data(), with a constant amount of work per event:
+
+    - the proportion of choice trials whose first choice was optimal
+    - the mean and variance of the choice latency (Welford's method)
+    - how often the second reinforcer was collected after an optimal choice
+
+for the whole session and for each sub-session. They are printed on the
+terminal after every trial, shown on the screen in TEST mode, and saved as
+"_summary.csv" next to the data file when the session ends. The definitions
+are the same as in session_analysis.py, so the numbers match (choice trials
+being the protocol's trial types that start with a choice; see
+Protocol.choice_trial_types()).
+"""
+
+from csv import writer, QUOTE_MINIMAL
+from math import sqrt
+
+from protocol import load_protocol
+
+STATS_SUFFIX = "_summary.csv"
+STATS_HEADER = ["Scope", "Trials", "ChoiceTrials", "OptimalChoices",
+               "OptimalProportion", "ChoiceLatencyMean", "ChoiceLatencySD",
+               "OptimalTrials", "SecondReinforcers",
+               "SecondReinforcerProportion", "Reinforcers"]
+
+
+def stats_path_for(csv_path):
+    # The summary sits next to the .csv, with the same name
+    if csv_path.endswith(".csv"):
+        return csv_path[:-4] + STATS_SUFFIX
+    return csv_path + STATS_SUFFIX
+
+
+class RunningMean(object):
+    # Mean and variance, updated one value at a time (Welford's method)
+    __slots__ = ("n", "mean", "_m2")
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        # Sample variance (None until there are two values)
+        return self._m2 / (self.n - 1) if self.n > 1 else None
+
+    @property
+    def sd(self):
+        variance = self.variance
+        return None if variance is None else sqrt(variance)
+
+
+class ChoiceStats(object):
+    # The running numbers of one scope (the session, or a sub-session)
+    __slots__ = ("trials", "choice_trials", "optimal_choices", "latency",
+                 "optimal_trials", "second_reinforcers", "reinforcers")
+
+    def __init__(self):
+        self.trials = 0 # Trials with at least one event
+        self.choice_trials = 0 # Choice trials with a choice made
+        self.optimal_choices = 0 # ...whose first choice was optimal
+        self.latency = RunningMean() # Of the first choice on choice trials (s)
+        self.optimal_trials = 0 # Trials (any type) whose first choice was optimal
+        self.second_reinforcers = 0 # ...where the second reinforcer was collected
+        self.reinforcers = 0
+
+    @property
+    def optimal_proportion(self):
+        return self.optimal_choices / self.choice_trials if self.choice_trials else None
+
+    @property
+    def second_reinforcer_proportion(self):
+        return self.second_reinforcers / self.optimal_trials if self.optimal_trials else None
+
+    def row(self, scope):
+        def rounded(value):
+            return "NA" if value is None else round(value, 4)
+        return [scope, self.trials, self.choice_trials, self.optimal_choices,
+                rounded(self.optimal_proportion), rounded(self.latency.mean if self.latency.n else None),
+                rounded(self.latency.sd), self.optimal_trials, self.second_reinforcers,
+                rounded(self.second_reinforcer_proportion), self.reinforcers]
+
+
+class SessionStats(object):
+    def __init__(self, trials_per_subsession=None, choice_trial_types=None):
+        self.trials_per_subsession = trials_per_subsession
+        if choice_trial_types is None:
+            choice_trial_types = load_protocol().choice_trial_types()
+        self.choice_trial_types = choice_trial_types
+        self.session = ChoiceStats()
+        self.subsessions = [] # ChoiceStats of each sub-session so far
+        # State of the current trial
+        self._trial = None
+        self._chosen = False # Has the first choice been made?
+        self._optimal_first = False # ...and was it optimal?
+        self._trial_reinforcers = 0
+
+    def _scopes(self, trial_num):
+        # The session's stats and those of the trial's sub-session
+        if not self.trials_per_subsession or trial_num < 1:
+            return (self.session,)
+        index = (trial_num - 1) // self.trials_per_subsession
+        while len(self.subsessions) <= index:
+            self.subsessions.append(ChoiceStats())
+        return (self.session, self.subsessions[index])
+
+    def event(self, outcome, trial_num, trial_type, trial_time_s):
+        # Updates every number with one event (as logged by write_data())
+        if trial_num != self._trial:
+            self._trial = trial_num
+            self._chosen = self._optimal_first = False
+            self._trial_reinforcers = 0
+            if trial_num >= 1:
+                for scope in self._scopes(trial_num):
+                    scope.trials += 1
+        if outcome == "optimal_peck" or outcome == "suboptimal_peck":
+            if not self._chosen: # Only the first choice of a trial counts
+                self._chosen = True
+                self._optimal_first = outcome == "optimal_peck"
+                for scope in self._scopes(trial_num):
+                    if trial_type in self.choice_trial_types:
+                        scope.choice_trials += 1
+                        scope.optimal_choices += self._optimal_first
+                        scope.latency.add(trial_time_s)
+                    scope.optimal_trials += self._optimal_first
+        elif outcome == "reinforcer_provided":
+            self._trial_reinforcers += 1
+            for scope in self._scopes(trial_num):
+                scope.reinforcers += 1
+                if self._optimal_first and self._trial_reinforcers == 2:
+                    scope.second_reinforcers += 1
+
+    def add_rows(self, rows):
+        # Catches up on rows in the session .csv layout (e.g., those of a
+        # session being resumed)
+        for row in rows:
+            self.event(row[3], int(row[8]), row[6], float(row[7]))
+
+    def text(self, subsession=True):
+        # One line of the numbers so far (and of the current sub-session)
+        def line(stats):
+            if stats.choice_trials:
+                choice = f"optimal {stats.optimal_choices}/{stats.choice_trials} ({stats.optimal_proportion:.0%})"
+            else:
+                choice = "no choices yet"
+            if stats.latency.n:
+                sd = f" ± {stats.latency.sd:.2f}" if stats.latency.sd is not None else ""
+                choice += f", latency {stats.latency.mean:.2f}{sd} s"
+            if stats.optimal_trials:
+                choice += f", 2nd SR {stats.second_reinforcers}/{stats.optimal_trials}"
+            return choice
+        text = f"Session: {line(self.session)}"
+        if subsession and len(self.subsessions) > 1:
+            text += f"\nSub-session {len(self.subsessions)}: {line(self.subsessions[-1])}"
+        return text
+
+    def rows(self):
+        # Summary rows: the session, then each sub-session
+        return [self.session.row("session")] + \
+            [stats.row(f"subsession_{i}") for i, stats in enumerate(self.subsessions, start = 1)]
+
+    def write_summary(self, file_path):
+        with open(file_path, 'w', newline='') as f:
+            w = writer(f, quoting=QUOTE_MINIMAL)
+            w.writerow(STATS_HEADER)
+            w.writerows(self.rows())
+        return file_path
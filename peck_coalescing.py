@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Optional coalescing of non-contingent pecks for P038 sessions.
+
+Every peck used to get its own row in the session .csv and its own line on
+the terminal, including pecks to the blank/dark screen (ITI_peck,
+background_peck, hopper_up_peck, between-session_ITI_peck) that have no
+consequences. Some birds make hundreds of those per session.
+
+When coalescing is turned on for an event type (see coalesce_pecks in the
+main program), the PeckCoalescer below collects that type's pecks into
+windows instead: a window starts with a peck and takes in every later peck
+of the same type for the next window_ms, as long as the trial, key states
+and reinforcer count stay the same. Each window is then written as ONE row
+of a summary file that sits next to the session's .csv
+("_coalesced.csv"), holding its number of pecks, the times of its first and
+last peck, and the bounding box of their coordinates. Key pecks, reinforcers
+and every other event are still written to the .csv in full, and the
+session's binary event store (.evt) always keeps every single peck.
+
+This module can also be run from the command line to expand a session's
+summaries back into one row per peck, merged in time order with the
+session's full rows, and to check the summaries against the .evt. The pecks
+of a window are spread evenly between its first and last peck; the first
+and last are put at opposite corners of its bounding box and the rest at
+its centre, so the expanded rows have the same count, times and bounding
+box as the summary:
+
+    python peck_coalescing.py <session file>.csv [--out <output>.csv] [--verify]
+"""
+
+from csv import reader, writer, QUOTE_MINIMAL
+from datetime import timedelta
+from os import path as os_path
+
+from event_store import CSV_HEADER, EventStore, binary_path_for, NA_COORD, \
+    session_microseconds
+from session_recorder import SessionRecorder
+
+# The only events that can be coalesced (everything else is contingent)
+NON_CONTINGENT = ("ITI_peck", "background_peck", "hopper_up_peck",
+                  "between-session_ITI_peck")
+SUMMARY_SUFFIX = "_coalesced.csv"
+SUMMARY_HEADER = ["LocationEvent", "Count",
+                  "FirstSessionTime", "LastSessionTime",
+                  "FirstTrialTime", "LastTrialTime",
+                  "XMin", "YMin", "XMax", "YMax",
+                  "LeftKey", "RightKey", "TrialType", "TrialNum",
+                  "ReinforcersProvided", "Date"]
+
+
+def summary_path_for(csv_path):
+    # The summary file sits next to the .csv, with the same name
+    if csv_path.endswith(".csv"):
+        return csv_path[:-4] + SUMMARY_SUFFIX
+    return csv_path + SUMMARY_SUFFIX
+
+
+def parse_windows(windows):
+    # Checks a {event type: window in ms} setting and returns it as a dict
+    windows = dict(windows or {})
+    for event_type, window_ms in windows.items():
+        if event_type not in NON_CONTINGENT:
+            raise ValueError(f"{event_type!r} can't be coalesced (only {', '.join(NON_CONTINGENT)} can)")
+        if not isinstance(window_ms, int) or isinstance(window_ms, bool) or window_ms <= 0:
+            raise ValueError(f"The window for {event_type} should be a positive number of ms, not {window_ms!r}")
+    return windows
+
+
+class _Window(object):
+    # The pecks of one event type being collected into one summary row
+    __slots__ = ("row", "first_us", "context", "count", "last_row",
+                 "x_min", "y_min", "x_max", "y_max")
+
+    def __init__(self, row, session_us):
+        self.row = row # First peck's row
+        self.first_us = session_us
+        self.context = (row[4], row[5], row[6], row[8], row[9])
+        self.count = 1
+        self.last_row = row
+        self.x_min = self.x_max = row[1]
+        self.y_min = self.y_max = row[2]
+
+    def add(self, row):
+        self.count += 1
+        self.last_row = row
+        self.x_min = min(self.x_min, row[1])
+        self.x_max = max(self.x_max, row[1])
+        self.y_min = min(self.y_min, row[2])
+        self.y_max = max(self.y_max, row[2])
+
+    def summary(self):
+        first, last = self.row, self.last_row
+        return [first[3], self.count, first[0], last[0], first[7], last[7],
+                self.x_min, self.y_min, self.x_max, self.y_max,
+                first[4], first[5], first[6], first[8], first[9], first[14]]
+
+
+class PeckCoalescer(object):
+    # Lives on the event logger's writer thread (see event_logger.py), which
+    # offers it every row before writing it to the .csv
+    def __init__(self, file_path, windows, flush_policy="trial", fsync=False,
+                 mode="w", echo=True):
+        self.windows = parse_windows(windows)
+        self.echo = echo
+        self.coalesced = 0 # Pecks taken out of the .csv
+        self._open = {} # event type -> _Window
+        self.recorder = SessionRecorder(file_path,
+                                        header = SUMMARY_HEADER if mode == "w" else None,
+                                        flush_policy = flush_policy,
+                                        fsync = fsync,
+                                        mode = mode)
+
+    @property
+    def file_path(self):
+        return self.recorder.file_path
+
+    def add(self, row, session_us):
+        # Takes the row into a window (and returns True) if its event type
+        # is coalesced; otherwise returns False and the row is written as is
+        window_ms = self.windows.get(row[3])
+        if window_ms is None or not isinstance(row[1], int):
+            return False
+        window = self._open.get(row[3])
+        if window is not None and (session_us - window.first_us >= window_ms * 1000
+                                   or (row[4], row[5], row[6], row[8], row[9]) != window.context):
+            self._write(window)
+            window = None
+        if window is None:
+            self._open[row[3]] = _Window(row, session_us)
+        else:
+            window.add(row)
+        self.coalesced += 1
+        return True
+
+    def _write(self, window):
+        del self._open[window.row[3]]
+        summary = window.summary()
+        self.recorder.write_row(summary)
+        if self.echo:
+            print(f"{summary[0]:>30} | x{summary[1]:<4} ({summary[6]}-{summary[8]}, {summary[7]}-{summary[9]}) | {summary[2]} - {summary[3]} | {summary[12]}")
+
+    def write_windows(self):
+        # Writes every window collected so far (even if it isn't over yet)
+        for window in list(self._open.values()):
+            self._write(window)
+
+    def end_trial(self):
+        self.write_windows()
+        self.recorder.end_trial()
+
+    def close(self):
+        self.write_windows()
+        self.recorder.close()
+
+
+def read_summaries(summary_path):
+    with open(summary_path, 'r', newline='') as f:
+        rows = reader(f)
+        next(rows, None) # Header
+        return [row for row in rows if row]
+
+
+def expand_summary(summary, constants):
+    # One .csv row per peck of a summary row. constants are the
+    # ITIDuration, Subject, Condition and TrainingPhase of the session.
+    count = int(summary[1])
+    first_us = session_microseconds(summary[2])
+    last_us = session_microseconds(summary[3])
+    first_trial_time, last_trial_time = float(summary[4]), float(summary[5])
+    x_min, y_min, x_max, y_max = (int(value) for value in summary[6:10])
+    rows = []
+    for i in range(count):
+        fraction = i / (count - 1) if count > 1 else 0
+        if i == 0:
+            x, y = x_min, y_min
+        elif i == count - 1:
+            x, y = x_max, y_max
+        else:
+            x, y = round((x_min + x_max) / 2), round((y_min + y_max) / 2)
+        rows.append([str(timedelta(microseconds = round(first_us + (last_us - first_us) * fraction))),
+                     x, y, summary[0], summary[10], summary[11], summary[12],
+                     round(first_trial_time + (last_trial_time - first_trial_time) * fraction, 5),
+                     summary[13], summary[14], *constants, summary[15]])
+    return rows
+
+
+def read_session_rows(csv_path):
+    # Every data row of a session .csv, with any coalesced pecks expanded
+    # back into rows and merged in (by SessionTime)
+    with open(csv_path, 'r', newline='') as f:
+        rows = [row for row in reader(f)][1:]
+    summary_path = summary_path_for(csv_path)
+    if not os_path.isfile(summary_path) or not rows:
+        return rows
+    constants = rows[0][10:14]
+    expanded = [row for summary in read_summaries(summary_path)
+                for row in expand_summary(summary, constants)]
+    # Full rows go first among rows with the same time
+    merged = [(session_microseconds(row[0]), 0, i, row) for i, row in enumerate(rows)]
+    merged += [(session_microseconds(row[0]), 1, i, row) for i, row in enumerate(expanded)]
+    merged.sort(key = lambda item: item[:3])
+    return [[str(value) for value in item[3]] for item in merged]
+
+
+def verify(csv_path):
+    # Checks the .csv and its summaries against the session's .evt (which
+    # keeps every peck). Returns a list of problems (empty if they match).
+    store = EventStore.load(binary_path_for(csv_path))
+    c = store.columns
+    problems = []
+    with open(csv_path, 'r', newline='') as f:
+        full_rows = len([row for row in reader(f)]) - 1
+    summaries = read_summaries(summary_path_for(csv_path))
+    total = full_rows + sum(int(summary[1]) for summary in summaries)
+    if total != len(store):
+        problems.append(f"{total} rows after expanding, but {len(store)} events in the .evt")
+    for line_number, summary in enumerate(summaries, start = 2):
+        event = store.event_types.code(summary[0])
+        trial = int(summary[13])
+        first_us, last_us = session_microseconds(summary[2]), session_microseconds(summary[3])
+        pecks = [i for i in range(len(store))
+                 if c["event"][i] == event and c["trial_num"][i] == trial
+                 and first_us <= c["session_us"][i] <= last_us and c["x"][i] != NA_COORD]
+        box = [min(c["x"][i] for i in pecks), min(c["y"][i] for i in pecks),
+               max(c["x"][i] for i in pecks), max(c["y"][i] for i in pecks)] if pecks else None
+        if len(pecks) != int(summary[1]):
+            problems.append(f"line {line_number}: {summary[1]} {summary[0]}(s), but {len(pecks)} in the .evt")
+        elif box != [int(value) for value in summary[6:10]]:
+            problems.append(f"line {line_number}: bounding box {summary[6:10]}, but {box} in the .evt")
+    return problems
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Expand (and check) the coalesced pecks of a P038 session")
+    parser.add_argument("data_file", help="the session's .csv")
+    parser.add_argument("--out", default=None, help="expanded .csv (default: <data file>_expanded.csv)")
+    parser.add_argument("--verify", action="store_true", help="check the summaries against the session's .evt")
+    args = parser.parse_args()
+
+    output_path = args.out or args.data_file[:-4] + "_expanded.csv"
+    rows = read_session_rows(args.data_file)
+    with open(output_path, 'w', newline='') as f:
+        w = writer(f, quoting=QUOTE_MINIMAL)
+        w.writerow(CSV_HEADER)
+        w.writerows(rows)
+    print(f"- {len(rows)} rows written to {output_path}")
+    if args.verify:
+        problems = verify(args.data_file)
+        for problem in problems:
+            print(f"  {problem}")
+        print("- Summaries match the .evt" if not problems else f"- {len(problems)} problem(s) found")
+        if problems:
+            raise SystemExit(1)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of P038 sessions.
+
+With profiling turned on (profile_sessions at the top of the program), the
+SessionProfiler:
+
+    - wraps MainScreen's hot paths (build_keys, key_press, provide_food,
+      write_data, write_comp_data, clear_canvas, ITI) with timers that keep
+      a histogram of how long each call took
+    - records how late every session clock callback fires (the root.after()
+      timers behind the ITI, key, and hopper phases)
+    - runs a heartbeat timer that measures Tk event-loop lag
+    - tracks memory with tracemalloc, sampling the traced total with each
+      heartbeat and comparing allocation snapshots from the start and end of
+      the session
+
+Histograms use power-of-two microsecond buckets, so a timed call only costs
+two clock reads and a couple of integer operations. At the end of the
+session the summary (counts, mean/percentile/max times, lag, memory growth
+and its top sources) is written next to the data file as "_profile.json" and
+a short table is printed to the terminal.
+"""
+
+from functools import wraps
+from json import dump
+from time import perf_counter_ns
+import tracemalloc
+
+HOT_PATHS = ("build_keys", "key_press", "provide_food", "write_data",
+             "write_comp_data", "clear_canvas", "ITI")
+HEARTBEAT_MS = 250
+MEMORY_SAMPLE_EVERY = 40 # heartbeats (i.e., every 10 s)
+N_BUCKETS = 40
+
+
+class Histogram(object):
+    # Durations in power-of-two microsecond buckets: bucket i holds values
+    # below 2**i us (bucket 0 is < 1 us)
+    __slots__ = ("counts", "n", "total_ns", "max_ns")
+
+    def __init__(self):
+        self.counts = [0] * N_BUCKETS
+        self.n = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, duration_ns):
+        us = duration_ns // 1000
+        self.counts[min(us.bit_length() if us > 0 else 0, N_BUCKETS - 1)] += 1
+        self.n += 1
+        self.total_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    def percentile_us(self, p):
+        # Upper edge of the bucket holding the p-th percentile
+        if not self.n:
+            return None
+        target = p / 100 * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return 2 ** i
+        return 2 ** (N_BUCKETS - 1)
+
+    def summary(self):
+        return {"calls": self.n,
+                "total_ms": round(self.total_ns / 1e6, 3),
+                "mean_us": round(self.total_ns / self.n / 1000, 2) if self.n else None,
+                "p50_us": self.percentile_us(50),
+                "p95_us": self.percentile_us(95),
+                "p99_us": self.percentile_us(99),
+                "max_us": round(self.max_ns / 1000, 2),
+                "buckets_us": {f"<{2 ** i}": c for i, c in enumerate(self.counts) if c}}
+
+
+class SessionProfiler(object):
+    def __init__(self, time_source=perf_counter_ns, trace_memory=True):
+        self.time_source = time_source
+        self.trace_memory = trace_memory
+        self.timings = {} # name -> Histogram
+        self.memory = [] # (session seconds, traced bytes, peak bytes)
+        self._first_snapshot = None
+        self._clock = None
+        self._heartbeats = 0
+        self._started_tracemalloc = False
+
+    def histogram(self, name):
+        if name not in self.timings:
+            self.timings[name] = Histogram()
+        return self.timings[name]
+
+    def wrap(self, obj, method_names=HOT_PATHS):
+        # Replaces each method on the instance with a timed version. Needs to
+        # be done before the methods are handed out as callbacks.
+        for name in method_names:
+            setattr(obj, name, self.timed(name, getattr(obj, name)))
+
+    def timed(self, name, function):
+        histogram = self.histogram(name)
+        time_source = self.time_source
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time_source()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.add(time_source() - start)
+        return timed_function
+
+    def start(self, clock):
+        # Called once the session starts: hooks into the session clock's
+        # callbacks, starts the lag heartbeat and memory tracing
+        self._clock = clock
+        lateness = self.histogram("after_lateness")
+        clock.lateness_hook = lambda late_ns: lateness.add(max(0, late_ns))
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            self._first_snapshot = tracemalloc.take_snapshot()
+            self._sample_memory()
+        lag = self.histogram("event_loop_lag")
+        def beat():
+            deadline = clock.anchor()
+            lag.add(max(0, clock.now_ns() - deadline))
+            self._heartbeats += 1
+            if self.trace_memory and self._heartbeats % MEMORY_SAMPLE_EVERY == 0:
+                self._sample_memory()
+            clock.after(deadline, HEARTBEAT_MS, beat)
+        clock.after(clock.now_ns(), HEARTBEAT_MS, beat)
+
+    def _sample_memory(self):
+        current, peak = tracemalloc.get_traced_memory()
+        elapsed_s = self._clock.elapsed_ns() / 1e9 if self._clock else 0.0
+        self.memory.append((round(elapsed_s, 3), current, peak))
+
+    def summary(self, top=10):
+        result = {"timings": {name: h.summary() for name, h in sorted(self.timings.items())}}
+        if self.trace_memory and self._first_snapshot is not None and tracemalloc.is_tracing():
+            self._sample_memory()
+            growth = tracemalloc.take_snapshot().compare_to(self._first_snapshot, "lineno")
+            result["memory"] = {
+                "samples": [{"session_s": t, "traced_bytes": c, "peak_bytes": p} for t, c, p in self.memory],
+                "growth_bytes": self.memory[-1][1] - self.memory[0][1],
+                "top_growth": [{"where": str(stat.traceback), "size_diff_bytes": stat.size_diff,
+                                "count_diff": stat.count_diff} for stat in growth[:top]]}
+        return result
+
+    def write_summary(self, file_path):
+        summary = self.summary()
+        with open(file_path, 'w', encoding='utf-8') as f:
+            dump(summary, f, indent=2)
+        return summary
+
+    def print_summary(self, summary=None):
+        summary = summary or self.summary()
+        print(f"\n{'Profile':>20} | {'Calls':>7} | {'Mean us':>8} | {'p95 us':>7} | {'Max us':>9}")
+        for name, s in summary["timings"].items():
+            if s["calls"]:
+                print(f"{name:>20} | {s['calls']:>7} | {s['mean_us']:>8} | {s['p95_us']:>7} | {s['max_us']:>9}")
+        if "memory" in summary:
+            print(f"{'memory growth':>20} | {summary['memory']['growth_bytes'] / 1024:.1f} KiB")
+
+    def stop(self):
+        if self._clock is not None:
+            self._clock.lateness_hook = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The P038 protocol (P038_Protocol.json), checked and compiled into tables.
+
+What happens in each phase used to be spread across the main program as
+tests on the trial type's name ("L" in the trial type, "choice" not in the
+trial type, "LO" in the trial type and "left" in the key...), which were run
+again on every key presentation and every peck. Adding a phase meant
+editing first_ITI(), build_keys() and key_press() together.
+
+The protocol file instead spells it all out:
+
+    - keys: the keys on the screen (as in MainScreen's key_coordinates)
+    - roles: what a key can stand for (each has a color in the settings sheet)
+    - trial_types: for each trial type, the keys shown at each stage of the
+      trial and their roles. A trial starts at stage 0; e.g., after an
+      optimal choice, stage 1 leaves only the suboptimal key up.
+    - phases: for each phase, its contingencies (for a peck to a key of
+      each role: the event logged, whether it is reinforced, and whether the
+      trial then moves on to its next stage or ends) and its sessions (the
+      number of sub-sessions, the trials in each, the longest allowed run of
+      one trial type, whether there is a rest between sub-sessions, and
+      when the session ends), either for every group ("session") or for
+      each group ("groups").
+
+A session ends as soon as any of its caps is reached: "trials" (by default,
+one pass through its sub-sessions), "minutes" (90 by default) or
+"reinforcers" (none by default). Any of them can be set, or turned off with
+null, as long as one is left. With a trial cap above one pass, the session
+goes through its sub-sessions again (with a new trial order each pass).
+
+When it is loaded, every problem with the file is raised together as a
+ProtocolError, before a session starts. It is then compiled into tables
+indexed by integers, so that working out which keys to show (and what a
+peck to one of them does) is a lookup:
+
+    phase.layouts[trial type][stage] -> role of each key (None if hidden)
+    phase.outcomes[trial type][stage][key] -> Outcome(event, reinforce, next_stage)
+
+A new phase (or trial type) is only a matter of editing the protocol file.
+"""
+
+from collections import namedtuple
+from json import loads
+from os import path as os_path
+
+from trial_sequences import SessionPlan, generate_sequence
+
+PROTOCOL_PATH = os_path.join(os_path.dirname(os_path.abspath(__file__)),
+                             "P038_Protocol.json")
+PROTOCOL_VERSION = 1
+THEN = ("next_stage", "end_trial")
+DEFAULT_SESSION_MINUTES = 90
+
+# What a peck to a shown key does (next_stage is None if the trial ends)
+Outcome = namedtuple("Outcome", ["event", "reinforce", "next_stage"])
+# When a session ends (None: no cap)
+SessionCaps = namedtuple("SessionCaps", ["trials", "minutes", "reinforcers"])
+
+_loaded = {} # file path -> Protocol
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def _is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+class PhaseTables(object):
+    # The compiled tables of one phase
+    __slots__ = ("number", "name", "layouts", "outcomes", "plans", "caps")
+
+    def __init__(self, number, name, layouts, outcomes, plans, caps):
+        self.number = number
+        self.name = name
+        self.layouts = layouts # [trial type][stage] -> (role or None of each key)
+        self.outcomes = outcomes # [trial type][stage][key] -> Outcome or None (None for unused trial types)
+        self.plans = plans # group (or None, for every group) -> SessionPlan
+        self.caps = caps # group (or None, for every group) -> SessionCaps
+
+    def _group(self, experimental_group):
+        if None in self.plans:
+            return None
+        if experimental_group not in self.plans:
+            raise ValueError(f"Unknown experimental group: {experimental_group!r}")
+        return experimental_group
+
+    def session_plan(self, experimental_group=None):
+        return self.plans[self._group(experimental_group)]
+
+    def session_caps(self, experimental_group=None):
+        return self.caps[self._group(experimental_group)]
+
+
+class Protocol(object):
+    def __init__(self, spec, source="protocol"):
+        # Checks the (parsed) protocol and compiles it. Raises a
+        # ProtocolError listing every problem found.
+        self.source = source
+        problems = []
+        if not isinstance(spec, dict):
+            raise ProtocolError(f"{source}: should be a JSON object")
+        if spec.get("version") != PROTOCOL_VERSION:
+            problems.append(f"unknown version {spec.get('version')!r} (expected {PROTOCOL_VERSION})")
+        self.keys = self._names(spec, "keys", problems)
+        self.roles = self._names(spec, "roles", problems)
+        self.key_index = {key: k for k, key in enumerate(self.keys)}
+
+        # Trial types: the role of each key at each stage
+        self.trial_types = []
+        self.stages = [] # [trial type] -> [stage] -> (role or None of each key)
+        trial_types = spec.get("trial_types")
+        if not isinstance(trial_types, dict) or not trial_types:
+            problems.append("trial_types should map each trial type to its stages")
+            trial_types = {}
+        for trial_type, stages in trial_types.items():
+            if not isinstance(stages, list) or not stages:
+                problems.append(f"trial type {trial_type}: should be a list of stages")
+                stages = []
+            layouts = []
+            for s, stage in enumerate(stages):
+                where = f"trial type {trial_type}, stage {s}"
+                if not isinstance(stage, dict) or not stage:
+                    problems.append(f"{where}: should map the keys shown to their roles")
+                    stage = {}
+                for key, role in stage.items():
+                    if key not in self.key_index:
+                        problems.append(f"{where}: unknown key {key!r}")
+                    if role not in self.roles:
+                        problems.append(f"{where}: unknown role {role!r}")
+                layouts.append(tuple(stage.get(key) for key in self.keys))
+            self.trial_types.append(trial_type)
+            self.stages.append(layouts)
+        self.trial_index = {trial_type: t for t, trial_type in enumerate(self.trial_types)}
+
+        phases = spec.get("phases")
+        if not isinstance(phases, list) or not phases:
+            problems.append("phases should be a list of phases")
+            phases = []
+        self.phases = [self._compile_phase(number, phase, problems)
+                       for number, phase in enumerate(phases)]
+        if problems:
+            raise ProtocolError(f"{source}:\n  " + "\n  ".join(problems))
+
+    def _names(self, spec, field, problems):
+        names = spec.get(field)
+        if (not isinstance(names, list) or not names or len(set(names)) != len(names)
+                or not all(isinstance(name, str) for name in names)):
+            problems.append(f"{field} should be a list of different names")
+            return []
+        return names
+
+    def _compile_phase(self, number, phase, problems):
+        where = f"phase {number}"
+        if not isinstance(phase, dict):
+            problems.append(f"{where}: should be a JSON object")
+            phase = {}
+        name = phase.get("name")
+        if not isinstance(name, str) or not name:
+            problems.append(f"{where}: has no name")
+        where = f"phase {number} ({name})"
+
+        # What a peck to a key of each role does
+        contingencies = phase.get("contingencies")
+        if not isinstance(contingencies, dict):
+            problems.append(f"{where}: contingencies should map each role to what a peck does")
+            contingencies = {}
+        rules = {}
+        for role in self.roles:
+            rule = contingencies.get(role)
+            if not isinstance(rule, dict):
+                problems.append(f"{where}: no contingency for {role} keys")
+                continue
+            event, reinforce, then = rule.get("event"), rule.get("reinforce", True), rule.get("then")
+            try:
+                event.format(key = "")
+            except (AttributeError, KeyError, IndexError, ValueError):
+                problems.append(f"{where}, {role}: event should be a name (which may contain {{key}})")
+                continue
+            if not isinstance(reinforce, bool):
+                problems.append(f"{where}, {role}: reinforce should be true or false")
+            if then not in THEN:
+                problems.append(f"{where}, {role}: then should be one of {', '.join(THEN)}")
+            rules[role] = (event, reinforce, then)
+        for role in contingencies:
+            if role not in self.roles:
+                problems.append(f"{where}: contingency for unknown role {role!r}")
+
+        # Its sessions
+        if ("session" in phase) == ("groups" in phase):
+            problems.append(f"{where}: should have either a session (for every group) or groups")
+            sessions = {}
+        elif "session" in phase:
+            sessions = {None: phase["session"]}
+        elif isinstance(phase["groups"], dict) and phase["groups"]:
+            sessions = phase["groups"]
+        else:
+            problems.append(f"{where}: groups should map each group to its session")
+            sessions = {}
+        plans, caps = {}, {}
+        used = set()
+        for group, session in sessions.items():
+            compiled = self._compile_session(session, where if group is None else f"{where}, {group}", problems)
+            if compiled is not None:
+                plans[group], caps[group] = compiled
+                used.update(plans[group].blocks[0])
+
+        # Then the tables. Every stage a peck can lead to has to exist.
+        layouts, outcomes = [], []
+        for t, trial_type in enumerate(self.trial_types):
+            stages = self.stages[t]
+            layouts.append(stages)
+            if trial_type not in used:
+                outcomes.append(None)
+                continue
+            table = []
+            for s, roles in enumerate(stages):
+                row = []
+                for key, role in zip(self.keys, roles):
+                    if role is None or role not in rules:
+                        row.append(None)
+                        continue
+                    event, reinforce, then = rules[role]
+                    next_stage = None
+                    if then == "next_stage":
+                        next_stage = s + 1
+                        if next_stage >= len(stages):
+                            problems.append(f"{where}: a peck to the {role} key at stage {s} of "
+                                            f"{trial_type} leads to a stage it doesn't have")
+                    row.append(Outcome(event.format(key = key), reinforce, next_stage))
+                table.append(tuple(row))
+            outcomes.append(table)
+        return PhaseTables(number, name, layouts, outcomes, plans, caps)
+
+    def _compile_session(self, session, where, problems):
+        if not isinstance(session, dict):
+            problems.append(f"{where}: the session should be a JSON object")
+            return None
+        subsessions = session.get("subsessions", 1)
+        trials = session.get("trials")
+        max_run = session.get("max_run")
+        rest = session.get("rest_between_subsessions", False)
+        ok = True
+        if not _is_count(subsessions):
+            problems.append(f"{where}: subsessions should be a positive whole number")
+            ok = False
+        if not isinstance(trials, dict) or not trials:
+            problems.append(f"{where}: trials should map trial types to how many of each a sub-session has")
+            return None
+        for trial_type, n in trials.items():
+            if trial_type not in self.trial_index:
+                problems.append(f"{where}: unknown trial type {trial_type!r}")
+                ok = False
+            if not _is_count(n):
+                problems.append(f"{where}: the number of {trial_type} should be a positive whole number")
+                ok = False
+        if max_run is not None and not _is_count(max_run):
+            problems.append(f"{where}: max_run should be a positive whole number (or null)")
+            ok = False
+        if not isinstance(rest, bool):
+            problems.append(f"{where}: rest_between_subsessions should be true or false")
+            ok = False
+        session_caps = session.get("caps", {})
+        if not isinstance(session_caps, dict):
+            problems.append(f"{where}: caps should be a JSON object")
+            session_caps = {}
+        for cap in session_caps:
+            if cap not in SessionCaps._fields:
+                problems.append(f"{where}: unknown cap {cap!r}")
+                ok = False
+        minutes = session_caps.get("minutes", DEFAULT_SESSION_MINUTES)
+        if minutes is not None and (isinstance(minutes, bool) or not isinstance(minutes, (int, float))
+                                    or minutes <= 0):
+            problems.append(f"{where}: the minutes cap should be a positive number (or null)")
+            ok = False
+        for cap in ("trials", "reinforcers"):
+            value = session_caps.get(cap)
+            if value is not None and not _is_count(value):
+                problems.append(f"{where}: the {cap} cap should be a positive whole number (or null)")
+                ok = False
+        if all(session_caps.get(cap, 0) is None for cap in ("trials", "minutes")) and \
+                session_caps.get("reinforcers") is None:
+            problems.append(f"{where}: every cap is turned off, so the session would never end")
+            ok = False
+        if not ok:
+            return None
+        # Each trial type's trials, in the order given (the order the trial
+        # order generator counts them in, so seeds give the same orders)
+        block = [trial_type for trial_type, n in trials.items() for _ in range(n)]
+        blocks = [list(block) for _ in range(subsessions)]
+        try:
+            generate_sequence(blocks, max_run = max_run, seed = 0)
+        except ValueError as e:
+            problems.append(f"{where}: {e}")
+            return None
+        plan = SessionPlan(len(block) * subsessions, len(block), blocks, max_run, rest)
+        trials = session_caps["trials"] if "trials" in session_caps else plan.trials_per_session
+        return plan, SessionCaps(trials, minutes, session_caps.get("reinforcers"))
+
+    def phase(self, training_phase):
+        if not isinstance(training_phase, int) or not 0 <= training_phase < len(self.phases):
+            raise ValueError(f"Unknown training phase: {training_phase!r}")
+        return self.phases[training_phase]
+
+    def phase_names(self):
+        # As listed in the control panel, e.g. "0: Pre-Training"
+        return [f"{phase.number}: {phase.name}" for phase in self.phases]
+
+    def group_names(self):
+        # The experimental groups (those with their own sessions in any
+        # phase), in the order they first appear
+        names = []
+        for phase in self.phases:
+            names.extend(group for group in phase.plans if group is not None and group not in names)
+        return names
+
+    def starting_roles(self, trial_type):
+        # The roles of the keys shown when a trial of this type starts
+        return {role for role in self.stages[self.trial_index[trial_type]][0] if role is not None}
+
+    def choice_trial_types(self):
+        # The trial types that start with a choice between an optimal and a
+        # suboptimal key (how the analyses tell choice trials from forced ones)
+        return frozenset(trial_type for trial_type in self.trial_types
+                         if self.starting_roles(trial_type) == {"optimal", "suboptimal"})
+
+    def session_caps(self, training_phase, experimental_group=None):
+        return self.phase(training_phase).session_caps(experimental_group)
+
+    def session_plan(self, training_phase, experimental_group=None, max_run=None):
+        # The block (sub-session) structure of a session. max_run, if
+        # given, replaces the protocol's run limit (unless it has none).
+        plan = self.phase(training_phase).session_plan(experimental_group)
+        if max_run is not None and plan.max_run is not None:
+            plan = plan._replace(max_run = max_run)
+        return plan._replace(blocks = [list(block) for block in plan.blocks])
+
+
+def load_protocol(file_path=PROTOCOL_PATH):
+    # Reads, checks and compiles a protocol file (once per file)
+    if file_path not in _loaded:
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                spec = loads(f.read())
+        except (OSError, ValueError) as e:
+            raise ProtocolError(f"{file_path}: {e}") from None
+        _loaded[file_path] = Protocol(spec, file_path)
+    return _loaded[file_path]
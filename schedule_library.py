@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline library of precomputed P038 trial schedules.
+
+Trial orders are normally generated live once the space bar is pressed,
+which means nobody can look over (or reuse) a session's schedule ahead of
+time. This module precomputes the trial schedules of every subject in the
+settings .csv for each phase across a number of days, checks every one of
+them, and saves them in an indexed library on disk. When a session starts,
+first_ITI() looks up the schedule for that subject, phase, and date and only
+falls back to generating one live if none was precomputed.
+
+Building is done from the command line (subjects are split across a pool of
+processes, one per core by default):
+
+    python schedule_library.py build --days 30
+    python schedule_library.py build --days 10 --start 2023-07-10 --phases 1
+    python schedule_library.py show B1 1 2023-07-10
+
+Each schedule's seed is derived from its subject, phase and date, so
+rebuilding the library always gives the same schedules. Validation uses
+NumPy to check all of the schedules of a phase/group at once: the longest
+run of a trial type, the number of each trial type per sub-session, and the
+number of left and right trials per sub-session.
+
+The library itself is two files: "schedules.jsonl" (one schedule per line,
+only ever appended to) and "index.json", which maps each
+"subject|phase|date" key to the byte offset and length of its line. Loading
+a schedule is a dict lookup and a single seek/read.
+"""
+
+from datetime import date, timedelta
+from hashlib import sha256
+from json import dumps, loads
+from os import cpu_count, makedirs, path as os_path, replace
+
+from settings_registry import SettingsRegistry
+from trial_sequences import session_plan, generate_sequence
+
+INDEX_FILE = "index.json"
+DATA_FILE = "schedules.jsonl"
+PHASES = (0, 1)
+
+
+def schedule_key(subject_ID, training_phase, session_date):
+    if isinstance(session_date, date):
+        session_date = session_date.isoformat()
+    return f"{subject_ID}|{training_phase}|{session_date}"
+
+
+def schedule_seed(subject_ID, training_phase, session_date):
+    # A seed that only depends on the subject, phase and date
+    digest = sha256(schedule_key(subject_ID, training_phase, session_date).encode("utf-8"))
+    return int.from_bytes(digest.digest()[:4], "big")
+
+
+def read_subject_groups(settings_csv_directory):
+    # Returns {subject: group} for every row of the settings .csv
+    return SettingsRegistry(settings_csv_directory).groups()
+
+
+def build_subject_schedules(subject_ID, experimental_group, dates, phases):
+    # Worker function (run in a separate process): every schedule of one
+    # subject across the given dates and phases
+    schedules = []
+    for session_date in dates:
+        for training_phase in phases:
+            plan = session_plan(training_phase, experimental_group)
+            seed = schedule_seed(subject_ID, training_phase, session_date)
+            schedules.append({"subject": subject_ID,
+                              "phase": training_phase,
+                              "date": session_date,
+                              "group": experimental_group,
+                              "seed": seed,
+                              "trials": generate_sequence(plan.blocks,
+                                                          max_run = plan.max_run,
+                                                          seed = seed)})
+    return schedules
+
+
+def validate_schedules(schedules):
+    # Checks a list of schedules, batched by phase/group so that each check
+    # runs over a whole 2D array (schedules x trials) at once. Returns a list
+    # of (key, problem) pairs; an empty list means everything passed.
+    import numpy as np
+    problems = []
+    batches = {}
+    for schedule in schedules:
+        batches.setdefault((schedule["phase"], schedule["group"]), []).append(schedule)
+    for (training_phase, experimental_group), batch in batches.items():
+        plan = session_plan(training_phase, experimental_group)
+        keys = [schedule_key(s["subject"], s["phase"], s["date"]) for s in batch]
+        lengths = np.array([len(s["trials"]) for s in batch])
+        for i in np.flatnonzero(lengths != plan.trials_per_session):
+            problems.append((keys[i], f"{lengths[i]} trials (expected {plan.trials_per_session})"))
+        batch = [s for s, n in zip(batch, lengths) if n == plan.trials_per_session]
+        keys = [k for k, n in zip(keys, lengths) if n == plan.trials_per_session]
+        if not batch:
+            continue
+        # Code each trial type as an int
+        trial_types = sorted({t for block in plan.blocks for t in block})
+        codes = {t: i for i, t in enumerate(trial_types)}
+        orders = np.array([[codes.get(t, -1) for t in s["trials"]] for s in batch])
+        for i in np.flatnonzero((orders < 0).any(axis=1)):
+            problems.append((keys[i], "contains trial types not in the plan"))
+        # Longest run: a run longer than max_run means max_run equal
+        # neighbours in a row somewhere along the schedule
+        if plan.max_run is not None:
+            same = (orders[:, 1:] == orders[:, :-1]).astype(np.int32)
+            window = np.cumsum(np.pad(same, ((0, 0), (1, 0))), axis=1)
+            longest = window[:, plan.max_run:] - window[:, :-plan.max_run]
+            for i in np.flatnonzero((longest >= plan.max_run).any(axis=1)):
+                problems.append((keys[i], f"more than {plan.max_run} of the same trial in a row"))
+        # Per-block (sub-session) trial type counts
+        block_start = 0
+        for block_number, block in enumerate(plan.blocks):
+            block_orders = orders[:, block_start:block_start + len(block)]
+            block_start += len(block)
+            counts = np.stack([(block_orders == c).sum(axis=1) for c in range(len(trial_types))], axis=1)
+            expected = np.array([block.count(t) for t in trial_types])
+            for i in np.flatnonzero((counts != expected).any(axis=1)):
+                problems.append((keys[i], f"unbalanced trial types in sub-session {block_number + 1}"))
+            # Per-side counts (trial types starting with "L" vs "R")
+            left = np.array([t.startswith("L") for t in trial_types])
+            side_counts = np.stack([counts[:, left].sum(axis=1), counts[:, ~left].sum(axis=1)], axis=1)
+            expected_sides = np.array([expected[left].sum(), expected[~left].sum()])
+            for i in np.flatnonzero((side_counts != expected_sides).any(axis=1)):
+                problems.append((keys[i], f"unbalanced left/right trials in sub-session {block_number + 1}"))
+    return problems
+
+
+class ScheduleLibrary(object):
+    # An indexed, append-only store of schedules in a directory
+    def __init__(self, library_directory):
+        self.library_directory = library_directory
+        self.index_path = os_path.join(library_directory, INDEX_FILE)
+        self.data_path = os_path.join(library_directory, DATA_FILE)
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            if os_path.isfile(self.index_path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self._index = loads(f.read())
+            else:
+                self._index = {}
+        return self._index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, subject_ID, training_phase, session_date):
+        # Returns the schedule (a dict) for a subject/phase/date, or None
+        entry = self.index.get(schedule_key(subject_ID, training_phase, session_date))
+        if entry is None:
+            return None
+        offset, length = entry
+        with open(self.data_path, 'rb') as f:
+            f.seek(offset)
+            return loads(f.read(length).decode("utf-8"))
+
+    def add(self, schedules):
+        # Appends schedules to the data file (a newer schedule for the same
+        # key replaces the older one in the index), then rewrites the index
+        makedirs(self.library_directory, exist_ok=True)
+        index = self.index
+        with open(self.data_path, 'ab') as f:
+            offset = f.tell()
+            for schedule in schedules:
+                line = dumps(schedule).encode("utf-8")
+                index[schedule_key(schedule["subject"], schedule["phase"], schedule["date"])] = [offset, len(line)]
+                f.write(line + b"\n")
+                offset += len(line) + 1
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(dumps(index))
+        replace(temp_path, self.index_path)
+
+
+def build_library(settings_csv_directory, library_directory, days,
+                  start_date=None, phases=PHASES, workers=None):
+    # Precomputes, validates, and saves the schedules of every subject.
+    # Returns (number of schedules saved, list of problems found).
+    start_date = start_date or date.today()
+    dates = [(start_date + timedelta(days = d)).isoformat() for d in range(days)]
+    subject_groups = read_subject_groups(settings_csv_directory)
+    schedules = []
+    from concurrent.futures import ProcessPoolExecutor # Only needed here (slow to import)
+    with ProcessPoolExecutor(max_workers = workers or cpu_count()) as pool:
+        futures = [pool.submit(build_subject_schedules, subject_ID, group, dates, phases)
+                   for subject_ID, group in subject_groups.items()]
+        for future in futures:
+            schedules.extend(future.result())
+    problems = validate_schedules(schedules)
+    if not problems:
+        ScheduleLibrary(library_directory).add(schedules)
+    return len(schedules), problems
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Precompute P038 trial schedules")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="precompute schedules for every subject")
+    build.add_argument("--days", type=int, required=True, help="number of days to precompute")
+    build.add_argument("--start", type=date.fromisoformat, default=None, help="first day (YYYY-MM-DD), default today")
+    build.add_argument("--phases", type=int, nargs="+", default=list(PHASES))
+    build.add_argument("--settings", default="P038_Settings-Assignments.csv")
+    build.add_argument("--library", default="schedule_library")
+    build.add_argument("--workers", type=int, default=None)
+    show = commands.add_parser("show", help="print one schedule")
+    show.add_argument("subject")
+    show.add_argument("phase", type=int)
+    show.add_argument("date")
+    show.add_argument("--library", default="schedule_library")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        n, problems = build_library(args.settings, args.library, args.days,
+                                    start_date = args.start,
+                                    phases = args.phases,
+                                    workers = args.workers)
+        if problems:
+            print(f"ERROR: {len(problems)} problem(s) found; library NOT updated")
+            for key, problem in problems:
+                print(f"  {key}: {problem}")
+        else:
+            print(f"- {n} schedules validated and saved to {args.library}")
+    elif args.command == "show":
+        schedule = ScheduleLibrary(args.library).get(args.subject, args.phase, args.date)
+        if schedule is None:
+            print("No schedule found")
+        else:
+            print(f"{schedule['subject']} | Phase {schedule['phase']} | {schedule['date']} | {schedule['group']} | seed {schedule['seed']}")
+            for trial_number, trial_type in enumerate(schedule["trials"], 1):
+                print(f"{trial_number:>3} {trial_type}")
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental, vectorized analysis of the P038 data folder.
+
+Scans every subject folder in the data folder for session files
+("{subject}_{timestamp}_P037_data-Phase{n}.csv"), parses each one into NumPy
+columns (including the SessionTime timedelta strings, all at once), and
+computes per-session and per-subject metrics:
+
+    - optimal-choice proportion on choice trials (first choice of a trial)
+    - choice latency (TrialTime of the first choice peck on choice trials)
+    - second-reinforcer collection on trials where the optimal key was pecked
+    - ITI peck rate (per minute of ITI) and background peck rate (per
+      minute of session)
+
+Per-session results are cached (keyed on each file's size and mtime) in a
+small JSON file in the data folder, so each run only parses files that are
+new or have changed.
+
+    python session_analysis.py [data folder] [--out <folder>]
+
+Note that the data rows have one fewer value than the header (the
+"ChoiceKeysActive" column was never filled in), so columns are read by
+position rather than by header name.
+"""
+
+from argparse import ArgumentParser
+from csv import writer, QUOTE_MINIMAL
+from json import dumps, loads
+from os import path as os_path, replace, stat
+
+import numpy as np
+
+from session_catalog import parse_session_filename, find_session_files
+from peck_coalescing import read_session_rows
+from protocol import load_protocol
+
+CACHE_FILE = ".P038_analysis_cache.json"
+CACHE_VERSION = 1
+
+# Position of each value in a data row
+(COL_SESSION_TIME, COL_X, COL_Y, COL_EVENT, COL_LEFT_KEY, COL_RIGHT_KEY,
+ COL_TRIAL_TYPE, COL_TRIAL_TIME, COL_TRIAL_NUM, COL_REINFORCERS,
+ COL_ITI_DURATION, COL_SUBJECT, COL_CONDITION, COL_TRAINING_PHASE,
+ COL_DATE) = range(15)
+
+SESSION_METRICS = ["subject", "phase", "condition", "date", "start", "file",
+                   "trials", "reinforcers", "session_minutes",
+                   "choice_trials", "optimal_proportion",
+                   "choice_latency_mean", "choice_latency_median",
+                   "optimal_trials", "second_reinforcer_proportion",
+                   "ITI_pecks", "ITI_peck_rate", "background_pecks",
+                   "background_peck_rate"]
+
+
+def default_data_folder():
+    box_folder = str(os_path.expanduser('~')) + "/OneDrive/Desktop/Data/P038_data"
+    return box_folder if os_path.isdir(box_folder) else "Data"
+
+
+def parse_session_times(session_times):
+    # Vectorized "H:MM:SS[.ffffff]" (str(timedelta)) -> seconds. (Past
+    # 24 h, str(timedelta) puts "D day(s), " in front.)
+    session_times = np.asarray(session_times, dtype=str)
+    if session_times.size == 0:
+        return np.zeros(0)
+    days, _, clock_times = np.char.rpartition(session_times, " ").T
+    days = np.char.partition(days, " ")[:, 0]
+    hours, _, rest = np.char.partition(clock_times, ":").T
+    minutes, _, seconds = np.char.partition(rest, ":").T
+    return np.where(days == "", "0", days).astype(float) * 86400 + \
+        hours.astype(float) * 3600 + minutes.astype(float) * 60 + seconds.astype(float)
+
+
+def read_session_columns(file_path):
+    # Reads a session file (with any coalesced pecks expanded back into
+    # rows; see peck_coalescing.py) into a dict of NumPy columns
+    rows = [row for row in read_session_rows(file_path) if len(row) >= 15]
+    if rows:
+        values = np.array([row[:15] for row in rows], dtype=str)
+    else:
+        values = np.empty((0, 15), dtype=str)
+    trial_time = np.char.replace(values[:, COL_TRIAL_TIME], "NA", "nan")
+    return {"session_time": parse_session_times(values[:, COL_SESSION_TIME]),
+            "event": values[:, COL_EVENT],
+            "trial_type": values[:, COL_TRIAL_TYPE],
+            "trial_time": trial_time.astype(float),
+            "trial_num": values[:, COL_TRIAL_NUM].astype(int),
+            "reinforcers": values[:, COL_REINFORCERS].astype(int),
+            "ITI_duration": values[:, COL_ITI_DURATION],
+            "subject": values[:, COL_SUBJECT],
+            "condition": values[:, COL_CONDITION],
+            "date": values[:, COL_DATE]}
+
+
+def _first(values, default=None):
+    return values[0].item() if len(values) else default
+
+
+def _nan_to_none(value):
+    value = float(value)
+    return None if np.isnan(value) else round(value, 4)
+
+
+def session_metrics(columns, choice_trial_types=None):
+    # Per-session metrics from a session's columns (see read_session_columns).
+    # Choice trials are those of the protocol's choice trial types (see
+    # Protocol.choice_trial_types()).
+    if choice_trial_types is None:
+        choice_trial_types = load_protocol().choice_trial_types()
+    event = columns["event"]
+    trial_num = columns["trial_num"]
+    trial_type = columns["trial_type"]
+    n_trials = int(trial_num.max()) if trial_num.size else 0
+    reinforced = event == "reinforcer_provided"
+    session_minutes = float(columns["session_time"].max()) / 60 if trial_num.size else 0.0
+
+    # First choice (optimal/suboptimal peck) of every trial
+    choice_peck = (event == "optimal_peck") | (event == "suboptimal_peck")
+    trials_with_choice, first_index = np.unique(trial_num[choice_peck], return_index=True)
+    first_event = event[choice_peck][first_index]
+    first_trial_type = trial_type[choice_peck][first_index]
+    first_latency = columns["trial_time"][choice_peck][first_index]
+    on_choice_trial = np.isin(first_trial_type, sorted(choice_trial_types))
+    first_optimal = first_event == "optimal_peck"
+    n_choice = int(on_choice_trial.sum())
+
+    # Reinforcers per trial, to see if the second one was collected
+    reinforcers_per_trial = np.bincount(trial_num[reinforced], minlength=n_trials + 1)
+    optimal_trials = trials_with_choice[first_optimal]
+    second_collected = reinforcers_per_trial[optimal_trials] >= 2
+
+    # Non-contingent pecks
+    ITI_pecks = int((event == "ITI_peck").sum())
+    background_pecks = int((event == "background_peck").sum())
+    ITI_duration = _first(columns["ITI_duration"], "0")
+    ITI_minutes = n_trials * float(ITI_duration) / 60000 if ITI_duration.isdigit() else 0.0
+
+    choice_latencies = first_latency[on_choice_trial]
+    return {"subject": _first(columns["subject"], ""),
+            "condition": _first(columns["condition"], ""),
+            "date": _first(columns["date"], ""),
+            "trials": n_trials,
+            "reinforcers": int(reinforced.sum()),
+            "session_minutes": round(session_minutes, 3),
+            "choice_trials": n_choice,
+            "optimal_proportion": _nan_to_none(first_optimal[on_choice_trial].mean()) if n_choice else None,
+            "choice_latency_mean": _nan_to_none(choice_latencies.mean()) if n_choice else None,
+            "choice_latency_median": _nan_to_none(np.median(choice_latencies)) if n_choice else None,
+            "optimal_trials": int(len(optimal_trials)),
+            "second_reinforcer_proportion": round(float(second_collected.mean()), 4) if len(optimal_trials) else None,
+            "ITI_pecks": ITI_pecks,
+            "ITI_peck_rate": round(ITI_pecks / ITI_minutes, 3) if ITI_minutes else None,
+            "background_pecks": background_pecks,
+            "background_peck_rate": round(background_pecks / session_minutes, 3) if session_minutes else None}
+
+
+def analyze_file(file_path):
+    subject, timestamp, phase = parse_session_filename(os_path.basename(file_path))
+    metrics = session_metrics(read_session_columns(file_path))
+    metrics.update({"subject": metrics["subject"] or subject,
+                    "phase": phase,
+                    "start": timestamp,
+                    "file": os_path.basename(file_path)})
+    return metrics
+
+
+class AnalysisCache(object):
+    # {file path: {"size", "mtime", "metrics"}}, stored as JSON
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.entries = {}
+        if os_path.isfile(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                stored = loads(f.read())
+            if stored.get("version") == CACHE_VERSION:
+                self.entries = stored["entries"]
+
+    def get(self, file_path, size, mtime):
+        entry = self.entries.get(file_path)
+        if entry and entry["size"] == size and entry["mtime"] == mtime:
+            return entry["metrics"]
+        return None
+
+    def put(self, file_path, size, mtime, metrics):
+        self.entries[file_path] = {"size": size, "mtime": mtime, "metrics": metrics}
+
+    def save(self):
+        temp_path = self.cache_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(dumps({"version": CACHE_VERSION, "entries": self.entries}))
+        replace(temp_path, self.cache_path)
+
+
+def analyze_folder(data_folder, cache_path=None):
+    # Returns (list of per-session metrics, number of files parsed this run)
+    cache = AnalysisCache(cache_path or os_path.join(data_folder, CACHE_FILE))
+    sessions = []
+    parsed = 0
+    session_files = find_session_files(data_folder)
+    for file_path in session_files:
+        info = stat(file_path)
+        metrics = cache.get(file_path, info.st_size, info.st_mtime_ns)
+        if metrics is None:
+            metrics = analyze_file(file_path)
+            cache.put(file_path, info.st_size, info.st_mtime_ns, metrics)
+            parsed += 1
+        sessions.append(metrics)
+    # Forget files that are gone
+    cache.entries = {k: v for k, v in cache.entries.items() if k in set(session_files)}
+    if parsed or len(cache.entries) != len(session_files) or not os_path.isfile(cache.cache_path):
+        cache.save()
+    return sessions, parsed
+
+
+def subject_metrics(sessions):
+    # Per-subject (and phase) means of the session metrics
+    grouped = {}
+    for metrics in sessions:
+        grouped.setdefault((metrics["subject"], metrics["phase"]), []).append(metrics)
+    summary = []
+    for (subject, phase), subject_sessions in sorted(grouped.items()):
+        subject_sessions.sort(key=lambda m: m["start"])
+        row = {"subject": subject, "phase": phase,
+               "condition": subject_sessions[-1]["condition"],
+               "sessions": len(subject_sessions)}
+        for metric in ("optimal_proportion", "choice_latency_mean",
+                       "second_reinforcer_proportion", "ITI_peck_rate",
+                       "background_peck_rate", "session_minutes"):
+            values = np.array([m[metric] for m in subject_sessions if m[metric] is not None], dtype=float)
+            row[metric] = round(float(values.mean()), 4) if values.size else None
+        row["last_optimal_proportion"] = subject_sessions[-1]["optimal_proportion"]
+        summary.append(row)
+    return summary
+
+
+def write_rows(file_path, rows, columns):
+    with open(file_path, 'w', newline='') as f:
+        w = writer(f, quoting=QUOTE_MINIMAL)
+        w.writerow(columns)
+        for row in rows:
+            w.writerow(["NA" if row.get(c) is None else row.get(c) for c in columns])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Analyze every P038 session in the data folder")
+    parser.add_argument("data_folder", nargs="?", default=None)
+    parser.add_argument("--out", default=None, help="folder for the metric .csv files (default: the data folder)")
+    parser.add_argument("--cache", default=None, help="cache file (default: in the data folder)")
+    args = parser.parse_args()
+
+    data_folder = args.data_folder or default_data_folder()
+    sessions, parsed = analyze_folder(data_folder, args.cache)
+    subjects = subject_metrics(sessions)
+    out_folder = args.out or data_folder
+    write_rows(os_path.join(out_folder, "P038_session_metrics.csv"),
+               sorted(sessions, key=lambda m: (m["subject"], m["start"])), SESSION_METRICS)
+    subject_columns = ["subject", "phase", "condition", "sessions",
+                       "optimal_proportion", "last_optimal_proportion",
+                       "choice_latency_mean", "second_reinforcer_proportion",
+                       "ITI_peck_rate", "background_peck_rate", "session_minutes"]
+    write_rows(os_path.join(out_folder, "P038_subject_metrics.csv"), subjects, subject_columns)
+
+    print(f"{len(sessions)} sessions ({parsed} parsed, {len(sessions) - parsed} from cache)\n")
+    print(f"{'Subject':>8} | Phase | {'Group':>6} | Sessions | Optimal | Latency (s) | 2nd SR")
+    for row in subjects:
+        optimal = "NA" if row["optimal_proportion"] is None else f"{row['optimal_proportion']:.3f}"
+        latency = "NA" if row["choice_latency_mean"] is None else f"{row['choice_latency_mean']:.2f}"
+        second = "NA" if row["second_reinforcer_proportion"] is None else f"{row['second_reinforcer_proportion']:.3f}"
+        print(f"{row['subject']:>8} | {row['phase']:^5} | {row['condition']:>6} | {row['sessions']:^8} | {optimal:^7} | {latency:^11} | {second}")
+    print(f"\n- Metrics written to {out_folder}")
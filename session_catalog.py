@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A local SQLite catalog of every P038 session file.
+
+Rather than walking each subject folder and picking apart file names like
+"{subject}_{timestamp}_P037_data-Phase{n}.csv", sessions are indexed in a
+small database with their subject, phase, group, date, start time, number of trials and
+reinforcers, and a SHA-256 hash of the file. Optionally, every event row can
+be stored too.
+
+Ingesting is incremental: a file is only re-read if its size or mtime has
+changed since it was last catalogued. The main program also upserts each
+session into the catalog as soon as its data file is closed.
+
+The catalog is local to each box PC (by default
+"P038_catalog_{PC name}.sqlite3" in a P038 folder under the user's local
+AppData, or ~/.local/share off Windows; see default_catalog_path()). It is
+deliberately kept out of the OneDrive-synced data folder: a SQLite file (and
+its journal) written by several PCs through a synced folder ends up with
+conflict copies, or corrupted. Any PC can build its own catalog of the
+(synced) data folder with "ingest", or use --db to pick the file.
+
+    python session_catalog.py ingest [data folder] [--events]
+    python session_catalog.py query --group Forced --phase 1 --limit 5
+"""
+
+from hashlib import sha256
+from os import environ, listdir, makedirs, path as os_path, stat
+from platform import node
+from re import compile as re_compile
+from sqlite3 import connect
+from time import time
+
+from peck_coalescing import read_session_rows
+
+CATALOG_FILE = "P038_catalog_{box}.sqlite3"
+
+# Session files (and not the _timing.csv etc. written next to them)
+SESSION_FILE_PATTERN = re_compile(r"^(?P<subject>.+?)_(?P<timestamp>\d{4}-\d{2}-\d{2}_\d{2}\.\d{2}\.\d{2})_P037_data-Phase(?P<phase>\d+)\.csv$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    path TEXT PRIMARY KEY,
+    subject TEXT NOT NULL,
+    phase INTEGER NOT NULL,
+    condition TEXT,
+    session_date TEXT,
+    start_time TEXT NOT NULL,
+    trials INTEGER,
+    reinforcers INTEGER,
+    events INTEGER,
+    sha256 TEXT,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ingested REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_by_subject ON sessions (subject, start_time);
+CREATE INDEX IF NOT EXISTS sessions_by_group ON sessions (condition, phase, start_time);
+CREATE TABLE IF NOT EXISTS events (
+    path TEXT NOT NULL REFERENCES sessions (path) ON DELETE CASCADE,
+    row INTEGER NOT NULL,
+    session_time TEXT,
+    x TEXT,
+    y TEXT,
+    event TEXT,
+    left_key TEXT,
+    right_key TEXT,
+    trial_type TEXT,
+    trial_time TEXT,
+    trial_num INTEGER,
+    reinforcers INTEGER,
+    PRIMARY KEY (path, row)
+);
+"""
+
+
+def parse_session_filename(file_name):
+    # Returns (subject, timestamp string, phase) or None if not a session file
+    match = SESSION_FILE_PATTERN.match(file_name)
+    if match is None:
+        return None
+    return match.group("subject"), match.group("timestamp"), int(match.group("phase"))
+
+
+def find_session_files(data_folder):
+    # Every session file in every subject folder
+    session_files = []
+    if not os_path.isdir(data_folder):
+        return session_files
+    for subject_folder in sorted(listdir(data_folder)):
+        subject_path = os_path.join(data_folder, subject_folder)
+        if not os_path.isdir(subject_path):
+            continue
+        for file_name in sorted(listdir(subject_path)):
+            if parse_session_filename(file_name) is not None:
+                session_files.append(os_path.join(subject_path, file_name))
+    return session_files
+
+
+def file_hash(file_path, chunk_size=1 << 20):
+    digest = sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def default_catalog_path():
+    # This PC's own catalog, somewhere that isn't synced
+    base = environ.get("LOCALAPPDATA") or os_path.join(os_path.expanduser('~'), ".local", "share")
+    return os_path.join(base, "P038", CATALOG_FILE.format(box = node() or "box"))
+
+
+class SessionCatalog(object):
+    def __init__(self, db_path):
+        self.db_path = db_path
+        if os_path.dirname(db_path):
+            makedirs(os_path.dirname(db_path), exist_ok=True)
+        self.connection = connect(db_path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def is_current(self, file_path, size, mtime_ns, with_events=False):
+        # Whether a file is already catalogued as it is on disk now (and, if
+        # with_events, with its events)
+        file_path = os_path.abspath(file_path)
+        row = self.connection.execute("SELECT size, mtime_ns, events FROM sessions WHERE path = ?",
+                                      (file_path,)).fetchone()
+        if row is None or row[:2] != (size, mtime_ns):
+            return False
+        if with_events and row[2]:
+            return self.connection.execute("SELECT 1 FROM events WHERE path = ? LIMIT 1",
+                                           (file_path,)).fetchone() is not None
+        return True
+
+    def ingest_file(self, file_path, with_events=False):
+        # Reads a session file and upserts it (and optionally its events)
+        parsed_name = parse_session_filename(os_path.basename(file_path))
+        if parsed_name is None:
+            raise ValueError(f"Not a P038 session file: {file_path}")
+        subject, timestamp, phase = parsed_name
+        file_path = os_path.abspath(file_path)
+        info = stat(file_path)
+
+        # Columns are read by position, as data rows have one value fewer
+        # than the header (see CSV_HEADER in event_store.py). Coalesced
+        # pecks (see peck_coalescing.py) are expanded back into rows.
+        rows = [row for row in read_session_rows(file_path) if len(row) >= 15]
+        trials = max((int(row[8]) for row in rows), default=0)
+        reinforcers = sum(row[3] == "reinforcer_provided" for row in rows)
+        condition = rows[0][12] if rows else None
+        session_date = rows[0][14] if rows else None
+
+        with self.connection:
+            self.connection.execute("DELETE FROM events WHERE path = ?", (file_path,))
+            self.connection.execute("INSERT OR REPLACE INTO sessions VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                                    (file_path, subject, phase, condition,
+                                     session_date, timestamp, trials,
+                                     reinforcers, len(rows), file_hash(file_path),
+                                     info.st_size, info.st_mtime_ns, time()))
+            if with_events:
+                self.connection.executemany("INSERT INTO events VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                                            ((file_path, i, *row[:8], int(row[8]), int(row[9]))
+                                             for i, row in enumerate(rows)))
+
+    def ingest_folder(self, data_folder, with_events=False):
+        # Catalogues new or changed session files and forgets deleted ones.
+        # Returns (files ingested, files removed).
+        session_files = [os_path.abspath(p) for p in find_session_files(data_folder)]
+        ingested = 0
+        for file_path in session_files:
+            info = stat(file_path)
+            if not self.is_current(file_path, info.st_size, info.st_mtime_ns, with_events):
+                self.ingest_file(file_path, with_events)
+                ingested += 1
+        folder = os_path.join(os_path.abspath(data_folder), "")
+        catalogued = [row[0] for row in self.connection.execute(
+            "SELECT path FROM sessions WHERE substr(path, 1, ?) = ?", (len(folder), folder))]
+        missing = set(catalogued) - set(session_files)
+        with self.connection:
+            self.connection.executemany("DELETE FROM sessions WHERE path = ?",
+                                        ((p,) for p in missing))
+        return ingested, len(missing)
+
+    def sessions(self, subject=None, condition=None, phase=None, limit=None):
+        # Most recent sessions first, as dicts
+        clauses, values = [], []
+        for column, value in (("subject", subject), ("condition", condition), ("phase", phase)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                values.append(value)
+        query = "SELECT * FROM sessions"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY start_time DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            values.append(limit)
+        cursor = self.connection.execute(query, values)
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def events(self, file_path):
+        # Every catalogued event of a session (if ingested with events)
+        cursor = self.connection.execute("SELECT * FROM events WHERE path = ? ORDER BY row",
+                                         (os_path.abspath(file_path),))
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Catalog of P038 session files")
+    parser.add_argument("--db", default=None, help="catalog file (default: this PC's own, see default_catalog_path())")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = commands.add_parser("ingest", help="catalog new or changed session files")
+    ingest_parser.add_argument("data_folder", nargs="?", default=None)
+    ingest_parser.add_argument("--events", action="store_true", help="also store every event row")
+    query_parser = commands.add_parser("query", help="list catalogued sessions")
+    query_parser.add_argument("data_folder", nargs="?", default=None)
+    query_parser.add_argument("--subject", default=None)
+    query_parser.add_argument("--group", default=None)
+    query_parser.add_argument("--phase", type=int, default=None)
+    query_parser.add_argument("--limit", type=int, default=5)
+    args = parser.parse_args()
+
+    data_folder = args.data_folder
+    if data_folder is None:
+        data_folder = str(os_path.expanduser('~')) + "/OneDrive/Desktop/Data/P038_data"
+        if not os_path.isdir(data_folder):
+            data_folder = "Data"
+    with SessionCatalog(args.db or default_catalog_path()) as catalog:
+        if args.command == "ingest":
+            start = time()
+            ingested, removed = catalog.ingest_folder(data_folder, args.events)
+            print(f"- {ingested} session file(s) catalogued, {removed} removed ({time() - start:.2f} s)")
+        else:
+            start = time()
+            sessions = catalog.sessions(args.subject, args.group, args.phase, args.limit)
+            elapsed_ms = (time() - start) * 1000
+            for s in sessions:
+                print(f"{s['subject']:>6} | Phase {s['phase']} | {s['condition'] or 'NA':>6} | {s['start_time']} | {s['trials']:>3} trials | {s['reinforcers']:>3} SR | {os_path.basename(s['path'])}")
+            print(f"\n- {len(sessions)} session(s) ({elapsed_ms:.1f} ms)")
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+High-resolution, drift-corrected timing for P038 sessions.
+
+Session timing used to rely on datetime.now()/time() and on chaining
+root.after() calls with the nominal ITI, hopper and first-ITI durations.
+Because each after() started counting only once the previous callback
+actually ran, any lateness in the Tk event loop added up across trials.
+
+The SessionClock instead runs on a monotonic nanosecond clock
+(time.perf_counter_ns) and schedules each phase against an absolute
+deadline: a phase's deadline is its anchor (normally the *intended* start of
+the phase before it) plus its duration, and the after() delay is worked out
+from whatever time is actually left. If one callback runs a few ms late, the
+next phase is shortened by that much, so the lateness doesn't build up.
+
+The clock also keeps a log of the intended and actual onset of every timed
+event (ITI onsets, key presentations, and hopper on/off), which is written
+next to the session's data file at the end of the session. Other timed
+events (like hopper commands; see hopper_driver.py) can be added to it with
+record(). For long sessions, the log can instead be written as it goes
+(see open_onsets() and roll_onsets()), so it doesn't build up in memory.
+"""
+
+from csv import writer, QUOTE_MINIMAL
+from os import path as os_path
+from threading import Lock
+from time import perf_counter_ns
+
+ONSET_HEADER = ["TrialNum", "Event", "IntendedSessionTime",
+                "ActualSessionTime", "LatenessMs"]
+
+EARLY_TOLERANCE_NS = 500000 # Callbacks firing more than 0.5 ms early are re-armed
+
+
+class SessionClock(object):
+    def __init__(self, root, time_source=perf_counter_ns):
+        self.root = root # Anything with Tk's after()/after_cancel()
+        self.time_source = time_source
+        self.start_ns = None
+        self.onsets = [] # (trial, event, intended ns, actual ns), session-relative
+        self._onsets_lock = Lock() # (hopper commands are recorded from another thread)
+        self._onset_file = None # Where the log is written as it goes (if it is)
+        self._current_deadline = None # Deadline of the callback now running
+        self._pending = {} # after() id -> (deadline, callback, label, trial)
+        self.lateness_hook = None # Optional; called with each callback's lateness (ns)
+
+    def now_ns(self):
+        return self.time_source()
+
+    def start(self, elapsed_ns=0):
+        # Marks the start of the session (time zero). A resumed session
+        # starts elapsed_ns in, so its times carry on from where it stopped.
+        self.start_ns = self.time_source() - elapsed_ns
+        return self.start_ns
+
+    def elapsed_ns(self):
+        return self.time_source() - self.start_ns
+
+    def elapsed_ms(self):
+        return self.elapsed_ns() / 1000000
+
+    def anchor(self):
+        # The time the current phase was *meant* to start: the deadline of
+        # the scheduled callback that is running now or, outside of one
+        # (e.g., in response to a peck), the current time.
+        if self._current_deadline is not None:
+            return self._current_deadline
+        return self.time_source()
+
+    def mark(self, label, trial=None):
+        # Records the onset of an event happening now and returns its
+        # intended time, to be used as the anchor of the following phase
+        intended = self.anchor()
+        self._record(trial, label, intended, self.time_source())
+        return intended
+
+    def record(self, label, intended_ns, actual_ns, trial=None):
+        # Logs an event timed elsewhere (e.g., a hopper command's issue and
+        # completion), with the same intended vs. actual columns
+        self._record(trial, label, intended_ns, actual_ns)
+
+    def after(self, anchor_ns, delay_ms, callback, label=None, trial=None):
+        # Schedules callback for delay_ms after anchor_ns. If a label is
+        # given, the callback's intended and actual onsets are logged.
+        deadline = anchor_ns + int(delay_ms * 1000000)
+        return self._arm(deadline, callback, label, trial)
+
+    def _arm(self, deadline, callback, label, trial):
+        remaining_ms = max(0, (deadline - self.time_source()) // 1000000)
+        handle = [None]
+        handle[0] = self.root.after(remaining_ms,
+                                    lambda: self._fire(handle[0]))
+        self._pending[handle[0]] = (deadline, callback, label, trial)
+        return handle[0]
+
+    def _fire(self, handle):
+        entry = self._pending.pop(handle, None)
+        if entry is None: # Cancelled
+            return
+        deadline, callback, label, trial = entry
+        now = self.time_source()
+        if now < deadline - EARLY_TOLERANCE_NS: # Tk rounds delays to whole ms
+            self._arm(deadline, callback, label, trial)
+            return
+        if label is not None:
+            self._record(trial, label, deadline, now)
+        if self.lateness_hook is not None:
+            self.lateness_hook(now - deadline)
+        self._current_deadline = deadline
+        try:
+            callback()
+        finally:
+            self._current_deadline = None
+
+    def cancel_all(self):
+        # Cancels every callback that hasn't run yet (e.g., when exiting)
+        for handle in list(self._pending):
+            try:
+                self.root.after_cancel(handle)
+            except Exception: # The window may already be gone
+                pass
+        self._pending.clear()
+
+    def _record(self, trial, label, intended, actual):
+        if self.start_ns is None:
+            return
+        with self._onsets_lock:
+            self.onsets.append((trial, label, intended - self.start_ns, actual - self.start_ns))
+
+    def _write_onset_rows(self, w):
+        # Writes (and forgets) the onsets logged so far (times in seconds
+        # into the session, lateness in ms)
+        with self._onsets_lock:
+            onsets, self.onsets = self.onsets, []
+        for trial, label, intended, actual in onsets:
+            w.writerow([trial, label,
+                        f"{intended / 1e9:.6f}",
+                        f"{actual / 1e9:.6f}",
+                        f"{(actual - intended) / 1e6:.3f}"])
+
+    def open_onsets(self, file_path, append=False):
+        # Starts writing the onset log to file_path as the session goes. When
+        # appending (a resumed session), the onsets from before the session
+        # was cut short are kept and no header is written, unless there was
+        # no log yet.
+        if append and os_path.isfile(file_path) and os_path.getsize(file_path) > 0:
+            self._onset_file = open(file_path, 'a', newline='')
+            return
+        self._onset_file = open(file_path, 'w', newline='')
+        writer(self._onset_file, quoting=QUOTE_MINIMAL).writerow(ONSET_HEADER)
+
+    def roll_onsets(self, max_rows=0):
+        # Writes the onsets logged so far to the open log, once there are
+        # more than max_rows of them
+        if self._onset_file is not None and len(self.onsets) > max_rows:
+            self._write_onset_rows(writer(self._onset_file, quoting=QUOTE_MINIMAL))
+            self._onset_file.flush()
+
+    def write_onsets(self, file_path):
+        # Writes the onset log as a .csv. If it was being written as the
+        # session went, the rest of it is written and the file closed.
+        if self._onset_file is not None:
+            self.roll_onsets()
+            self._onset_file.close()
+            self._onset_file = None
+            return
+        with open(file_path, 'w', newline='') as f:
+            w = writer(f, quoting=QUOTE_MINIMAL)
+            w.writerow(ONSET_HEADER)
+            self._write_onset_rows(w)
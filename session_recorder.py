@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming .csv recorder for P038 session data.
+
+Previously, the whole session data matrix was rewritten to disk at the start
+of every ITI, which made disk I/O grow quadratically with the number of
+events (and made OneDrive re-sync the whole file every trial). The
+SessionRecorder below instead opens the data file once, writes the header,
+and then only appends new rows as they come in. The bytes on disk are the
+same as the old rewrite approach (same csv writer, quoting, and line endings),
+so existing analysis scripts can read the files without any changes.
+
+How often the appended rows are pushed to disk is set by the flush policy:
+
+    "event"  -- flush after every single row
+    "trial"  -- flush once per trial (when end_trial() is called in the ITI)
+    <int>    -- flush whenever at least that many milliseconds have passed
+                since the last flush (checked as rows come in)
+
+If fsync is True, every flush is also forced through the OS cache to the disk.
+"""
+
+from csv import writer, QUOTE_MINIMAL
+from os import fsync as os_fsync
+from time import monotonic
+
+FLUSH_POLICIES = ("event", "trial")
+
+
+def parse_flush_policy(flush_policy):
+    # Flush policies can be given as "event", "trial", or a number of ms
+    # (as an int or a string of digits, e.g. from a settings sheet). This
+    # returns either the string policy or an int number of ms.
+    if isinstance(flush_policy, str):
+        if flush_policy in FLUSH_POLICIES:
+            return flush_policy
+        if flush_policy.strip().isdigit():
+            flush_policy = int(flush_policy)
+    if isinstance(flush_policy, int) and not isinstance(flush_policy, bool) \
+            and flush_policy > 0:
+        return flush_policy
+    raise ValueError(f"Unknown flush policy: {flush_policy!r} (use 'event', "
+                     "'trial', or a positive number of ms)")
+
+
+class SessionRecorder(object):
+    # The recorder owns the open data file for the whole session. It is
+    # built once the file name is known (i.e., once the session start time
+    # has been set) and closed when the session ends.
+    def __init__(self, file_path, header=None, flush_policy="trial",
+                 fsync=False, mode="w"):
+        self.file_path = file_path
+        self.flush_policy = parse_flush_policy(flush_policy)
+        self.fsync = fsync
+        self.rows_written = 0 # Number of data rows (not header) appended
+        self.flush_count = 0
+        self._last_flush = monotonic()
+        self._file = open(file_path, mode, newline='')
+        self._writer = writer(self._file, quoting=QUOTE_MINIMAL)
+        if header is not None:
+            self._writer.writerow(header)
+            self.flush()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def write_row(self, row):
+        # Appends a single event row, then flushes if the policy calls for it
+        self._writer.writerow(row)
+        self.rows_written += 1
+        if self.flush_policy == "event":
+            self.flush()
+        elif self.flush_policy != "trial":
+            if (monotonic() - self._last_flush) * 1000 >= self.flush_policy:
+                self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def end_trial(self):
+        # Called once per trial (during the ITI). Under the "trial" policy
+        # this is the only time rows get pushed to disk; under a timed
+        # policy it also gives a chance to flush during quiet trials.
+        if self.flush_policy == "trial":
+            self.flush()
+        elif self.flush_policy != "event":
+            if (monotonic() - self._last_flush) * 1000 >= self.flush_policy:
+                self.flush()
+
+    def flush(self):
+        if self._file.closed:
+            return
+        self._file.flush()
+        if self.fsync:
+            os_fsync(self._file.fileno())
+        self._last_flush = monotonic()
+        self.flush_count += 1
+
+    def close(self):
+        # Flushes whatever is left and closes the file. Safe to call twice.
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Replay of recorded P038 sessions.
+
+When a session's data looks odd, it helps to see what the bird saw. This
+module rebuilds a session's stimulus timeline from its data file and plays
+it back on the same 800x600 canvas layout (drawn by the same StimulusLayer
+as the program itself), with a marker at the Xcord/Ycord of every peck:
+
+    python session_replay.py <session file>.csv [--trial 12] [--speed 10]
+
+While it plays:   space -- pause/play
+                  + / - -- faster/slower (1x to 100x)
+          right / left  -- next/previous trial
+                 Escape -- quit
+
+The screen states come from the session's "_timing.csv" (the logged onset of
+every ITI, key presentation and hopper cycle), if there is one. Otherwise
+they are worked out from the data rows: keys come on at SessionTime -
+TrialTime, the ITI starts one ITIDuration before that, and the hopper is up
+from each reinforcer for the subject's hopper duration. Which keys are shown
+(and as which role) comes from TrialType and the protocol file (see
+protocol.py), and their colors from the subject's settings.
+
+Only the trial being played is read from the data file. The byte offset at
+which each trial starts is worked out once and saved next to the file
+("_replay_index.json"), so jumping to any trial is a single seek.
+"""
+
+from csv import reader
+from io import StringIO
+from json import dumps, loads
+from os import path as os_path, stat
+from time import perf_counter_ns
+
+from checkpoint import write_atomic
+from peck_coalescing import summary_path_for, read_summaries, expand_summary, \
+    session_microseconds
+from settings_registry import SettingsRegistry, SettingsError
+from stimulus_layer import StimulusLayer
+from protocol import load_protocol
+
+INDEX_SUFFIX = "_replay_index.json"
+INDEX_VERSION = 1
+SPEEDS = (1, 2, 5, 10, 20, 50, 100)
+FRAME_MS = 20
+SETTINGS_PATH = os_path.join(os_path.dirname(os_path.abspath(__file__)),
+                             "P038_Settings-Assignments.csv")
+
+# The layout of MainScreen (see its key_coordinates and ITI_color)
+SCREEN_WIDTH, SCREEN_HEIGHT = 800, 600
+KEY_COORDINATES = {"left_choice_key": [200, 250, 300, 350],
+                   "right_choice_key": [500, 250, 600, 350]}
+ITI_COLOR = "Slategray2"
+DEFAULT_COLORS = {"optimal": "Blue", "suboptimal": "Yellow"}
+DEFAULT_HOPPER_MS = 6000
+BETWEEN_SESSION_ITI_MS = 15 * 60 * 1000 # (15 s for TEST)
+MARKER_COLORS = {"optimal_peck": "lime green",
+                 "suboptimal_peck": "red",
+                 "hopper_up_peck": "orange"} # Everything else is white
+
+
+def index_path_for(csv_path):
+    if csv_path.endswith(".csv"):
+        return csv_path[:-4] + INDEX_SUFFIX
+    return csv_path + INDEX_SUFFIX
+
+
+class TrialIndex(object):
+    # {trial number: (first byte, end byte)} of each trial's rows in a
+    # session .csv (the rows of a trial are always next to each other)
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.trials = {}
+        info = stat(csv_path)
+        self._key = [info.st_size, info.st_mtime_ns]
+        if not self._load():
+            self.build()
+
+    def _load(self):
+        index_path = index_path_for(self.csv_path)
+        if not os_path.isfile(index_path):
+            return False
+        with open(index_path, 'r', encoding='utf-8') as f:
+            stored = loads(f.read())
+        if stored.get("version") != INDEX_VERSION or stored.get("file") != self._key:
+            return False
+        self.trials = {int(trial): tuple(span) for trial, span in stored["trials"].items()}
+        return True
+
+    def build(self):
+        # One pass over the file (the only one), then saved for next time
+        self.trials = {}
+        with open(self.csv_path, 'rb') as f:
+            offset = len(f.readline()) # Header
+            for line in f:
+                row = next(reader([line.decode('utf-8')]), None)
+                if row and len(row) > 8:
+                    trial = int(row[8])
+                    start = self.trials[trial][0] if trial in self.trials else offset
+                    self.trials[trial] = (start, offset + len(line))
+                offset += len(line)
+        try:
+            write_atomic(index_path_for(self.csv_path),
+                         dumps({"version": INDEX_VERSION, "file": self._key,
+                                "trials": self.trials}))
+        except OSError: # e.g., a read-only data folder; just keep it in memory
+            pass
+
+    def trial_numbers(self):
+        return sorted(self.trials)
+
+    def rows(self, trial):
+        # The data rows of one trial (read straight from its offset)
+        if trial not in self.trials:
+            return []
+        start, end = self.trials[trial]
+        with open(self.csv_path, 'rb') as f:
+            f.seek(start)
+            text = f.read(end - start).decode('utf-8')
+        return [row for row in reader(StringIO(text, newline='')) if row]
+
+
+def read_onsets(timing_path):
+    # {trial: [(event label, session time in s), ...]} from a "_timing.csv"
+    onsets = {}
+    with open(timing_path, 'r', newline='') as f:
+        rows = reader(f)
+        next(rows, None) # Header
+        for row in rows:
+            if row and row[0].isdigit():
+                onsets.setdefault(int(row[0]), []).append((row[1], float(row[3])))
+    return onsets
+
+
+class SessionReplay(object):
+    def __init__(self, root, canvas, csv_path, speed=1, settings_csv=SETTINGS_PATH,
+                 time_source=perf_counter_ns):
+        self.root = root
+        self.canvas = canvas
+        self.csv_path = csv_path
+        self.time_source = time_source
+        self.index = TrialIndex(csv_path)
+        self.trial_numbers = self.index.trial_numbers()
+        if not self.trial_numbers:
+            raise ValueError(f"{csv_path} has no data rows")
+
+        # Session constants (from the first trial's rows)
+        first = self.index.rows(self.trial_numbers[0])[0]
+        self.ITI_duration_ms = int(first[10])
+        self.subject_ID, self.condition = first[11], first[12]
+        self.training_phase = int(first[13])
+        self.protocol = load_protocol()
+        self.phase_tables = self.protocol.phase(self.training_phase)
+        plan = self.phase_tables.session_plan(self.condition)
+        self.trials_per_session = plan.trials_per_session
+        self.trials_per_subsession = plan.trials_per_subsession
+        self.rest_between_subsessions = plan.rest_between_blocks
+        self.colors = dict(DEFAULT_COLORS)
+        self.hopper_ms = DEFAULT_HOPPER_MS
+        try:
+            settings = SettingsRegistry(settings_csv).get(self.subject_ID)
+            self.colors = {"optimal": settings.optimal_color,
+                           "suboptimal": settings.suboptimal_color}
+            self.hopper_ms = settings.hopper_duration
+        except SettingsError:
+            pass
+        timing_path = csv_path[:-4] + "_timing.csv"
+        self.onsets = read_onsets(timing_path) if os_path.isfile(timing_path) else None
+        summary_path = summary_path_for(csv_path)
+        self.summaries = {} # Coalesced pecks (see peck_coalescing.py), by trial
+        if os_path.isfile(summary_path):
+            for summary in read_summaries(summary_path):
+                self.summaries.setdefault(int(summary[13]), []).append(summary)
+
+        self.stimuli = StimulusLayer(canvas, SCREEN_WIDTH, SCREEN_HEIGHT,
+                                     KEY_COORDINATES,
+                                     on_background = lambda event, event_type: None,
+                                     on_key = lambda event, key_string: None)
+        self.status = canvas.create_text(10, 10, anchor = "nw", text = "",
+                                         fill = "white", font = "Courier 12")
+        self.markers = []
+        self.speed = speed
+        self.paused = False
+        self.trial = None
+        self.timeline = []
+        self._next = 0 # Index of the next timeline item to show
+        self._position_s = 0.0 # Session time being shown
+        self._anchor = (0.0, time_source()) # (session time, real time) of the last (re)start
+        self._after_id = None
+
+    # Timeline of a trial: (session time in s, kind, value), in time order
+
+    def trial_timeline(self, trial):
+        rows = self.index.rows(trial)
+        constants = rows[0][10:14] if rows else None
+        for summary in self.summaries.get(trial, ()):
+            rows += expand_summary(summary, constants)
+        rows.sort(key = lambda row: session_microseconds(row[0]))
+        timeline = [(session_microseconds(row[0]) / 1e6, "peck", row) for row in rows
+                    if row[1] != "NA" or row[3] == "SessionEnds"]
+        if not rows:
+            return timeline
+        trial_type = rows[0][6]
+        if trial_type in self.protocol.trial_index:
+            layouts = self.phase_tables.layouts[self.protocol.trial_index[trial_type]]
+        else:
+            layouts = [()]
+        between_session = self.rest_between_subsessions and trial > 1 and \
+            (trial - 1) % self.trials_per_subsession == 0
+        if self.onsets is not None and trial in self.onsets:
+            key_onsets = 0
+            for label, time_s in self.onsets[trial]:
+                if label == "ITI_onset":
+                    timeline.append((time_s, "screen", "between" if between_session else "ITI"))
+                elif label == "key_onset":
+                    timeline.append((time_s, "keys", self._keys(layouts, key_onsets)))
+                    key_onsets += 1
+                elif label == "hopper_on":
+                    timeline.append((time_s, "screen", "hopper"))
+        else:
+            # No onset log: work the onsets out from the rows
+            key_onset = min(session_microseconds(row[0]) / 1e6 - float(row[7]) for row in rows)
+            if between_session:
+                ITI_ms = 15 * 1000 if self.subject_ID == "TEST" else BETWEEN_SESSION_ITI_MS
+            else:
+                ITI_ms = self.ITI_duration_ms
+            ITI_onset = min(key_onset - ITI_ms / 1000, session_microseconds(rows[0][0]) / 1e6)
+            timeline.append((ITI_onset, "screen", "between" if between_session else "ITI"))
+            timeline.append((key_onset, "keys", self._keys(layouts, 0)))
+            optimal_first = next((row[3] == "optimal_peck" for row in rows
+                                  if row[3] in ("optimal_peck", "suboptimal_peck")), False)
+            for i, time_s in enumerate(session_microseconds(row[0]) / 1e6 for row in rows
+                                       if row[3] == "reinforcer_provided"):
+                timeline.append((time_s, "screen", "hopper"))
+                if i == 0 and optimal_first:
+                    timeline.append((time_s + self.hopper_ms / 1000, "keys", self._keys(layouts, 1)))
+        # Screen changes go before pecks at the same time
+        timeline.sort(key = lambda item: (item[0], item[1] == "peck"))
+        return timeline
+
+    def _keys(self, layouts, key_onset):
+        # {key_string: color} of a trial's key presentation (its first, or
+        # e.g. its second after an optimal choice), from the protocol's
+        # layout of that stage of the trial
+        roles = layouts[min(key_onset, len(layouts) - 1)]
+        return {key: self.colors.get(role, "white")
+                for key, role in zip(self.protocol.keys, roles) if role is not None}
+
+    # Playback
+
+    def seek(self, trial):
+        # Jumps to the start of a trial (the closest one recorded)
+        trial = min(self.trial_numbers, key = lambda t: abs(t - trial))
+        self.trial = trial
+        self.timeline = self.trial_timeline(trial)
+        self._next = 0
+        for marker in self.markers:
+            self.canvas.delete(marker)
+        self.markers = []
+        self.stimuli.hide_all()
+        start = self.timeline[0][0] if self.timeline else 0.0
+        self._restart(start)
+        self._update_status()
+
+    def _restart(self, position_s):
+        self._position_s = position_s
+        self._anchor = (position_s, self.time_source())
+
+    def set_speed(self, speed):
+        self._restart(self._position_s)
+        self.speed = max(SPEEDS[0], min(SPEEDS[-1], speed))
+        self._update_status()
+
+    def faster(self):
+        self.set_speed(next((s for s in SPEEDS if s > self.speed), SPEEDS[-1]))
+
+    def slower(self):
+        self.set_speed(next((s for s in reversed(SPEEDS) if s < self.speed), SPEEDS[0]))
+
+    def toggle_pause(self):
+        self.paused = not self.paused
+        self._restart(self._position_s)
+        self._update_status()
+
+    def step_trial(self, step):
+        i = self.trial_numbers.index(self.trial) + step
+        if 0 <= i < len(self.trial_numbers):
+            self.seek(self.trial_numbers[i])
+
+    def advance(self, position_s):
+        # Shows everything on the timeline up to position_s. Returns False
+        # once the last trial is over.
+        self._position_s = position_s
+        while self._next < len(self.timeline) and self.timeline[self._next][0] <= position_s:
+            self._show(*self.timeline[self._next][1:])
+            self._next += 1
+        if self._next >= len(self.timeline):
+            i = self.trial_numbers.index(self.trial) + 1
+            if i >= len(self.trial_numbers):
+                return False
+            self.trial = self.trial_numbers[i]
+            self.timeline = self.trial_timeline(self.trial)
+            self._next = 0
+            for marker in self.markers:
+                self.canvas.delete(marker)
+            self.markers = []
+        return True
+
+    def _show(self, kind, value):
+        if kind == "screen":
+            self.stimuli.hide_keys()
+            self.stimuli.show_background(ITI_COLOR if value == "ITI" else "black", "")
+        elif kind == "keys":
+            self.stimuli.show_background("black", "")
+            self.stimuli.show_keys(value)
+        elif value[3] == "SessionEnds":
+            self.stimuli.hide_all()
+        else: # A peck
+            x, y = int(value[1]), int(value[2])
+            self.markers.append(self.canvas.create_oval(x - 5, y - 5, x + 5, y + 5,
+                                                        fill = MARKER_COLORS.get(value[3], "white"),
+                                                        outline = ""))
+
+    def _update_status(self):
+        minutes, seconds = divmod(self._position_s, 60)
+        state = "paused" if self.paused else f"{self.speed}x"
+        self.canvas.itemconfigure(self.status,
+                                  text = f"{self.subject_ID}  Trial {self.trial}/{self.trial_numbers[-1]}  "
+                                         f"{int(minutes)}:{seconds:06.3f}  {state}")
+
+    def _frame(self):
+        if not self.paused:
+            anchor_s, anchor_ns = self._anchor
+            position_s = anchor_s + (self.time_source() - anchor_ns) / 1e9 * self.speed
+            if not self.advance(position_s):
+                self._update_status()
+                return
+            self._update_status()
+        self._after_id = self.root.after(FRAME_MS, self._frame)
+
+    def play(self, trial=None):
+        self.seek(self.trial_numbers[0] if trial is None else trial)
+        self._frame()
+
+    def bind_keys(self):
+        self.root.bind("<space>", lambda event: self.toggle_pause())
+        self.root.bind("<plus>", lambda event: self.faster())
+        self.root.bind("<equal>", lambda event: self.faster())
+        self.root.bind("<minus>", lambda event: self.slower())
+        self.root.bind("<Right>", lambda event: self.step_trial(1))
+        self.root.bind("<Left>", lambda event: self.step_trial(-1))
+        self.root.bind("<Escape>", lambda event: self.root.destroy())
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Replay a recorded P038 session")
+    parser.add_argument("data_file", help="the session's .csv")
+    parser.add_argument("--trial", type=int, default=None, help="trial to start at")
+    parser.add_argument("--speed", type=int, default=1, choices=SPEEDS)
+    parser.add_argument("--settings", default=SETTINGS_PATH, help="settings sheet (for key colors)")
+    parser.add_argument("--list", action="store_true", help="list the trials (and their offsets) and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        index = TrialIndex(args.data_file)
+        for trial in index.trial_numbers():
+            print(f"Trial {trial:>3}: bytes {index.trials[trial][0]}-{index.trials[trial][1]}")
+    else:
+        from tkinter import Tk, Canvas
+        root = Tk()
+        root.title(f"P038 replay: {os_path.basename(args.data_file)}")
+        canvas = Canvas(root, bg="black", height=SCREEN_HEIGHT, width=SCREEN_WIDTH)
+        canvas.pack()
+        replay = SessionReplay(root, canvas, args.data_file, speed=args.speed,
+                               settings_csv=args.settings)
+        replay.bind_keys()
+        replay.play(args.trial)
+        root.mainloop()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Registry of the subject settings in P038_Settings-Assignments.csv.
+
+The settings sheet is read and checked once (when the control panel opens)
+into one SubjectSettings record per subject, indexed by subject name. The
+registry only re-reads the sheet when its mtime changes, so it can be asked
+to refresh as often as needed (e.g., every time the subject menu is opened)
+without touching the file otherwise.
+
+Every row is checked when the sheet is loaded, and any problems (missing
+columns, durations that aren't positive whole numbers, groups the protocol
+doesn't have, the same color for both keys, repeated subjects) are raised
+together as a SettingsError, rather than turning up once a session has
+already started.
+"""
+
+from csv import DictReader
+from os import stat
+from re import split as re_split
+
+COLUMNS = ("Subject", "Hopper Duration (ms)", "ITI Duration (ms)", "Group",
+           "Optimal Color", "Suboptimal Color")
+
+
+class SettingsError(ValueError):
+    pass
+
+
+class SubjectSettings(object):
+    # One subject's row of the settings sheet
+    __slots__ = ("subject", "hopper_duration", "ITI_duration", "group",
+                 "optimal_color", "suboptimal_color")
+
+    def __init__(self, subject, hopper_duration, ITI_duration, group,
+                 optimal_color, suboptimal_color):
+        self.subject = subject
+        self.hopper_duration = hopper_duration # ms
+        self.ITI_duration = ITI_duration # ms
+        self.group = group
+        self.optimal_color = optimal_color
+        self.suboptimal_color = suboptimal_color
+
+    def __repr__(self):
+        return (f"SubjectSettings({self.subject!r}, hopper={self.hopper_duration} ms, "
+                f"ITI={self.ITI_duration} ms, group={self.group!r}, "
+                f"optimal={self.optimal_color!r}, suboptimal={self.suboptimal_color!r})")
+
+
+def _positive_int(value):
+    value = value.strip()
+    if not value.isdigit() or int(value) <= 0:
+        raise ValueError
+    return int(value)
+
+
+def protocol_groups():
+    # The experimental groups defined in the protocol file (see protocol.py)
+    from protocol import load_protocol # (only needed to check the sheet)
+    return tuple(load_protocol().group_names())
+
+
+def parse_settings_row(line, groups=()):
+    # Builds a SubjectSettings from one DictReader row, or raises ValueError
+    # saying what is wrong with it. The group has to be one of groups (any
+    # name will do if there are none).
+    problems = []
+    subject = (line.get("Subject") or "").strip()
+    if not subject:
+        problems.append("no subject name")
+    durations = {}
+    for column in ("Hopper Duration (ms)", "ITI Duration (ms)"):
+        try:
+            durations[column] = _positive_int(line.get(column) or "")
+        except ValueError:
+            problems.append(f"{column} should be a positive whole number, not {line.get(column)!r}")
+    group = (line.get("Group") or "").strip()
+    if groups and group not in groups:
+        problems.append(f"Group should be one of {', '.join(groups)}, not {group!r}")
+    elif not group:
+        problems.append("no group")
+    optimal_color = (line.get("Optimal Color") or "").strip()
+    suboptimal_color = (line.get("Suboptimal Color") or "").strip()
+    if not optimal_color or not suboptimal_color:
+        problems.append("both key colors are needed")
+    elif optimal_color.lower() == suboptimal_color.lower():
+        problems.append(f"the optimal and suboptimal keys are both {optimal_color!r}")
+    if problems:
+        raise ValueError("; ".join(problems))
+    return SubjectSettings(subject,
+                           durations["Hopper Duration (ms)"],
+                           durations["ITI Duration (ms)"],
+                           group,
+                           optimal_color,
+                           suboptimal_color)
+
+
+def _natural_key(subject):
+    # So that B2 comes before B10
+    return [int(part) if part.isdigit() else part.lower()
+            for part in re_split(r"(\d+)", subject)]
+
+
+class SettingsRegistry(object):
+    def __init__(self, csv_path, groups=None):
+        self.csv_path = csv_path
+        self.groups_allowed = protocol_groups() if groups is None else tuple(groups)
+        self.subjects = {} # subject -> SubjectSettings
+        self._mtime_ns = None
+        self.reload()
+
+    def reload(self):
+        # Re-reads the sheet if it changed since it was last read. Returns
+        # whether it was re-read. Raises SettingsError (and keeps the
+        # previous settings) if the file is missing or has bad rows.
+        try:
+            mtime_ns = stat(self.csv_path).st_mtime_ns
+        except OSError:
+            raise SettingsError(f"Cannot find the settings sheet: {self.csv_path}")
+        if mtime_ns == self._mtime_ns:
+            return False
+        with open(self.csv_path, 'r', encoding='utf-8-sig', newline='') as data:
+            reader = DictReader(data)
+            missing = [c for c in COLUMNS if c not in (reader.fieldnames or [])]
+            if missing:
+                raise SettingsError(f"The settings sheet {self.csv_path} is missing the column(s): "
+                                    f"{', '.join(missing)} (is it comma-delimited?)")
+            subjects = {}
+            problems = []
+            for line_number, line in enumerate(reader, 2):
+                if not any((value or "").strip() for value in line.values() if isinstance(value, str)):
+                    continue # Blank line
+                try:
+                    settings = parse_settings_row(line, self.groups_allowed)
+                except ValueError as e:
+                    problems.append(f"  line {line_number}: {e}")
+                    continue
+                if settings.subject in subjects:
+                    problems.append(f"  line {line_number}: {settings.subject} is listed more than once")
+                    continue
+                subjects[settings.subject] = settings
+        if problems:
+            raise SettingsError(f"Bad rows in the settings sheet {self.csv_path}:\n" + "\n".join(problems))
+        self.subjects = subjects
+        self._mtime_ns = mtime_ns
+        return True
+
+    def get(self, subject):
+        # A subject's settings (from memory; no file access)
+        try:
+            return self.subjects[subject]
+        except KeyError:
+            raise SettingsError(f"{subject} is not in the settings sheet {self.csv_path}")
+
+    def __contains__(self, subject):
+        return subject in self.subjects
+
+    def __iter__(self):
+        return iter(self.subjects.values())
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def subject_names(self):
+        # Subjects for the control panel menu: TEST first, then the rest in
+        # natural order
+        names = sorted((s for s in self.subjects if s != "TEST"), key=_natural_key)
+        if "TEST" in self.subjects:
+            names.insert(0, "TEST")
+        return names
+
+    def groups(self):
+        # {subject: group}
+        return {s.subject: s.group for s in self}
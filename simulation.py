@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless, accelerated simulation of P038 sessions.
+
+Testing the MainScreen used to mean sitting in front of a display, clicking
+on keys, and waiting out every 10 s ITI, 6 s hopper cycle, and the 15 min
+between-session ITI in real time. This module runs the very same trial
+logic (ITI(), build_keys(), key_press(), provide_food(), write_data(), ...)
+with no Tkinter window at all:
+
+    - VirtualRoot stands in for the Toplevel window. Its after() calls go
+      onto a virtual clock that jumps straight to the next due callback, so
+      a whole session takes milliseconds.
+    - HeadlessCanvas stands in for the Canvas. It keeps track of every item,
+      its state, and its bindings, and can be "pecked" at an x/y coordinate
+      (the topmost visible item there gets the click, like in Tk).
+    - A simulated pigeon (any object with a choose() method) decides which
+      key to peck, and how quickly, every time keys are presented.
+
+The session writes the same data files a real session would. From the
+command line:
+
+    python simulation.py --subject B1 --phase 1 --p-optimal 0.7 --data sim_data
+"""
+
+from argparse import ArgumentParser
+from collections import namedtuple
+from heapq import heappush, heappop
+from importlib.util import spec_from_file_location, module_from_spec
+from itertools import count
+from os import makedirs, path as os_path
+from random import Random
+
+from hopper_driver import SimulatedHopperObject
+from protocol import load_protocol
+
+PROGRAM_PATH = os_path.join(os_path.dirname(os_path.abspath(__file__)),
+                            "P038_ExpProgram_2023-07-03.py")
+SETTINGS_PATH = os_path.join(os_path.dirname(os_path.abspath(__file__)),
+                             "P038_Settings-Assignments.csv")
+
+_program = None
+
+
+def load_program():
+    # Loads the experiment program as a module (its file name isn't a valid
+    # module name, so it can't simply be imported) and switches it to the
+    # non-box version, so no hardware is touched (and no telemetry server
+    # is started). Simulated sessions aren't added to the PC's session
+    # catalog either. (Their checkpoints are still written, in the simulated
+    # data folder, so that a simulated session can be resumed.)
+    global _program
+    if _program is None:
+        spec = spec_from_file_location("P038_ExpProgram", PROGRAM_PATH)
+        _program = module_from_spec(spec)
+        spec.loader.exec_module(_program)
+        _program.operant_box_version = False
+        _program.telemetry_port = None # No live telemetry server
+        _program.catalog_sessions = False # Keep them out of the real catalog
+    return _program
+
+
+class VirtualRoot(object):
+    # Stands in for the Tk window: after() callbacks run on a virtual clock
+    def __init__(self):
+        self.time_ns = 0
+        self.destroyed = False
+        self.bindings = {}
+        self._queue = [] # (due time, sequence number, id, callback)
+        self._ids = count(1)
+        self._cancelled = set()
+
+    def now_ns(self):
+        return self.time_ns
+
+    def after(self, ms, callback):
+        sequence = next(self._ids)
+        after_id = f"after#{sequence}"
+        heappush(self._queue, (self.time_ns + int(ms) * 1000000, sequence, after_id, callback))
+        return after_id
+
+    def after_cancel(self, after_id):
+        self._cancelled.add(after_id)
+
+    def bind(self, sequence, callback):
+        self.bindings[sequence] = callback
+
+    def unbind(self, sequence):
+        self.bindings.pop(sequence, None)
+
+    def fire(self, sequence, event=None):
+        # Simulates a key press bound on the window (e.g., "<space>")
+        if sequence in self.bindings:
+            self.bindings[sequence](event)
+
+    def title(self, *args):
+        pass
+
+    def attributes(self, *args):
+        pass
+
+    def config(self, **options):
+        pass
+
+    def destroy(self):
+        self.destroyed = True
+
+    def run(self, max_time_ns=None):
+        # Runs callbacks in time order until the window is destroyed, there
+        # is nothing left to run, or max_time_ns is reached
+        while self._queue and not self.destroyed:
+            due, sequence, after_id, callback = heappop(self._queue)
+            if max_time_ns is not None and due > max_time_ns:
+                heappush(self._queue, (due, sequence, after_id, callback))
+                self.time_ns = max_time_ns
+                return
+            if after_id in self._cancelled:
+                self._cancelled.discard(after_id)
+                continue
+            self.time_ns = max(self.time_ns, due)
+            callback()
+
+
+class PeckEvent(object):
+    # Stands in for a Tk "<Button-1>" event (region and distance are filled
+    # in by the stimulus layer's hit-testing)
+    __slots__ = ("x", "y", "region", "distance")
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class HeadlessCanvas(object):
+    # Stands in for the Tk Canvas. Items are kept in stacking order.
+    def __init__(self):
+        self.items = {} # id -> {"type", "coords", "options", "tags"}
+        self.tag_bindings = {} # tag -> callback
+        self.bindings = {} # sequence -> callback (Canvas-wide)
+        self._ids = count(1)
+
+    def _create(self, item_type, coords, options):
+        item = next(self._ids)
+        tags = options.pop("tag", options.pop("tags", ()))
+        if isinstance(tags, str):
+            tags = (tags,)
+        options.setdefault("state", "normal")
+        self.items[item] = {"type": item_type, "coords": list(coords),
+                            "options": options, "tags": tuple(tags)}
+        return item
+
+    def create_rectangle(self, *coords, **options):
+        return self._create("rectangle", coords, options)
+
+    def create_oval(self, *coords, **options):
+        return self._create("oval", coords, options)
+
+    def create_text(self, *coords, **options):
+        return self._create("text", coords, options)
+
+    def itemconfigure(self, item, **options):
+        self.items[item]["options"].update(options)
+
+    itemconfig = itemconfigure
+
+    def coords(self, item, *coords):
+        if coords:
+            self.items[item]["coords"] = list(coords)
+        return self.items[item]["coords"]
+
+    def tag_bind(self, tag, sequence, callback):
+        self.tag_bindings[tag] = callback
+
+    def bind(self, sequence, callback):
+        self.bindings[sequence] = callback
+
+    def delete(self, item):
+        if item == "all":
+            self.items.clear()
+        else:
+            self.items.pop(item, None)
+
+    def pack(self, **options):
+        pass
+
+    def visible_items(self):
+        return [item for item, spec in self.items.items()
+                if spec["options"]["state"] != "hidden"]
+
+    def item_at(self, x, y):
+        # The topmost visible item under a point. Like in Tk, shapes with
+        # no fill can only be hit on their outline, so they're skipped here
+        # (as is text, whose size isn't known without a display).
+        for item in reversed(list(self.items)):
+            spec = self.items[item]
+            options = spec["options"]
+            if options["state"] == "hidden" or spec["type"] == "text":
+                continue
+            if options.get("fill", "black") == "":
+                continue
+            x1, y1, x2, y2 = spec["coords"]
+            if spec["type"] == "rectangle":
+                if x1 <= x <= x2 and y1 <= y <= y2:
+                    return item
+            elif spec["type"] == "oval":
+                cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+                rx, ry = (x2 - x1) / 2, (y2 - y1) / 2
+                if ((x - cx) / rx) ** 2 + ((y - cy) / ry) ** 2 <= 1:
+                    return item
+        return None
+
+    def click(self, x, y):
+        # Simulates a peck at (x, y)
+        event = PeckEvent(x, y)
+        if "<Button-1>" in self.bindings:
+            self.bindings["<Button-1>"](event)
+        item = self.item_at(x, y)
+        if item is None:
+            return
+        for tag in self.items[item]["tags"]:
+            if tag in self.tag_bindings:
+                self.tag_bindings[tag](event)
+                return
+
+
+# What a simulated pigeon is shown each time keys come on
+KeyPresentation = namedtuple("KeyPresentation", ["trial_num",
+                                                 "trial_type",
+                                                 "keys", # {key_string: "optimal"/"suboptimal"}
+                                                 "second_chance"]) # After an optimal choice?
+
+
+class RandomPigeon(object):
+    # Pecks the optimal key with probability p_optimal when given a choice
+    # (and the only key otherwise), after a uniformly random latency.
+    def __init__(self, p_optimal=0.5, latency_ms=(300, 1500),
+                 p_collect_second=1.0):
+        self.p_optimal = p_optimal
+        self.latency_ms = latency_ms
+        self.p_collect_second = p_collect_second # Peck the leftover key after an optimal choice?
+
+    def choose(self, presentation, rng):
+        # Returns (key_string, latency in ms), or None to not peck at all
+        latency = rng.uniform(*self.latency_ms)
+        keys = presentation.keys
+        if presentation.second_chance and rng.random() >= self.p_collect_second:
+            return None
+        if len(keys) == 1:
+            return next(iter(keys)), latency
+        wanted = "optimal" if rng.random() < self.p_optimal else "suboptimal"
+        for key_string, role in keys.items():
+            if role == wanted:
+                return key_string, latency
+        return rng.choice(sorted(keys)), latency
+
+
+class SessionSimulator(object):
+    # Drives a MainScreen with a simulated pigeon on a virtual clock
+    def __init__(self, subject_ID, training_phase, pigeon=None,
+                 data_folder_directory=None, settings_csv_directory=SETTINGS_PATH,
+                 seed=None, background_pecks_per_min=0, echo=False,
+                 hopper=None, resume=None):
+        program = load_program()
+        self.rng = Random(seed)
+        self.pigeon = pigeon or RandomPigeon()
+        self.background_pecks_per_min = background_pecks_per_min
+        self.root = VirtualRoot()
+        self.canvas = HeadlessCanvas()
+        training_phase_name_list = load_protocol().phase_names()
+        record_data = data_folder_directory is not None
+        if record_data:
+            makedirs(os_path.join(data_folder_directory, subject_ID), exist_ok=True)
+        # (hopper can be a SimulatedHopperObject, see hopper_driver.py)
+        self.screen = program.MainScreen(hopper,
+                                         subject_ID,
+                                         record_data,
+                                         data_folder_directory,
+                                         training_phase_name_list[training_phase],
+                                         training_phase_name_list,
+                                         root = self.root,
+                                         canvas = self.canvas,
+                                         time_source = self.root.now_ns,
+                                         settings_csv_directory = settings_csv_directory,
+                                         echo = echo,
+                                         threaded_logging = False,
+                                         resume = resume)
+        # Hook into key presentations so the pigeon can respond to them
+        build_keys = self.screen.build_keys
+        def build_keys_and_respond():
+            build_keys()
+            self._respond()
+        self.screen.build_keys = build_keys_and_respond
+
+    def _respond(self):
+        screen = self.screen
+        presentation = KeyPresentation(screen.current_trial_counter,
+                                       screen.trial_type,
+                                       dict(screen.shown_keys),
+                                       screen.trial_stage > 0)
+        choice = self.pigeon.choose(presentation, self.rng)
+        if choice is None:
+            return
+        key_string, latency = choice
+        x1, y1, x2, y2 = screen.key_coordinates[key_string]
+        # Peck somewhere near the centre of the key
+        x = round((x1 + x2) / 2 + self.rng.uniform(-20, 20))
+        y = round((y1 + y2) / 2 + self.rng.uniform(-20, 20))
+        self.root.after(latency, lambda: self.canvas.click(x, y))
+
+    def _background_peck(self):
+        # Pecks at a random spot on the screen, then schedules the next one
+        if self.root.destroyed:
+            return
+        self.canvas.click(self.rng.randrange(self.screen.mainscreen_width),
+                          self.rng.randrange(self.screen.mainscreen_height))
+        self.root.after(self.rng.expovariate(self.background_pecks_per_min / 60000),
+                        self._background_peck)
+
+    def run(self, max_minutes=None):
+        # Places the bird in the box (space bar) and runs the whole session.
+        # Returns the MainScreen, whose data frame/data file hold the results.
+        self.root.fire("<space>")
+        if self.background_pecks_per_min:
+            self.root.after(self.rng.expovariate(self.background_pecks_per_min / 60000),
+                            self._background_peck)
+        max_time_ns = None if max_minutes is None else int(max_minutes * 60e9)
+        self.root.run(max_time_ns)
+        return self.screen
+
+
+def simulate_session(subject_ID, training_phase, pigeon=None, **options):
+    # Runs a single simulated session and returns its MainScreen
+    return SessionSimulator(subject_ID, training_phase, pigeon, **options).run()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Run a headless, simulated P038 session")
+    parser.add_argument("--subject", default="TEST")
+    parser.add_argument("--phase", type=int, choices=(0, 1), default=1)
+    parser.add_argument("--p-optimal", type=float, default=0.5)
+    parser.add_argument("--latency", type=float, nargs=2, default=(300, 1500), metavar=("MIN_MS", "MAX_MS"))
+    parser.add_argument("--background-rate", type=float, default=0, help="background pecks per minute")
+    parser.add_argument("--data", default=None, help="data folder (no data file is written if left out)")
+    parser.add_argument("--settings", default=SETTINGS_PATH)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--echo", action="store_true", help="print every event")
+    parser.add_argument("--hopper-delay", type=float, default=None, metavar="MS",
+                        help="drive a simulated hopper that takes this long per command")
+    args = parser.parse_args()
+
+    screen = simulate_session(args.subject, args.phase,
+                              RandomPigeon(args.p_optimal, tuple(args.latency)),
+                              data_folder_directory = args.data,
+                              settings_csv_directory = args.settings,
+                              seed = args.seed,
+                              background_pecks_per_min = args.background_rate,
+                              echo = args.echo,
+                              hopper = None if args.hopper_delay is None else SimulatedHopperObject(args.hopper_delay, args.hopper_delay))
+    print(f"\n- Simulated {screen.current_trial_counter} trials, "
+          f"{screen.reinforcers_provided} reinforcers, "
+          f"{len(screen.session_data_frame)} events, "
+          f"{screen.clock.elapsed_ms() / 60000:.1f} min of session time")
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fast startup for the P038 program: deferred hardware and startup timings.
+
+The box's hopper and paint program live in the Hopper_Software folder on the
+desktop (not with this program). They used to be imported, and the
+HopperObject built, before the control panel even came up; if the folder was
+missing, the program stopped at an input() prompt, which also happened when
+the program was only imported for analysis or testing.
+
+The HardwareLoader instead imports them only when they are first needed. The
+control panel starts a background probe as it opens, which imports the
+hopper module and builds the HopperObject while the experimenter is still
+picking a subject and phase. By the time a session starts, the hopper is
+usually ready; if not, starting the session waits for the probe to finish.
+If the Hopper_Software folder can't be found, that is reported then (and the
+session isn't started) instead of when the program is imported. A failed
+load isn't final: starting the next session tries again, so a hopper whose
+USB device comes up late (or a folder put back on the desktop) is picked up
+without restarting the program.
+
+StartupTimer records how long each startup phase took (imports, settings,
+control panel, hardware probe) so slow starts on the box PCs can be seen.
+"""
+
+from importlib import import_module, invalidate_caches
+from os import path as os_path
+from sys import path as sys_path
+from threading import Lock, Thread
+from time import perf_counter_ns
+
+_IMPORT_NS = perf_counter_ns() # Roughly when the program started importing
+
+HOPPER_SOFTWARE_DIRECTORY = str(os_path.expanduser('~')) + "/OneDrive/Desktop/Hopper_Software"
+MISSING_HARDWARE_MESSAGE = ("ERROR :-( \n Cannot find the hopper software folder. \n Maybe a bird moved it? \n"
+                            " Check the trash and desktop folders and drag it to the desktop <3")
+
+
+class StartupTimer(object):
+    def __init__(self, start_ns=_IMPORT_NS):
+        self.start_ns = start_ns
+        self._last_ns = start_ns
+        self.phases = [] # (phase, ms)
+
+    def mark(self, phase):
+        # Ends a startup phase (which started where the last one ended)
+        now = perf_counter_ns()
+        self.phases.append((phase, (now - self._last_ns) / 1e6))
+        self._last_ns = now
+
+    def add(self, phase, ms):
+        # Records a phase timed elsewhere (e.g., on another thread)
+        self.phases.append((phase, ms))
+
+    def report(self):
+        total_ms = (self._last_ns - self.start_ns) / 1e6
+        phases = ", ".join(f"{phase} {ms:.0f} ms" for phase, ms in self.phases)
+        print(f"Startup: {phases} (ready after {total_ms:.0f} ms)")
+
+
+class HardwareLoader(object):
+    def __init__(self, directory=HOPPER_SOFTWARE_DIRECTORY, timer=None):
+        self.directory = directory
+        self.timer = timer
+        self.error = None # Why the hardware couldn't be loaded, if it couldn't
+        self._hopper = None
+        self._lock = Lock()
+        self._probe = None
+
+    def _import(self, module_name):
+        if self.directory not in sys_path:
+            sys_path.insert(0, self.directory)
+        return import_module(module_name)
+
+    def probe(self):
+        # Starts loading the hopper in the background (once)
+        if self._probe is None:
+            self._probe = Thread(target=self._load_hopper, name="P038-hardware-probe", daemon=True)
+            self._probe.start()
+
+    def _load_hopper(self, retry=False):
+        # Loads the hopper, unless it already is (or already failed to, when
+        # not retrying)
+        with self._lock:
+            if retry and self.error is not None:
+                self.error = None
+                invalidate_caches() # In case the folder (or module) has appeared since
+            if self._hopper is not None or self.error is not None:
+                return
+            start = perf_counter_ns()
+            try:
+                self._hopper = self._import("hopper").HopperObject()
+            except ModuleNotFoundError as e:
+                self.error = e
+                print(MISSING_HARDWARE_MESSAGE)
+            except Exception as e: # e.g., the hopper itself didn't respond
+                self.error = e
+                print(f"ERROR :-( \n Could not set up the hopper: {e}")
+            if self.timer is not None:
+                self.timer.add("hardware probe (background)", (perf_counter_ns() - start) / 1e6)
+
+    def hopper(self):
+        # The HopperObject (waiting for the probe if it is still running), or
+        # None if it couldn't be loaded. The probe's result is only used
+        # once: if it failed, the next call tries to load the hopper again.
+        if self._probe is not None:
+            self._probe.join()
+            self._probe = None
+        else:
+            self._load_hopper(retry = True)
+        return self._hopper
+
+    def paint_program(self):
+        # The polygon_fill module (or None if it can't be imported)
+        try:
+            return self._import("polygon_fill")
+        except ModuleNotFoundError:
+            print(MISSING_HARDWARE_MESSAGE)
+            return None
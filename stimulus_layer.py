@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Retained-mode stimulus layer for the P038 experimental canvas.
+
+Every state change used to delete everything on the Canvas and then rebuild
+the background rectangle, both (invisible) halo ovals around the keys, both
+key ovals, and any onscreen text, re-binding every one of them to its
+callback. That happened every trial, and twice on optimal trials.
+
+The StimulusLayer instead creates each item (and its binding) ONCE per
+session. Moving between the ITI, key presentation, and feeding states only
+changes the state (hidden/normal), fill, text, and position of those items
+through itemconfigure()/coords(). Each item's current options are cached,
+so Tk is only told about options that actually change.
+
+Pecks are caught by a single "<Button-1>" binding on the Canvas itself and
+sorted out with a precomputed HitMap (see hit_testing.py) rather than by
+per-item bindings. The callbacks stay the same as before: a peck to the
+background calls on_background(event, event_type), where event_type depends
+on the current state (e.g., "ITI_peck" or "hopper_up_peck"), and a peck to a
+key (or the 25 px "active" halo around it) calls on_key(event, key_string).
+Hidden keys don't receive pecks, so a peck where an unused key would be
+counts as a background peck, as it did when unused keys were simply not
+drawn. Before either callback is called, the event is given the region that
+was hit (event.region) and its distance to the nearest key centre
+(event.distance); touchscreen bounces are dropped (see Debouncer).
+"""
+
+from time import perf_counter_ns
+
+from hit_testing import HitMap, Debouncer, BACKGROUND
+
+
+class StimulusLayer(object):
+    def __init__(self, canvas, width, height, key_coordinates, on_background,
+                 on_key, halo_margin=25, debounce_ms=50, debounce_px=30,
+                 time_source=perf_counter_ns):
+        # key_coordinates gives the [x1, y1, x2, y2] of each key, e.g.
+        # {"left_choice_key": [200, 250, 300, 350], ...}
+        self.canvas = canvas
+        self.width = width
+        self.height = height
+        self.key_coordinates = key_coordinates
+        self.background_event_type = "background_peck" # What a background peck counts as
+        self.background_visible = False
+        self.visible_keys = set() # Keys that can currently be pecked
+        self.on_background = on_background
+        self.on_key = on_key
+        self.time_source = time_source
+        self.hit_map = HitMap(width, height, key_coordinates, halo_margin)
+        self.debouncer = Debouncer(debounce_ms, debounce_px)
+        self._options = {} # Cache of every item's current options
+
+        # Order matters: items built later are drawn on top of items built
+        # earlier.
+        self.background = canvas.create_rectangle(0, 0, width, height,
+                                                  fill = "black",
+                                                  outline = "black",
+                                                  state = "hidden",
+                                                  tag = "bkgrd")
+        self._options[self.background] = {"fill": "black", "outline": "black",
+                                           "state": "hidden"}
+
+        # The keys (their "active" halos only exist in the hit map)
+        self.keys = {}
+        for key_string, (x1, y1, x2, y2) in key_coordinates.items():
+            self.keys[key_string] = canvas.create_oval(x1, y1, x2, y2,
+                                                       fill = "black",
+                                                       outline = "",
+                                                       state = "hidden",
+                                                       tag = key_string)
+            self._options[self.keys[key_string]] = {"fill": "black", "state": "hidden"}
+
+        # Onscreen text (start screen, and ITI/feeding feedback when testing)
+        self.text = canvas.create_text(0, 0, text = "", fill = "white",
+                                       font = "Times 20 italic bold",
+                                       state = "hidden")
+        self._options[self.text] = {"text": "", "fill": "white",
+                                    "font": "Times 20 italic bold",
+                                    "state": "hidden", "coords": (0, 0)}
+
+        # Every peck, wherever it lands, goes through peck()
+        canvas.bind("<Button-1>", self.peck)
+
+    def peck(self, event):
+        # Works out what was pecked and passes the peck on to its callback
+        key_string, region = self.hit_map.classify(event.x, event.y)
+        if key_string not in self.visible_keys:
+            if not self.background_visible: # Blank screen; nothing to peck
+                return
+            key_string, region = None, BACKGROUND
+        if self.debouncer.is_bounce(self.time_source(), event.x, event.y):
+            return
+        event.region = region
+        event.distance = self.hit_map.distance(event.x, event.y)
+        if key_string is None:
+            self.on_background(event, self.background_event_type)
+        else:
+            self.on_key(event, key_string)
+
+    def _set(self, item, **options):
+        # Only passes along the options that differ from the item's current ones
+        current = self._options[item]
+        changed = {}
+        for option, value in options.items():
+            if current.get(option) != value:
+                current[option] = value
+                changed[option] = value
+        coords = changed.pop("coords", None)
+        if coords is not None:
+            self.canvas.coords(item, *coords)
+        if changed:
+            self.canvas.itemconfigure(item, **changed)
+
+    def show_background(self, color, event_type):
+        # Fills the screen with a color; pecks to it are logged as event_type
+        self.background_event_type = event_type
+        self.background_visible = True
+        self._set(self.background, fill = color, outline = color, state = "normal")
+
+    def show_keys(self, key_colors):
+        # Shows the keys given in key_colors ({key_string: color}) and hides
+        # the others
+        for key_string in self.keys:
+            if key_string in key_colors:
+                self._set(self.keys[key_string], fill = key_colors[key_string], state = "normal")
+            else:
+                self._set(self.keys[key_string], state = "hidden")
+        self.visible_keys = set(key_colors)
+
+    def hide_keys(self):
+        self.show_keys({})
+
+    def show_text(self, x, y, text, fill):
+        self._set(self.text, coords = (x, y), text = text, fill = fill, state = "normal")
+
+    def hide_text(self):
+        self._set(self.text, state = "hidden")
+
+    def hide_all(self):
+        # Blank screen (nothing visible, nothing to peck)
+        self.background_visible = False
+        self._set(self.background, state = "hidden")
+        self.hide_keys()
+        self.hide_text()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Live session telemetry for P038 boxes.
+
+While a session runs, MainScreen keeps a SessionTelemetry object up to date
+(current trial and sub-session, reinforcers, pecks, state of the trial and
+hopper) and serves it as JSON over a small HTTP server running on its own
+thread:
+
+    GET http://<box>:8038/metrics
+
+Updates are cheap enough to make from the Tk callbacks: they only set a few
+attributes and bump a per-second peck counter. The JSON (including pecks in
+the last minute, time left in the session, and event-loop lag) is only put
+together when someone asks for it. Event-loop lag comes from a heartbeat
+timer on the session clock: how late it fires is the lag, and if it stops
+firing altogether the seconds since the last heartbeat keep climbing, so a
+frozen box is easy to spot.
+
+Several boxes can be watched at once from any computer that can reach them:
+
+    python telemetry.py http://box1:8038 http://box2:8038 --interval 5
+"""
+
+from json import dumps, loads
+from threading import Thread
+from time import perf_counter_ns, sleep, strftime
+
+# The HTTP server/client modules are only imported once they are used, so
+# importing this module (as the program does at startup) stays quick.
+
+PECK_WINDOW_S = 60 # Pecks per minute are counted over the last minute
+HEARTBEAT_MS = 1000
+STALL_AFTER_S = 5 # No heartbeat for this long: the event loop is stuck
+LAG_WARNING_MS = 250
+
+
+class SessionTelemetry(object):
+    def __init__(self, subject_ID, training_phase, session_duration_ms,
+                 time_source=perf_counter_ns):
+        self.time_source = time_source
+        self.subject_ID = subject_ID
+        self.training_phase = training_phase
+        self.session_duration_ms = session_duration_ms
+        self.experimental_group = None
+        self.trials_per_session = None
+        self.trials_per_subsession = None
+        self.start_ns = None
+        self.state = "waiting" # waiting, ITI, between-session_ITI, keys, hopper, ended
+        self.trial = 0
+        self.reinforcers = 0
+        self.pecks = 0
+        self.hopper_state = None
+        self.dropped_events = 0
+        self.last_event = None
+        self.last_event_ns = None
+        self.loop_lag_ms = None
+        self.max_loop_lag_ms = 0.0
+        self.last_heartbeat_ns = None
+        # Pecks per second over the last PECK_WINDOW_S seconds (a ring of
+        # counts, each tagged with the second it is counting)
+        self._peck_counts = [0] * PECK_WINDOW_S
+        self._peck_seconds = [-1] * PECK_WINDOW_S
+
+    def start(self, start_ns, experimental_group, trials_per_session,
+              trials_per_subsession, session_duration_ms=None):
+        # (trials_per_session and session_duration_ms are the session's
+        # caps, which may be None if it has none)
+        self.start_ns = start_ns
+        self.experimental_group = experimental_group
+        self.trials_per_session = trials_per_session
+        self.trials_per_subsession = trials_per_subsession
+        self.session_duration_ms = session_duration_ms
+
+    def set_state(self, state, trial=None, reinforcers=None):
+        self.state = state
+        if trial is not None:
+            self.trial = trial
+        if reinforcers is not None:
+            self.reinforcers = reinforcers
+
+    def event(self, outcome, now_ns):
+        # Called for every logged event (pecks and otherwise)
+        self.last_event = outcome
+        self.last_event_ns = now_ns
+        if outcome.endswith("peck"):
+            self.pecks += 1
+            second = self._second(now_ns)
+            i = second % PECK_WINDOW_S
+            if self._peck_seconds[i] != second:
+                self._peck_seconds[i] = second
+                self._peck_counts[i] = 0
+            self._peck_counts[i] += 1
+
+    def _second(self, now_ns):
+        return (now_ns - (self.start_ns or 0)) // 1000000000
+
+    def start_heartbeat(self, clock, interval_ms=HEARTBEAT_MS):
+        # Measures event-loop lag with a timer on the session clock that
+        # re-arms itself against absolute deadlines
+        def beat():
+            deadline = clock.anchor()
+            now = clock.now_ns()
+            self.loop_lag_ms = (now - deadline) / 1e6
+            self.max_loop_lag_ms = max(self.max_loop_lag_ms, self.loop_lag_ms)
+            self.last_heartbeat_ns = now
+            clock.after(deadline, interval_ms, beat)
+        self.last_heartbeat_ns = clock.now_ns()
+        clock.after(self.last_heartbeat_ns, interval_ms, beat)
+
+    def snapshot(self):
+        # Everything as a JSON-friendly dict (called from the server thread)
+        now = self.time_source()
+        elapsed_s = (now - self.start_ns) / 1e9 if self.start_ns is not None else 0.0
+        second = self._second(now)
+        recent_pecks = sum(count for count, s in zip(list(self._peck_counts), list(self._peck_seconds))
+                           if second - PECK_WINDOW_S < s <= second)
+        if self.trials_per_subsession and self.trial:
+            subsession = (self.trial - 1) // self.trials_per_subsession + 1
+        else:
+            subsession = None
+        return {"subject": self.subject_ID,
+                "phase": self.training_phase,
+                "group": self.experimental_group,
+                "state": self.state,
+                "trial": self.trial,
+                "trials_per_session": self.trials_per_session,
+                "subsession": subsession,
+                "reinforcers": self.reinforcers,
+                "pecks": self.pecks,
+                "pecks_per_minute": recent_pecks * 60 / min(PECK_WINDOW_S, max(elapsed_s, 1)),
+                "elapsed_s": round(elapsed_s, 3),
+                "time_left_s": None if self.session_duration_ms is None else
+                    round(max(0.0, self.session_duration_ms / 1000 - elapsed_s), 3),
+                "hopper": self.hopper_state,
+                "last_event": self.last_event,
+                "seconds_since_last_event": None if self.last_event_ns is None else round((now - self.last_event_ns) / 1e9, 3),
+                "loop_lag_ms": None if self.loop_lag_ms is None else round(self.loop_lag_ms, 3),
+                "max_loop_lag_ms": round(self.max_loop_lag_ms, 3),
+                "seconds_since_heartbeat": None if self.last_heartbeat_ns is None else round((now - self.last_heartbeat_ns) / 1e9, 3),
+                "dropped_events": self.dropped_events}
+
+
+class TelemetryServer(object):
+    # Serves a SessionTelemetry's snapshot as JSON on its own thread
+    def __init__(self, telemetry, host="127.0.0.1", port=8038):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] not in ("/", "/metrics"):
+                    handler.send_error(404)
+                    return
+                body = dumps(telemetry.snapshot()).encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", "application/json")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args): # Keep the terminal for the session
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = Thread(target=self.httpd.serve_forever, name="P038-telemetry", daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def fetch(url, timeout=2.0):
+    from urllib.request import urlopen
+    if not url.startswith("http"):
+        url = "http://" + url
+    if url.rstrip("/").count("/") < 3:
+        url = url.rstrip("/") + "/metrics"
+    with urlopen(url, timeout=timeout) as response:
+        return loads(response.read().decode("utf-8"))
+
+
+def poll(urls, timeout=2.0):
+    # Fetches every box at once. Returns [(url, snapshot or None, error or None)]
+    def one(url):
+        try:
+            return url, fetch(url, timeout), None
+        except Exception as e:
+            return url, None, e
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, len(urls))) as pool:
+        return list(pool.map(one, urls))
+
+
+def status(snapshot):
+    # One-word health of a box
+    if snapshot["state"] == "ended":
+        return "ENDED"
+    heartbeat = snapshot["seconds_since_heartbeat"]
+    if heartbeat is not None and heartbeat > STALL_AFTER_S:
+        return "STALLED"
+    if snapshot["loop_lag_ms"] is not None and snapshot["loop_lag_ms"] > LAG_WARNING_MS:
+        return "LAGGING"
+    return "OK" if snapshot["state"] != "waiting" else "WAITING"
+
+
+def format_table(results):
+    lines = [f"{'Box':<24} {'Subject':>7} {'Ph':>2} {'Status':>8} {'State':>20} {'Trial':>7} {'Sub':>3} {'SR':>4} {'Pk/min':>6} {'Left':>6} {'Lag ms':>7} {'Hopper':>6}"]
+    for url, snapshot, error in results:
+        if snapshot is None:
+            lines.append(f"{url:<24} {'':>7} {'':>2} {'OFFLINE':>8} ({error})")
+            continue
+        trial = f"{snapshot['trial']}/{snapshot['trials_per_session'] or '?'}"
+        lag = "NA" if snapshot["loop_lag_ms"] is None else f"{snapshot['loop_lag_ms']:.1f}"
+        left = "-" if snapshot["time_left_s"] is None else f"{snapshot['time_left_s'] / 60:.1f}m"
+        lines.append(f"{url:<24} {snapshot['subject']:>7} {snapshot['phase']:>2} {status(snapshot):>8} "
+                     f"{snapshot['state']:>20} {trial:>7} {snapshot['subsession'] or '-':>3} "
+                     f"{snapshot['reinforcers']:>4} {snapshot['pecks_per_minute']:>6.1f} "
+                     f"{left:>6} {lag:>7} {snapshot['hopper'] or 'NA':>6}")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Watch the live telemetry of several P038 boxes")
+    parser.add_argument("boxes", nargs="+", help="box addresses, e.g. http://box1:8038")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between polls")
+    parser.add_argument("--once", action="store_true", help="poll once and exit")
+    args = parser.parse_args()
+
+    while True:
+        print(f"\n{strftime('%H:%M:%S')}\n" + format_table(poll(args.boxes)))
+        if args.once:
+            break
+        sleep(args.interval)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that a failed hopper command doesn't leave the hopper stuck (see
+hopper_driver.py). Run with "python -m pytest test_hopper_driver.py".
+"""
+
+from time import perf_counter, sleep
+
+from hopper_driver import HopperDriver, SimulatedHopperObject
+
+
+def make_driver(failures=0):
+    # Unthreaded, so each command has been sent by the time set_state() returns
+    hopper = SimulatedHopperObject(on_delay_ms=0, off_delay_ms=0, failures=failures)
+    return hopper, HopperDriver(hopper, threaded=False)
+
+
+def wait_for_commands(driver, n, timeout_s=5):
+    # Until the worker has sent n commands
+    deadline = perf_counter() + timeout_s
+    while len(driver.commands) < n and perf_counter() < deadline:
+        sleep(0.001)
+
+
+def test_repeated_command_dropped():
+    hopper, driver = make_driver()
+    assert driver.set_state("On")
+    assert not driver.set_state("On")
+    assert hopper.calls == 1 and driver.dropped == 1
+
+
+def test_repeated_off_dropped_unless_forced():
+    # The "Off" at every ITI and key presentation is only sent once; the
+    # forced one (at the end of the session) always is
+    hopper, driver = make_driver()
+    assert driver.set_state("Off")
+    assert not driver.set_state("Off")
+    assert driver.set_state("Off", force=True)
+    assert hopper.calls == 2 and driver.dropped == 1
+
+
+def test_failed_command_not_dropped_next_time():
+    # The hopper fails to go down once; the next "Off" (even an ordinary
+    # one) has to be sent, and then it does go down
+    hopper, driver = make_driver()
+    driver.set_state("On")
+    hopper.failures = 1
+    driver.set_state("Off")
+    assert hopper.state == "On"
+    assert driver.requested_state is None
+    assert driver.commands[-1][4] is not None # The error was kept
+    assert driver.set_state("Off")
+    assert hopper.state == "Off"
+
+
+def test_failed_off_resent_threaded():
+    # Same as above, with the commands sent from the worker thread
+    hopper = SimulatedHopperObject(on_delay_ms=0, off_delay_ms=0)
+    driver = HopperDriver(hopper)
+    driver.set_state("On")
+    wait_for_commands(driver, 1)
+    hopper.failures = 1
+    driver.set_state("Off")
+    wait_for_commands(driver, 2)
+    assert driver.requested_state is None
+    assert driver.set_state("Off")
+    assert not driver.set_state("Off")
+    driver.close()
+    assert hopper.state == "Off"
+    assert len(driver.commands) == 3 and driver.dropped == 1
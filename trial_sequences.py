@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Constraint-aware trial order generation for P038 sessions.
+
+The trial order used to be found by reshuffling the whole list of trials
+until no trial type was repeated four times in a row. That loop had no upper
+bound on the number of reshuffles, never checked the first few positions of
+the list, and never checked the junction where the two 40-trial sub-sessions
+of a training session meet.
+
+Here, the order is instead built one trial at a time so that it is valid by
+construction. At each position, a trial type is drawn at random (weighted by
+how many trials of each type are left, just like a shuffle) from the types
+that would still leave a valid way to arrange the rest of the trials. A type
+with n trials left can still be arranged around the other r trials, with at
+most k in a row, as long as n <= k * (r + 1) (or, if it is the type of the
+current run of length L, n <= (k - L) + k * r). Checking that for each type
+is all that's needed, so the generator never backtracks and runs in linear
+time.
+
+Constraints are configurable:
+
+    - max_run: the maximum number of the same trial type in a row (None for
+      no limit)
+    - blocks: each block (sub-session) gets exactly its own list of trials,
+      so every sub-session stays balanced
+    - carry_across_blocks: whether runs are counted across the boundary
+      between blocks (e.g., the end of the first and start of the second
+      40-trial sub-session)
+    - previous: the trial order this one carries on from, if any (e.g.,
+      the last pass of a long session that runs through its blocks over and
+      over; see pass_seed())
+
+Passing the same seed always gives the same trial order.
+"""
+
+from collections import namedtuple
+from random import Random, SystemRandom
+
+# The trial composition of a session (see P038_Protocol.json)
+SessionPlan = namedtuple("SessionPlan", ["trials_per_session",
+                                         "trials_per_subsession",
+                                         "blocks", # list of lists of trial types
+                                         "max_run",
+                                         "rest_between_blocks"], # Long ITI between sub-sessions?
+                         defaults = (False,))
+
+
+def session_plan(training_phase, experimental_group=None, max_run=None):
+    # Returns the block (sub-session) structure of a session, as given for
+    # that phase/group in the protocol file. E.g., pre-training is a single
+    # block of 60 trials (4 trial types * 15 iterations each), and training
+    # is two sub-sessions of 40 trials each, made up of only choice trials
+    # for the Choice group (with no limit on run lengths), or 12 choice
+    # trials + 28 forced trials for the Forced group. max_run, if given,
+    # replaces the protocol's run limit.
+    from protocol import load_protocol # (protocol.py builds on this module)
+    return load_protocol().session_plan(training_phase, experimental_group, max_run)
+
+
+def new_seed():
+    # A fresh random seed, which can be printed/saved so that a session's
+    # trial order can be rebuilt later
+    return SystemRandom().randrange(2**32)
+
+
+def pass_seed(seed, pass_number):
+    # The seed of each pass through a session's blocks (the first pass
+    # uses the session's seed itself)
+    return (seed + pass_number * 0x9E3779B9) % 2**32
+
+
+def _is_feasible(counts, last, run, max_run):
+    # Can the remaining trials (counts) be arranged with no more than
+    # max_run in a row, given that the sequence so far ends with a run of
+    # length "run" of trial type "last"?
+    total = sum(counts.values())
+    for trial_type, n in counts.items():
+        if n == 0:
+            continue
+        others = total - n
+        if trial_type == last:
+            capacity = (max_run - run) + max_run * others
+        else:
+            capacity = max_run * (others + 1)
+        if n > capacity:
+            return False
+    return True
+
+
+def generate_sequence(blocks, max_run=None, carry_across_blocks=True,
+                      seed=None, rng=None, previous=None):
+    # Builds a trial order out of a list of blocks. Each block's trials
+    # appear (in a random order) before the next block's. Raises a
+    # ValueError if the constraints can't be met.
+    if rng is None:
+        rng = Random(seed)
+    order = []
+    last, run = None, 0
+    for trial_type in previous or (): # The run the previous order ends with
+        if trial_type == last:
+            run += 1
+        else:
+            last, run = trial_type, 1
+    for block_number, block in enumerate(blocks):
+        counts = {}
+        for trial_type in block: # dicts keep insertion order, so this is reproducible
+            counts[trial_type] = counts.get(trial_type, 0) + 1
+        if not carry_across_blocks:
+            last, run = None, 0
+        if max_run is not None and not _is_feasible(counts, last, run, max_run):
+            raise ValueError(f"Block {block_number + 1} cannot be arranged with "
+                             f"no more than {max_run} of the same trial in a row")
+        remaining = len(block)
+        while remaining:
+            # Every type that still has trials left and would leave a valid
+            # arrangement of the rest is a candidate...
+            candidates = []
+            for trial_type, n in counts.items():
+                if n == 0:
+                    continue
+                if max_run is not None:
+                    new_run = run + 1 if trial_type == last else 1
+                    if new_run > max_run:
+                        continue
+                    counts[trial_type] -= 1
+                    ok = _is_feasible(counts, trial_type, new_run, max_run)
+                    counts[trial_type] += 1
+                    if not ok:
+                        continue
+                candidates.append(trial_type)
+            # ...and one is drawn with a weight of how many are left
+            pick = rng.randrange(sum(counts[c] for c in candidates))
+            for trial_type in candidates:
+                pick -= counts[trial_type]
+                if pick < 0:
+                    break
+            order.append(trial_type)
+            counts[trial_type] -= 1
+            remaining -= 1
+            if trial_type == last:
+                run += 1
+            else:
+                last, run = trial_type, 1
+    return order
+
+
+def build_trial_order(training_phase, experimental_group=None, seed=None,
+                      max_run=None, carry_across_blocks=True):
+    # The full trial order of a session for a given phase and group
+    plan = session_plan(training_phase, experimental_group, max_run)
+    return generate_sequence(plan.blocks,
+                             max_run = plan.max_run,
+                             carry_across_blocks = carry_across_blocks,
+                             seed = seed)
+
+
+def longest_run(order):
+    # Length of the longest run of the same trial type in a trial order
+    longest, run, last = 0, 0, None
+    for trial_type in order:
+        run = run + 1 if trial_type == last else 1
+        last = trial_type
+        longest = max(longest, run)
+    return longest